@@ -0,0 +1,36 @@
+"""Benchmarks of the start of the command line interface, in fresh interpreters."""
+
+import subprocess
+import sys
+
+
+def run(*args: str):
+    subprocess.run([sys.executable, *args], check=True, stdout=subprocess.DEVNULL)
+
+
+def test_import_package(benchmark):
+    benchmark.pedantic(run, args=("-c", "import psha_disag_mod.__main__"), rounds=5)
+
+
+def test_import_plots(benchmark):
+    """Reference: the import of matplotlib, spared to the commands not plotting."""
+    benchmark.pedantic(
+        run, args=("-c", "import psha_disag_mod.plots_psha_disag"), rounds=5
+    )
+
+
+def test_cli_list(benchmark, curves_dir):
+    benchmark.pedantic(
+        run,
+        args=("-m", "psha_disag_mod", "list", curves_dir, "--type-data", "mean"),
+        rounds=5,
+    )
+
+
+def test_cli_stats(benchmark, curves_dir):
+    run("-m", "psha_disag_mod", "stats", curves_dir, "--poes", "0.002105")
+    benchmark.pedantic(
+        run,
+        args=("-m", "psha_disag_mod", "stats", curves_dir, "--poes", "0.002105"),
+        rounds=5,
+    )
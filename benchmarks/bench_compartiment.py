@@ -0,0 +1,68 @@
+"""Time the parsing and filtering of a large listing of OpenQuake exports.
+
+The linear filter_filenames is compared with a FilenameIndex, and the
+per-name read_psha_params with the bulk read_psha_params_many.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_compartiment [n_seeds]
+"""
+
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_listing
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    parse_psha_filename,
+    read_psha_params,
+    read_psha_params_many,
+)
+
+QUERIES = [
+    {"startname": ["hazard"]},
+    {"type_filename": ["curve"], "type_data": ["mean"], "type_acc": ["PGA"]},
+    {"type_data": ["rlz-"], "seed": [14]},
+    {"type_filename": ["uhs"], "type_data": ["0.05", "0.5", "0.95"]},
+    {"type_acc": ["SA(0.1)", "SA(1.0)"], "seed": [0, 14, 42]},
+]
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(n_seeds: int = 32):
+    filenames = synthetic_listing(n_seeds)
+    print(f"{len(filenames)} filenames, {len(QUERIES)} queries")
+
+    parse_psha_filename.cache_clear()
+    _, single_time = timed(lambda: [read_psha_params(name) for name in filenames])
+    _, many_time = timed(read_psha_params_many, filenames)
+    print(f"read_psha_params: {single_time:.3f} s, many: {many_time:.3f} s")
+
+    index, build_time = timed(FilenameIndex, filenames)
+    print(f"FilenameIndex build: {build_time:.3f} s")
+
+    total_linear = total_index = 0.0
+    for query in QUERIES:
+        expected, linear_time = timed(filter_filenames, filenames, "psha", **query)
+        filtered, index_time = timed(filter_filenames, index, "psha", **query)
+        assert filtered == expected, query
+        total_linear += linear_time
+        total_index += index_time
+        print(
+            f"{str(query):<75} {len(filtered):>7} files  "
+            f"linear {linear_time:.3f} s  index {index_time:.4f} s"
+        )
+    print(
+        f"total: linear {total_linear:.3f} s, "
+        f"index {total_index:.4f} s (+ {build_time:.3f} s build)"
+    )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
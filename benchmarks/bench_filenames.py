@@ -0,0 +1,52 @@
+"""Benchmarks of the parsing and filtering of the names of the exports."""
+
+import pytest
+
+from benchmarks.bench_compartiment import QUERIES
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    parse_psha_filename,
+    read_psha_params,
+    read_psha_params_many,
+)
+
+
+def test_read_psha_params(benchmark, listing):
+    benchmark.extra_info["names"] = len(listing)
+    benchmark.pedantic(
+        lambda: [read_psha_params(name) for name in listing],
+        setup=parse_psha_filename.cache_clear,
+        rounds=3,
+    )
+
+
+def test_read_psha_params_many(benchmark, listing):
+    benchmark.extra_info["names"] = len(listing)
+    benchmark.pedantic(
+        read_psha_params_many,
+        args=(listing,),
+        setup=parse_psha_filename.cache_clear,
+        rounds=3,
+    )
+
+
+def test_filename_index(benchmark, listing):
+    benchmark.extra_info["names"] = len(listing)
+    benchmark.pedantic(
+        FilenameIndex, args=(listing,), setup=parse_psha_filename.cache_clear, rounds=3
+    )
+
+
+@pytest.mark.parametrize("query", QUERIES, ids=range(len(QUERIES)))
+def test_filter_filenames(benchmark, listing, query):
+    benchmark.group = "filter_filenames"
+    parse_psha_filename.cache_clear()
+    benchmark(filter_filenames, listing, "psha", **query)
+
+
+@pytest.mark.parametrize("query", QUERIES, ids=range(len(QUERIES)))
+def test_filter_index(benchmark, listing, query):
+    benchmark.group = "filter_index"
+    index = FilenameIndex(listing)
+    benchmark(filter_filenames, index, "psha", **query)
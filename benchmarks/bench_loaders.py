@@ -0,0 +1,88 @@
+"""Benchmarks of the readers of the CSV exports and of the NRML source models."""
+
+import os
+
+import numpy as np
+
+from benchmarks.synthetic import site_grid
+from psha_disag_mod.compartiment import filter_filenames
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.drouet_curves import (
+    load_hazard_curves,
+    read_hazard_curve,
+    stack_hazard_curves,
+)
+from psha_disag_mod.euro_xml import parse_source_model, read_source_model
+from psha_disag_mod.pipeline import scan_directory, stream_map
+from psha_disag_mod.source_distances import model_distance_rates
+
+
+def test_read_hazard_curve(benchmark, curves_dir, scale):
+    benchmark.extra_info.update(sites=scale.sites, levels=scale.levels)
+    benchmark(
+        read_hazard_curve, os.path.join(curves_dir, "hazard_curve-mean-PGA_18.csv")
+    )
+
+
+def test_stack_hazard_curves(benchmark, curves_dir, scale):
+    benchmark.extra_info.update(sites=scale.sites, levels=scale.levels)
+    paths = [
+        os.path.join(curves_dir, filename)
+        for filename in filter_filenames(os.listdir(curves_dir), "psha")
+    ]
+    benchmark.pedantic(stack_hazard_curves, args=(paths,), rounds=3)
+
+
+def test_stream_hazard_curves(benchmark, curves_dir, scale):
+    benchmark.extra_info.update(sites=scale.sites, levels=scale.levels)
+
+    def stream():
+        return list(
+            stream_map(
+                lambda filename: read_hazard_curve(os.path.join(curves_dir, filename)),
+                scan_directory(curves_dir, "psha"),
+            )
+        )
+
+    benchmark.pedantic(stream, rounds=3)
+
+
+def test_load_hazard_curves_cached(benchmark, curves_dir):
+    load_hazard_curves(curves_dir)
+    benchmark(load_hazard_curves, curves_dir)
+
+
+def test_read_disaggregation(benchmark, mag_dist_eps_path, scale):
+    benchmark.extra_info.update(mags=scale.mags, dists=scale.dists, eps=scale.eps)
+    benchmark.pedantic(read_disaggregation, args=(mag_dist_eps_path,), rounds=3)
+
+
+def test_parse_source_model(benchmark, source_model_path, scale):
+    benchmark.extra_info.update(areas=scale.areas, points=scale.points)
+    benchmark.pedantic(parse_source_model, args=(source_model_path,), rounds=3)
+
+
+def test_read_source_model_cached(benchmark, source_model_path):
+    read_source_model(source_model_path)
+    benchmark(read_source_model, source_model_path)
+
+
+def test_model_distance_rates(benchmark, source_model_path, scale):
+    sites = site_grid(scale.sites)
+    edges = np.arange(0.0, 260.0, 10.0)
+    benchmark.extra_info.update(
+        areas=scale.areas, points=scale.points, sites=scale.sites
+    )
+    benchmark.pedantic(
+        model_distance_rates,
+        args=(source_model_path, sites, edges),
+        kwargs={"use_cache": False},
+        rounds=3,
+    )
+
+
+def test_model_distance_rates_cached(benchmark, source_model_path, scale):
+    sites = site_grid(scale.sites)
+    edges = np.arange(0.0, 260.0, 10.0)
+    model_distance_rates(source_model_path, sites, edges)
+    benchmark(model_distance_rates, source_model_path, sites, edges)
@@ -0,0 +1,70 @@
+"""Benchmarks of the rendering of the figures, on the Agg backend."""
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import imt_levels, synthetic_poes
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.plots_psha_disag import (
+    mag_dist_contributions,
+    render_disag_mag_dist,
+    render_hazard_curves,
+    render_uhs,
+    type_data_style,
+)
+from psha_disag_mod.utils import imt_frequency
+
+TYPE_DATAS = ["mean", "rlz-000", "rlz-001", "rlz-002", "rlz-003"]
+
+
+@pytest.mark.parametrize("template", [False, True])
+def test_render_hazard_curves(benchmark, tmp_path, scale, template):
+    imls = imt_levels(scale.levels)
+    poes = synthetic_poes(len(TYPE_DATAS), imls)
+    benchmark.pedantic(
+        render_hazard_curves,
+        args=(
+            str(tmp_path / "curve.png"),
+            {type_data: imls for type_data in TYPE_DATAS},
+            dict(zip(TYPE_DATAS, poes)),
+            {type_data: type_data_style(type_data) for type_data in TYPE_DATAS},
+            "PGA",
+        ),
+        kwargs={"template": template},
+        rounds=3,
+    )
+
+
+def test_render_uhs(benchmark, tmp_path):
+    imts = ["SA(0.03)", "SA(0.1)", "SA(0.3)", "SA(1.0)", "SA(3.0)"]
+    frequencies = np.array([imt_frequency(imt) for imt in imts])
+    spectra = synthetic_poes(len(TYPE_DATAS), frequencies)
+    benchmark.pedantic(
+        render_uhs,
+        args=(
+            str(tmp_path / "uhs.png"),
+            frequencies,
+            dict(zip(TYPE_DATAS, spectra)),
+            {type_data: type_data_style(type_data) for type_data in TYPE_DATAS},
+            "475 years",
+        ),
+        rounds=3,
+    )
+
+
+@pytest.mark.parametrize("template", [False, True])
+def test_render_disag_mag_dist(benchmark, tmp_path, mag_dist_eps_path, template):
+    matrix = read_disaggregation(mag_dist_eps_path)
+    benchmark.pedantic(
+        render_disag_mag_dist,
+        args=(
+            str(tmp_path / "disag.png"),
+            matrix.bin_edges["Mag"],
+            matrix.bin_edges["Dist"],
+            mag_dist_contributions(matrix)[0, 0],
+            matrix.poes[0],
+            matrix.imts[0],
+        ),
+        kwargs={"template": template},
+        rounds=3,
+    )
@@ -0,0 +1,58 @@
+"""Synthetic data of the pytest-benchmark suite, written once per session.
+
+The size of the data is chosen with the ``PSHA_BENCH_SCALE`` environment
+variable, one of the :data:`~benchmarks.synthetic.SCALES` (``medium`` by
+default).
+"""
+
+import os
+
+import pytest
+
+from benchmarks.synthetic import (
+    SCALES,
+    listing_of_size,
+    write_hazard_curves,
+    write_mag_dist_eps,
+    write_source_model,
+)
+
+
+@pytest.fixture(scope="session")
+def scale():
+    name = os.environ.get("PSHA_BENCH_SCALE", "medium")
+    if name not in SCALES:
+        raise pytest.UsageError(
+            f"PSHA_BENCH_SCALE={name} is not one of {', '.join(SCALES)}"
+        )
+    return SCALES[name]
+
+
+@pytest.fixture(scope="session")
+def listing(scale):
+    return listing_of_size(scale.names)
+
+
+@pytest.fixture(scope="session")
+def curves_dir(tmp_path_factory, scale):
+    """Export directory of the mean and 4 realizations of 15 IMTs."""
+    path = str(tmp_path_factory.mktemp("output"))
+    write_hazard_curves(path, scale.sites, scale.levels)
+    return path
+
+
+@pytest.fixture(scope="session")
+def mag_dist_eps_path(tmp_path_factory, scale):
+    path = str(tmp_path_factory.mktemp("disag") / "Mag_Dist_Eps-0_18.csv")
+    write_mag_dist_eps(path, scale.mags, scale.dists, scale.eps)
+    return path
+
+
+@pytest.fixture(scope="session")
+def source_model_path(tmp_path_factory, scale):
+    """Source model of area sources and 10 multi-point sources."""
+    path = str(tmp_path_factory.mktemp("model") / "source_model.xml")
+    write_source_model(
+        path, scale.areas, n_multi_points=10, n_points=scale.points // 10
+    )
+    return path
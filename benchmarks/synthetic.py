@@ -0,0 +1,274 @@
+"""Synthetic OpenQuake outputs and source models at configurable sizes.
+
+The files have the layout of the exports of OpenQuake 3.15 (see the
+Drouet-Simplified run), with made-up values: they are only meant to give the
+readers of the package realistic amounts of data to chew on.
+"""
+
+import math
+import os
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from tests.test_compartiment import generate_filenames
+
+IMTS = ["PGA"] + [
+    f"SA({period})"
+    for period in (
+        0.03,
+        0.05,
+        0.1,
+        0.15,
+        0.2,
+        0.25,
+        0.3,
+        0.4,
+        0.5,
+        0.75,
+        1.0,
+        1.5,
+        2.0,
+        3.0,
+    )
+]
+HAZARD_TYPE_DATAS = ["mean"] + [f"rlz-{rlz:03d}" for rlz in range(100)]
+QUANTILES = ["0.05", "0.5", "0.95"]
+POES = [0.002105, 0.000404, 0.0002, 0.0001]
+# Filenames per seed of synthetic_listing
+NAMES_PER_SEED = 2 * (len(HAZARD_TYPE_DATAS) + len(QUANTILES)) * len(IMTS)
+
+GENERATED_BY = "generated_by='OpenQuake engine 3.15.0', investigation_time=1.0"
+
+
+class Scale(NamedTuple):
+    """Sizes of the synthetic data of a benchmark run."""
+
+    # Filenames of the listing
+    names: int
+    # Sites and levels of the hazard curves
+    sites: int
+    levels: int
+    # Bins of the Mag_Dist_Eps disaggregation
+    mags: int
+    dists: int
+    eps: int
+    # Area sources and points of the multi-point sources
+    areas: int
+    points: int
+
+
+SCALES = {
+    "small": Scale(10_000, 100, 20, 6, 10, 3, 50, 1_000),
+    "medium": Scale(100_000, 1_000, 22, 8, 25, 6, 500, 10_000),
+    "large": Scale(1_000_000, 10_000, 44, 12, 50, 10, 5_000, 100_000),
+}
+
+
+def synthetic_listing(n_seeds: int = 32) -> List[str]:
+    """3,120 filenames per seed: 101 hazard data types, 3 quantiles, 15 IMTs."""
+    filenames, _ = generate_filenames(
+        startnames=("hazard", "quantile"),
+        type_filenames=("uhs", "curve"),
+        type_datas={"hazard": HAZARD_TYPE_DATAS, "quantile": QUANTILES},
+        type_accs=IMTS,
+        seeds=list(range(n_seeds)),
+    )
+    return filenames
+
+
+def listing_of_size(n_names: int) -> List[str]:
+    """At least ``n_names`` filenames of :func:`synthetic_listing`, whole seeds."""
+    return synthetic_listing(max(1, math.ceil(n_names / NAMES_PER_SEED)))
+
+
+def site_grid(n_sites: int) -> np.ndarray:
+    """(lon, lat) of a regular grid of about 0.1° around Grenoble, shape (site, 2)."""
+    side = math.ceil(math.sqrt(n_sites))
+    index = np.arange(n_sites)
+    return np.column_stack([5.0 + 0.1 * (index % side), 44.5 + 0.1 * (index // side)])
+
+
+def imt_levels(n_levels: int) -> np.ndarray:
+    """Logarithmically spaced intensity measure levels, from 5e-4 to 3 g."""
+    return np.geomspace(5e-4, 3.0, n_levels)
+
+
+def synthetic_poes(n_sites: int, imls: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """Decreasing curves of annual PoE, one per site, shape (site, IML)."""
+    amplitude = scale * np.linspace(0.5, 1.5, n_sites)[:, np.newaxis]
+    return np.clip(amplitude * 1e-2 * (imls / imls[0]) ** -1.5, 0, 1)
+
+
+def write_hazard_curve(
+    path: str, kind: str, imt: str, lonlats: np.ndarray, imls: np.ndarray, poes
+):
+    """Write the hazard curves of every site of an IMT in the format of OpenQuake."""
+    header = ["lon", "lat", "depth"] + [f"poe-{iml:.7f}" for iml in imls]
+    rows = np.column_stack([lonlats, np.zeros(len(lonlats)), poes])
+    with open(path, "w") as csv_file:
+        csv_file.write(
+            f"#,,,\"{GENERATED_BY}, kind='{kind}', imt='{imt}'\"\n"
+            + ",".join(header)
+            + "\n"
+        )
+        np.savetxt(
+            csv_file,
+            rows,
+            fmt=["%.5f", "%.5f", "%.5f"] + ["%.6E"] * len(imls),
+            delimiter=",",
+        )
+
+
+def write_hazard_curves(
+    export_dir: str,
+    n_sites: int,
+    n_levels: int,
+    imts: Sequence[str] = IMTS,
+    n_rlzs: int = 4,
+    seed: int = 18,
+) -> List[str]:
+    """Write the mean and ``n_rlzs`` realizations of the curves of every IMT.
+
+    Returns:
+        The names of the files written.
+    """
+    lonlats = site_grid(n_sites)
+    imls = imt_levels(n_levels)
+    filenames = []
+    for i, type_data in enumerate(["mean"] + [f"rlz-{r:03d}" for r in range(n_rlzs)]):
+        for imt in imts:
+            filename = f"hazard_curve-{type_data}-{imt}_{seed}.csv"
+            write_hazard_curve(
+                os.path.join(export_dir, filename),
+                type_data,
+                imt,
+                lonlats,
+                imls,
+                synthetic_poes(n_sites, imls, 1.0 + 0.1 * i),
+            )
+            filenames.append(filename)
+    return filenames
+
+
+def write_mag_dist_eps(
+    path: str,
+    n_mags: int,
+    n_dists: int,
+    n_eps: int,
+    imts: Sequence[str] = IMTS,
+    poes: Sequence[float] = POES,
+    n_rlzs: int = 1,
+):
+    """Write a ``Mag_Dist_Eps`` disaggregation with bins of 0.5, 10 km and 2 sigma."""
+    mag_edges = 4.5 + 0.5 * np.arange(n_mags + 1)
+    dist_edges = 10.0 * np.arange(n_dists + 1)
+    eps_edges = np.linspace(-n_eps, n_eps, n_eps + 1)
+    metadata = (
+        f"{GENERATED_BY}, mag_bin_edges={mag_edges.tolist()}, "
+        f"dist_bin_edges={dist_edges.tolist()}, eps_bin_edges={eps_edges.tolist()}, "
+        f"tectonic_region_types=['Stable Shallow Crust'], "
+        f"rlz_ids={list(range(n_rlzs))}, weights={[1.0 / n_rlzs] * n_rlzs}, "
+        "lon=5.73, lat=45.19"
+    )
+    mags, dists, eps = np.meshgrid(
+        (mag_edges[:-1] + mag_edges[1:]) / 2,
+        (dist_edges[:-1] + dist_edges[1:]) / 2,
+        (eps_edges[:-1] + eps_edges[1:]) / 2,
+        indexing="ij",
+    )
+    bins = np.column_stack([mags.ravel(), dists.ravel(), eps.ravel()])
+    rlzs = ",".join(f"rlz{rlz}" for rlz in range(n_rlzs))
+    with open(path, "w") as csv_file:
+        csv_file.write(f'#,,,"{metadata}"\nimt,poe,mag,dist,eps,{rlzs}\n')
+        for imt in imts:
+            for poe in poes:
+                values = poe * np.exp(-bins[:, 1:2] / 50.0) * np.ones(n_rlzs)
+                rows = np.column_stack([bins, values / len(bins)])
+                lines = [
+                    f"{imt},{poe}," + ",".join(f"{v:.5E}" for v in row) for row in rows
+                ]
+                csv_file.write("\n".join(lines) + "\n")
+
+
+_DISTRIBUTIONS = """        <nodalPlaneDist>
+          <nodalPlane probability="0.5" strike="0.0" dip="90" rake="0"/>
+          <nodalPlane probability="0.5" strike="90.0" dip="60" rake="-90"/>
+        </nodalPlaneDist>
+        <hypoDepthDist>
+          <hypoDepth probability="0.2" depth="5.8"/>
+          <hypoDepth probability="0.6" depth="11.5"/>
+          <hypoDepth probability="0.2" depth="17.2"/>
+        </hypoDepthDist>"""
+
+
+def _area_source(i: int, n_vertices: int) -> str:
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    lon, lat = 5.0 + 0.01 * i, 44.5 + 0.005 * i
+    ring = np.column_stack([lon + 0.2 * np.cos(angles), lat + 0.2 * np.sin(angles)])
+    ring = np.vstack([ring, ring[:1]])
+    return f"""      <areaSource id="A{i}" name="AREA_{i}">
+        <areaGeometry>
+          <gml:Polygon><gml:exterior><gml:LinearRing>
+            <gml:posList>{" ".join(f"{value:.6f}" for value in ring.ravel())}</gml:posList>
+          </gml:LinearRing></gml:exterior></gml:Polygon>
+          <upperSeismoDepth>0.1</upperSeismoDepth>
+          <lowerSeismoDepth>20.0</lowerSeismoDepth>
+        </areaGeometry>
+        <magScaleRel>WC1994</magScaleRel>
+        <ruptAspectRatio>1.0</ruptAspectRatio>
+        <truncGutenbergRichterMFD aValue="1.7" bValue="0.94" minMag="4.0" maxMag="6.3"/>
+{_DISTRIBUTIONS}
+      </areaSource>
+"""
+
+
+def _multi_point_source(i: int, n_points: int) -> str:
+    lonlats = site_grid(n_points) + [0.05, 0.05]
+    a_values = np.linspace(-0.6, 0.1, n_points)
+    return f"""      <multiPointSource id="MPS{i}" name="POINTS_{i}">
+        <multiPointGeometry>
+          <gml:posList>{" ".join(f"{value:.6f}" for value in lonlats.ravel())}</gml:posList>
+          <upperSeismoDepth>0.1</upperSeismoDepth>
+          <lowerSeismoDepth>20.0</lowerSeismoDepth>
+        </multiPointGeometry>
+        <magScaleRel>WC1994</magScaleRel>
+        <ruptAspectRatio>1.0</ruptAspectRatio>
+        <multiMFD kind="truncGutenbergRichterMFD" size="{n_points}">
+          <a_val>{" ".join(f"{value:.6f}" for value in a_values)}</a_val>
+          <b_val>0.94</b_val>
+          <bin_width>0.1</bin_width>
+          <max_mag>6.3</max_mag>
+          <min_mag>4.0</min_mag>
+        </multiMFD>
+{_DISTRIBUTIONS}
+      </multiPointSource>
+"""
+
+
+def write_source_model(
+    path: str,
+    n_areas: int,
+    n_vertices: int = 12,
+    n_multi_points: int = 0,
+    n_points: int = 1000,
+):
+    """Write a NRML source model of area sources and multi-point sources.
+
+    Args:
+        n_areas: number of area sources, polygons of ``n_vertices`` vertices.
+        n_multi_points: number of multi-point sources, of ``n_points`` points each.
+    """
+    with open(path, "w") as xml_file:
+        xml_file.write(
+            "<?xml version='1.0' encoding='UTF8'?>\n"
+            '<nrml xmlns:gml="http://www.opengis.net/gml" '
+            'xmlns="http://openquake.org/xmlns/nrml/0.5">\n'
+            '  <sourceModel name="SYNTHETIC">\n'
+            '    <sourceGroup tectonicRegion="Stable Shallow Crust">\n'
+        )
+        for i in range(n_areas):
+            xml_file.write(_area_source(i, n_vertices))
+        for i in range(n_multi_points):
+            xml_file.write(_multi_point_source(i, n_points))
+        xml_file.write("    </sourceGroup>\n  </sourceModel>\n</nrml>\n")
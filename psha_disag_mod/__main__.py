@@ -0,0 +1,319 @@
+"""Command line interface: ``python -m psha_disag_mod <command> ...``.
+
+    list    filenames of an export directory matching patterns (alias: filter)
+    ingest  pack an export directory into one archive
+    plot    figures of a run: curve, uhs or disag
+    stats   UHS of the curves of a site, or modal/mean disaggregation scenarios
+    compare deviations of runs (directories or seeds) from a reference run
+    watch   figures of a run rendered as OpenQuake writes its files
+
+The modules of the package, and matplotlib with them, are only imported by
+the commands using them, so that ``list`` starts with NumPy alone.
+"""
+
+import argparse
+import sys
+from contextlib import nullcontext
+from typing import Optional, Sequence
+
+from psha_disag_mod.utils import profiling
+
+
+def _list(args: argparse.Namespace):
+    from psha_disag_mod.compartiment import FilenameIndex, filter_filenames
+
+    filenames = filter_filenames(
+        FilenameIndex.from_directory(args.export_dir),
+        args.mode,
+        startname=args.startname,
+        type_filename=args.type_filename,
+        type_data=args.type_data,
+        type_acc=args.type_acc,
+        seed=args.seed,
+        disaggregation_patterns=args.axes,
+        sites=args.site,
+    )
+    for filename in filenames:
+        print(filename)
+
+
+def _ingest(args: argparse.Namespace):
+    from psha_disag_mod.archive import ingest_export
+
+    print(ingest_export(args.export_dir, args.archive, args.job_ini))
+
+
+def _plot(args: argparse.Namespace):
+    from psha_disag_mod.plots_psha_disag import plot_run
+
+    if args.kind == "uhs" and args.poes is None and args.job_ini is None:
+        raise SystemExit("plot uhs: give the PoEs of the spectra, --poes or --job-ini")
+    paths = plot_run(
+        args.export_dir,
+        args.plot_dir,
+        site=args.site,
+        workers=args.workers,
+        force=args.force,
+        poes=args.poes,
+        job_ini=args.job_ini,
+        kinds=[args.kind],
+        stream=args.stream,
+    )
+    for path in paths:
+        print(path)
+
+
+def _stats(args: argparse.Namespace):
+    from psha_disag_mod.disag_analytics import scenario_table, write_table
+
+    if args.disag:
+        from psha_disag_mod.disaggregation import (
+            find_mag_dist_file,
+            read_disaggregation,
+        )
+
+        path = find_mag_dist_file(args.export_dir, args.site, seed=args.seed)
+        if path is None:
+            raise SystemExit(f"No Mag_Dist disaggregation of site {args.site}")
+        table = scenario_table(read_disaggregation(path, use_cache=True))
+    else:
+        import numpy as np
+
+        from psha_disag_mod.drouet_curves import load_hazard_curves, uhs_table
+
+        poes = args.poes
+        if poes is None and args.job_ini is not None:
+            from psha_disag_mod.metadata_ini import read_job_config
+
+            poes = read_job_config(args.job_ini).poes.tolist()
+        if not poes:
+            raise SystemExit("stats: give the PoEs of the spectra, --poes or --job-ini")
+        curves = load_hazard_curves(args.export_dir, seed=args.seed)
+        statistics = [t for t in curves.type_datas if not t.startswith("rlz-")]
+        if statistics:
+            curves = curves.select(type_datas=statistics)
+        investigation_time = next(iter(curves.metadata.values()), {}).get(
+            "investigation_time", 1.0
+        )
+        table = uhs_table(curves, poes, args.site, investigation_time)
+        exported = ~np.isnan(table["acceleration"])
+        table = {column: values[exported] for column, values in table.items()}
+    write_table(args.output or sys.stdout, table)
+
+
+def _compare(args: argparse.Namespace):
+    from psha_disag_mod.comparison import (
+        comparison_report,
+        load_disaggregations,
+        parse_run,
+        stack_runs,
+    )
+    from psha_disag_mod.disag_analytics import write_table
+
+    runs = [parse_run(spec) for spec in args.runs]
+    poes = args.poes
+    if poes is None and args.job_ini is not None:
+        from psha_disag_mod.metadata_ini import read_job_config
+
+        poes = read_job_config(args.job_ini).poes.tolist()
+    patterns = {"type_data": args.type_data} if args.type_data else {}
+    report = comparison_report(
+        stack_runs(runs, args.reference, **patterns),
+        poes=poes,
+        matrices=load_disaggregations(runs, args.site) if args.disag else None,
+        reference=args.reference,
+        min_poe=args.min_poe,
+    )
+    write_table(args.output or sys.stdout, report)
+
+
+def _watch(args: argparse.Namespace):
+    from psha_disag_mod.watch import watch_run
+
+    config = None
+    if args.job_ini is not None:
+        from psha_disag_mod.metadata_ini import read_job_config
+
+        config = read_job_config(args.job_ini)
+
+    def print_update(update):
+        for path in update.rendered:
+            print(path, flush=True)
+
+    try:
+        watch_run(
+            args.export_dir,
+            args.plot_dir,
+            site=args.site,
+            workers=args.workers,
+            poes=args.poes,
+            config=config,
+            poll_interval=args.poll,
+            settle=args.settle,
+            idle_timeout=args.idle_timeout,
+            inotify=not args.no_inotify,
+            on_update=print_update,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def parser() -> argparse.ArgumentParser:
+    main_parser = argparse.ArgumentParser(
+        prog="python -m psha_disag_mod",
+        description="Post-processing of the outputs of OpenQuake.",
+    )
+    main_parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="write the time spent in each stage in a JSON file "
+        "(a Chrome trace if it ends with .trace.json)",
+    )
+    commands = main_parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser(
+        "list", aliases=["filter"], help="list the outputs matching patterns"
+    )
+    list_parser.add_argument("export_dir", help="export directory, or its archive")
+    list_parser.add_argument(
+        "--mode", choices=["psha", "disaggregation"], default="psha"
+    )
+    for pattern in ("startname", "type_filename", "type_data", "type_acc"):
+        list_parser.add_argument(f"--{pattern.replace('_', '-')}", nargs="+")
+    list_parser.add_argument("--seed", nargs="+", type=int)
+    list_parser.add_argument(
+        "--axes", nargs="+", help="disaggregation axes, e.g. Mag Dist"
+    )
+    list_parser.add_argument(
+        "--site", nargs="+", type=int, help="sites of the disaggregation files"
+    )
+    list_parser.set_defaults(run=_list)
+
+    ingest_parser = commands.add_parser(
+        "ingest", help="pack an export directory into one archive"
+    )
+    ingest_parser.add_argument("export_dir")
+    ingest_parser.add_argument(
+        "--archive", help="path of the archive, <export_dir>.psha.zip by default"
+    )
+    ingest_parser.add_argument("--job-ini", help="job.ini to store in the archive")
+    ingest_parser.set_defaults(run=_ingest)
+
+    plot_parser = commands.add_parser("plot", help="render the figures of a run")
+    plot_parser.add_argument("kind", choices=["curve", "uhs", "disag"])
+    plot_parser.add_argument("export_dir", help="export directory, or its archive")
+    plot_parser.add_argument("plot_dir")
+    plot_parser.add_argument("--site", type=int, default=0)
+    plot_parser.add_argument("--poes", nargs="+", type=float, help="PoEs of the UHS")
+    plot_parser.add_argument(
+        "--job-ini", help="job.ini the outputs are checked against"
+    )
+    plot_parser.add_argument(
+        "--workers", type=int, default=1, help="rendering processes, 0 for all cores"
+    )
+    plot_parser.add_argument(
+        "--force", action="store_true", help="render the up to date figures too"
+    )
+    plot_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="render while the directory is scanned and the files read",
+    )
+    plot_parser.set_defaults(run=_plot)
+
+    stats_parser = commands.add_parser(
+        "stats", help="UHS of the curves of a site, as CSV"
+    )
+    stats_parser.add_argument("export_dir", help="export directory, or its archive")
+    stats_parser.add_argument("--site", type=int, default=0)
+    stats_parser.add_argument("--seed", nargs="+", type=int)
+    stats_parser.add_argument("--poes", nargs="+", type=float)
+    stats_parser.add_argument("--job-ini", help="job.ini giving the PoEs")
+    stats_parser.add_argument(
+        "--disag",
+        action="store_true",
+        help="modal and mean scenarios of the Mag_Dist disaggregation instead",
+    )
+    stats_parser.add_argument(
+        "--output", help="CSV file, the standard output by default"
+    )
+    stats_parser.set_defaults(run=_stats)
+
+    compare_parser = commands.add_parser(
+        "compare", help="deviations of runs from a reference run, as CSV"
+    )
+    compare_parser.add_argument(
+        "runs",
+        nargs="+",
+        metavar="export_dir[:seed]",
+        help="runs to compare, the first one is the reference by default",
+    )
+    compare_parser.add_argument(
+        "--reference", type=int, default=0, help="index of the reference run"
+    )
+    compare_parser.add_argument(
+        "--type-data", nargs="+", help="kinds of curves compared, e.g. mean"
+    )
+    compare_parser.add_argument("--poes", nargs="+", type=float, help="PoEs of the UHS")
+    compare_parser.add_argument("--job-ini", help="job.ini giving the PoEs")
+    compare_parser.add_argument(
+        "--min-poe",
+        type=float,
+        default=0.0,
+        help="levels where the reference PoE is lower are not compared",
+    )
+    compare_parser.add_argument(
+        "--disag",
+        action="store_true",
+        help="compare the Mag_Dist disaggregations of --site too",
+    )
+    compare_parser.add_argument("--site", type=int, default=0)
+    compare_parser.add_argument(
+        "--output", help="CSV file, the standard output by default"
+    )
+    compare_parser.set_defaults(run=_compare)
+
+    watch_parser = commands.add_parser(
+        "watch", help="render the figures of a run as its files are written"
+    )
+    watch_parser.add_argument("export_dir")
+    watch_parser.add_argument("plot_dir")
+    watch_parser.add_argument("--site", type=int, default=0)
+    watch_parser.add_argument("--poes", nargs="+", type=float, help="PoEs of the UHS")
+    watch_parser.add_argument(
+        "--job-ini", help="job.ini giving the PoEs and the disaggregation IMTs"
+    )
+    watch_parser.add_argument(
+        "--workers", type=int, default=1, help="rendering processes, 0 for all cores"
+    )
+    watch_parser.add_argument(
+        "--poll", type=float, default=1.0, help="seconds between two polls"
+    )
+    watch_parser.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="seconds a polled file keeps its size before it is read",
+    )
+    watch_parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="stop after this many seconds without new files, never by default",
+    )
+    watch_parser.add_argument(
+        "--no-inotify", action="store_true", help="find the new files by polling only"
+    )
+    watch_parser.set_defaults(run=_watch)
+    return main_parser
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    args = parser().parse_args(argv)
+    if getattr(args, "workers", 1) == 0:
+        args.workers = None
+    with profiling(args.profile) if args.profile else nullcontext():
+        args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""Pack a whole export directory of OpenQuake into one indexed, compressed archive.
+
+:func:`ingest_export` reads every output of a run once and writes a single
+zip file:
+
+* ``index.json``: the original filenames, the ``#`` metadata of each file,
+  the ``job.ini`` and the description of every stored array;
+* ``arrays/<name>/<chunk>.npy``: arrays cut in compressed chunks along one
+  axis (the sites for the hazard curves), so that a slice only reads the
+  chunks it overlaps;
+* ``files/<filename>``: the files which are not tables of numbers.
+
+An archive then stands for its export directory: ``load_hazard_curves``,
+``read_disaggregation``, ``FilenameIndex.from_directory`` and the functions
+built on them accept the path of the archive (or of a file inside it, e.g.
+``run.psha.zip/Mag_Dist-0_18.csv``) and read it by key instead of opening
+each CSV file.
+
+From the command line:
+
+    python -m psha_disag_mod ingest <export_dir> --archive <archive> --job-ini <job.ini>
+"""
+
+import io
+import json
+import os
+import zipfile
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from psha_disag_mod.compartiment import (
+    filter_filenames,
+    is_disag_filename,
+    parse_psha_filename,
+)
+from psha_disag_mod.disaggregation import DisaggregationMatrix, read_disaggregation
+from psha_disag_mod.drouet_curves import HazardCurves, stack_hazard_curves
+from psha_disag_mod.metadata_ini import JobConfig, parse_job_ini
+from psha_disag_mod.sites import SiteSelection, SiteTable
+from psha_disag_mod.utils import parse_oq_metadata, timed
+
+ARCHIVE_SUFFIX = ".psha.zip"
+INDEX_MEMBER = "index.json"
+ARCHIVE_VERSION = 1
+# Target size of the chunks of the arrays, before compression
+CHUNK_BYTES = 1 << 22
+# Number of archives kept open, one per (path, modification time)
+OPEN_ARCHIVES = 8
+
+
+def is_archive(path: str) -> bool:
+    """Whether a path is an archive written by :func:`ingest_export`."""
+    return path.endswith(ARCHIVE_SUFFIX) and os.path.isfile(path)
+
+
+def split_archive_path(path: str) -> Optional[Tuple[str, str]]:
+    """(archive, filename) of the path of a file inside an archive, None for other paths."""
+    directory, filename = os.path.split(path)
+    if is_archive(directory):
+        return directory, filename
+    return None
+
+
+def _npy_bytes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+class ArchiveWriter:
+    """Zip file being filled with chunked arrays, raw files and finally the index."""
+
+    def __init__(self, path: str, chunk_bytes: int = CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.zip_file = zipfile.ZipFile(
+            f"{path}.tmp", "w", compression=zipfile.ZIP_DEFLATED
+        )
+        self.index: Dict[str, Any] = {
+            "version": ARCHIVE_VERSION,
+            "filenames": [],
+            "metadata": {},
+            "arrays": {},
+            "curves": {},
+            "tables": {},
+            "disaggregations": {},
+            "files": [],
+            "job_ini": None,
+        }
+
+    def add_array(self, name: str, array: np.ndarray, axis: int = 0) -> str:
+        """Store an array in chunks along ``axis``."""
+        array = np.ascontiguousarray(array)
+        if array.ndim == 0:
+            array = array.reshape(1)
+        row_bytes = max(array.nbytes // max(array.shape[axis], 1), 1)
+        rows = max(self.chunk_bytes // row_bytes, 1)
+        members = []
+        for i, start in enumerate(range(0, max(array.shape[axis], 1), rows)):
+            member = f"arrays/{name}/{i}.npy"
+            chunk = np.take(
+                array, range(start, min(start + rows, array.shape[axis])), axis
+            )
+            self.zip_file.writestr(member, _npy_bytes(chunk))
+            members.append(member)
+        self.index["arrays"][name] = {
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+            "axis": axis,
+            "rows": rows,
+            "members": members,
+        }
+        return name
+
+    def add_file(self, filename: str, content: bytes):
+        """Store a file as it is."""
+        self.zip_file.writestr(f"files/{filename}", content)
+        self.index["files"].append(filename)
+
+    def close(self):
+        """Write the index and move the archive to its path."""
+        self.zip_file.writestr(INDEX_MEMBER, json.dumps(self.index))
+        self.zip_file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def _add_curves(writer: ArchiveWriter, export_dir: str, filenames: List[str]):
+    """Stack the hazard curves of each run (seed) of the export."""
+    curve_files = filter_filenames(filenames, "psha", type_filename=["curve"])
+    for seed in sorted({parse_psha_filename(name).seed for name in curve_files}):
+        selected = filter_filenames(curve_files, "psha", seed=[seed])
+        curves = stack_hazard_curves(
+            [os.path.join(export_dir, filename) for filename in selected]
+        )
+        writer.index["curves"][str(seed)] = {
+            "filenames": selected,
+            "type_datas": curves.type_datas,
+            "imts": curves.imts,
+            "sites": writer.add_array(f"curves-{seed}/sites", curves.sites),
+            "imls": writer.add_array(f"curves-{seed}/imls", curves.imls),
+            "poes": writer.add_array(f"curves-{seed}/poes", curves.poes, axis=2),
+        }
+        writer.index["metadata"].update(curves.metadata)
+
+
+def _add_disaggregation(writer: ArchiveWriter, path: str, filename: str):
+    matrix = read_disaggregation(path)
+    writer.index["disaggregations"][filename] = {
+        "axes": matrix.axes,
+        "imts": matrix.imts,
+        "poes": matrix.poes.tolist(),
+        "bin_edges": {
+            axis: edges if axis == "TRT" else np.asarray(edges).tolist()
+            for axis, edges in matrix.bin_edges.items()
+        },
+        "rlz_ids": [int(rlz) for rlz in matrix.rlz_ids],
+        "weights": matrix.weights.tolist(),
+        "values": writer.add_array(f"disaggregation/{filename}", matrix.values),
+    }
+    writer.index["metadata"][filename] = matrix.metadata
+
+
+def _add_table(writer: ArchiveWriter, path: str, filename: str) -> bool:
+    """Store a CSV of numbers with a ``#`` line (UHS, hazard maps...), False if it is not one."""
+    with open(path) as csv_file:
+        first_line = csv_file.readline()
+        if not first_line.startswith("#"):
+            return False
+        header = csv_file.readline().strip().split(",")
+        try:
+            values = np.loadtxt(csv_file, delimiter=",", ndmin=2)
+        except ValueError:
+            return False
+    writer.index["tables"][filename] = {
+        "columns": header,
+        "values": writer.add_array(f"tables/{filename}", values),
+    }
+    writer.index["metadata"][filename] = parse_oq_metadata(first_line)
+    return True
+
+
+@timed
+def ingest_export(
+    export_dir: str,
+    archive_path: Optional[str] = None,
+    job_ini: Optional[str] = None,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> str:
+    """Pack an export directory of OpenQuake into one archive.
+
+    Args:
+        export_dir: ``export_dir`` of the job, where the CSV files are.
+        archive_path: path of the archive, ``<export_dir>.psha.zip`` if not given.
+        job_ini: configuration of the job, stored in the archive. By default
+            the ``job.ini`` of the parent folder of the export, if any.
+        chunk_bytes: target size of the chunks of the arrays.
+
+    Returns:
+        The path of the archive.
+    """
+    export_dir = os.path.normpath(export_dir)
+    archive_path = archive_path or export_dir + ARCHIVE_SUFFIX
+    if job_ini is None:
+        candidate = os.path.join(os.path.dirname(export_dir), "job.ini")
+        job_ini = candidate if os.path.exists(candidate) else None
+    filenames = sorted(
+        filename
+        for filename in os.listdir(export_dir)
+        if os.path.isfile(os.path.join(export_dir, filename))
+    )
+
+    writer = ArchiveWriter(archive_path, chunk_bytes)
+    writer.index["filenames"] = filenames
+    _add_curves(writer, export_dir, filenames)
+    curve_files = {
+        filename
+        for entry in writer.index["curves"].values()
+        for filename in entry["filenames"]
+    }
+    for filename in filenames:
+        path = os.path.join(export_dir, filename)
+        if filename in curve_files:
+            continue
+        if is_disag_filename(filename):
+            _add_disaggregation(writer, path, filename)
+        elif not (filename.endswith(".csv") and _add_table(writer, path, filename)):
+            with open(path, "rb") as raw_file:
+                writer.add_file(filename, raw_file.read())
+    if job_ini is not None:
+        with open(job_ini) as ini_file:
+            writer.index["job_ini"] = {
+                "path": os.path.abspath(job_ini),
+                "text": ini_file.read(),
+            }
+    writer.close()
+    return archive_path
+
+
+class ChunkedArray:
+    """Array of an archive, read lazily: indexing it only reads the chunks it needs.
+
+    The chunks are cut along :attr:`axis`. ``array[...]`` accepts the usual
+    NumPy indices, and ``np.asarray(array)`` reads it whole.
+    """
+
+    def __init__(self, zip_file: zipfile.ZipFile, entry: Dict[str, Any]):
+        self.zip_file = zip_file
+        self.shape = tuple(entry["shape"])
+        self.dtype = np.dtype(entry["dtype"])
+        self.axis = entry["axis"]
+        self.rows = entry["rows"]
+        self.members = entry["members"]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def _chunk(self, i: int) -> np.ndarray:
+        with self.zip_file.open(self.members[i]) as member:
+            return np.load(io.BytesIO(member.read()), allow_pickle=False)
+
+    def _read_rows(self, rows: np.ndarray) -> np.ndarray:
+        """Values at some indices along the chunked axis, in their order."""
+        chunks = np.unique(rows // self.rows)
+        if len(chunks) == 0:
+            shape = list(self.shape)
+            shape[self.axis] = 0
+            return np.empty(shape, self.dtype)
+        loaded = np.concatenate([self._chunk(i) for i in chunks], axis=self.axis)
+        starts = {chunk: i * self.rows for i, chunk in enumerate(chunks)}
+        local = np.array([starts[row // self.rows] + row % self.rows for row in rows])
+        return np.take(loaded, local, axis=self.axis)
+
+    def __getitem__(self, key) -> np.ndarray:
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i + 1 :]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        rows = np.arange(self.shape[self.axis])[key[self.axis]]
+        values = self._read_rows(np.atleast_1d(rows))
+        if np.ndim(rows) == 0:
+            values = np.take(values, 0, axis=self.axis)
+            return values[key[: self.axis] + key[self.axis + 1 :]]
+        return values[key[: self.axis] + (slice(None),) + key[self.axis + 1 :]]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = self[...]
+        return values if dtype is None else values.astype(dtype)
+
+
+class ExportArchive:
+    """Outputs of a run packed by :func:`ingest_export`, read by key."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.zip_file = zipfile.ZipFile(path)
+        self.index = json.loads(self.zip_file.read(INDEX_MEMBER))
+        if self.index.get("version") != ARCHIVE_VERSION:
+            raise ValueError(f"{path} was written by another version of the archive")
+
+    @property
+    def filenames(self) -> List[str]:
+        """Names of the files of the original export directory."""
+        return self.index["filenames"]
+
+    def metadata(self, filename: str) -> Dict:
+        """``#`` line of an original CSV file."""
+        return self.index["metadata"][filename]
+
+    def array(self, name: str) -> ChunkedArray:
+        """Stored array, read lazily."""
+        return ChunkedArray(self.zip_file, self.index["arrays"][name])
+
+    @timed
+    def hazard_curves(
+        self,
+        filenames: Optional[Sequence[str]] = None,
+        sites: Optional[SiteSelection] = None,
+        **patterns,
+    ) -> HazardCurves:
+        """Hazard curves of the archive, as :func:`~psha_disag_mod.drouet_curves.load_hazard_curves`.
+
+        Args:
+            filenames: original filenames to consider, all of them if None.
+            sites: sites to read, only their chunks are decompressed.
+            patterns: patterns of :func:`~psha_disag_mod.compartiment.filter_filenames`.
+
+        Raises:
+            ValueError: if the selected curves come from several runs.
+        """
+        selected = filter_filenames(
+            self.filenames if filenames is None else filenames,
+            "psha",
+            type_filename=["curve"],
+            **patterns,
+        )
+        seeds = {parse_psha_filename(filename).seed for filename in selected}
+        if len(seeds) > 1:
+            raise ValueError(f"Curves of several runs {sorted(seeds)}, filter one seed")
+        if not seeds:
+            return HazardCurves(
+                [], [], np.empty((0, 3)), np.empty((0, 0)), np.empty((0, 0, 0, 0)), {}
+            )
+        entry = self.index["curves"][str(seeds.pop())]
+
+        params = [parse_psha_filename(filename) for filename in selected]
+        type_datas = list(dict.fromkeys(param.type_data for param in params))
+        imts = [imt for imt in entry["imts"] if imt in {p.type_acc for p in params}]
+        all_sites = np.asarray(self.array(entry["sites"]))
+        if sites is None:
+            i_sites = np.arange(len(all_sites))
+        else:
+            i_sites = SiteTable(all_sites).select(sites)
+        i_datas = [entry["type_datas"].index(type_data) for type_data in type_datas]
+        i_imts = [entry["imts"].index(imt) for imt in imts]
+        poes = self.array(entry["poes"])[:, :, i_sites][np.ix_(i_datas, i_imts)]
+        # the curves stored for the run but not selected by the patterns
+        exported = np.zeros((len(type_datas), len(imts)), dtype=bool)
+        for param in params:
+            exported[type_datas.index(param.type_data), imts.index(param.type_acc)] = (
+                True
+            )
+        poes[~exported] = np.nan
+        imls = np.asarray(self.array(entry["imls"]))[i_imts]
+        n_imls = int((~np.isnan(imls)).sum(axis=1).max(initial=0))
+        return HazardCurves(
+            type_datas=type_datas,
+            imts=imts,
+            sites=all_sites[i_sites],
+            imls=imls[:, :n_imls],
+            poes=poes[..., :n_imls],
+            metadata={filename: self.metadata(filename) for filename in selected},
+        )
+
+    @timed
+    def disaggregation(self, filename: str) -> DisaggregationMatrix:
+        """Disaggregation of an original file, e.g. ``Mag_Dist-0_18.csv``.
+
+        Raises:
+            FileNotFoundError: if the archive has no such disaggregation.
+        """
+        if filename not in self.index["disaggregations"]:
+            raise FileNotFoundError(f"No disaggregation {filename} in {self.path}")
+        entry = self.index["disaggregations"][filename]
+        return DisaggregationMatrix(
+            axes=entry["axes"],
+            imts=entry["imts"],
+            poes=np.array(entry["poes"]),
+            bin_edges={
+                axis: edges if axis == "TRT" else np.array(edges)
+                for axis, edges in entry["bin_edges"].items()
+            },
+            rlz_ids=entry["rlz_ids"],
+            weights=np.array(entry["weights"]),
+            values=np.asarray(self.array(entry["values"])),
+            metadata=self.metadata(filename),
+        )
+
+    def table(self, filename: str) -> Tuple[List[str], np.ndarray]:
+        """Columns and values of an original CSV of numbers (UHS, hazard maps...)."""
+        entry = self.index["tables"][filename]
+        return entry["columns"], np.asarray(self.array(entry["values"]))
+
+    def read_file(self, filename: str) -> bytes:
+        """Content of an original file stored as it is."""
+        return self.zip_file.read(f"files/{filename}")
+
+    def job_config(self) -> Optional[JobConfig]:
+        """Configuration of the job, if the archive has its ``job.ini``."""
+        job_ini = self.index["job_ini"]
+        if job_ini is None:
+            return None
+        return parse_job_ini(job_ini["text"], job_ini["path"])
+
+
+@lru_cache(maxsize=OPEN_ARCHIVES)
+def _open_archive(path: str, mtime_ns: int) -> ExportArchive:
+    return ExportArchive(path)
+
+
+def open_archive(path: str) -> ExportArchive:
+    """Archive of a path, opened once per process as long as it is not rewritten."""
+    path = os.path.abspath(path)
+    return _open_archive(path, os.stat(path).st_mtime_ns)
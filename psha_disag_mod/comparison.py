@@ -0,0 +1,493 @@
+"""Compare the hazard results of several runs: seeds, source models or GMPE sets.
+
+The curves of every run are aligned on the type_datas, IMTs, sites and levels
+of a reference run and stacked in one array of shape
+(run, type_data, IMT, site, IML), so that the deviations of all the runs from
+the reference, at every level or at the PoEs of ``job.ini``, are computed at
+once. Their disaggregations are compared the same way, as distributions of
+the rates over the bins. :func:`comparison_report` sums it all up in one row
+per run, e.g. for a convergence study over the seeds of a job.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from psha_disag_mod.compartiment import FilenameIndex
+from psha_disag_mod.disag_analytics import bin_rates
+from psha_disag_mod.disaggregation import (
+    DisaggregationMatrix,
+    find_disaggregation_file,
+    find_mag_dist_file,
+    read_disaggregation,
+)
+from psha_disag_mod.drouet_curves import (
+    EPSILON,
+    HazardCurves,
+    load_hazard_curves,
+    uniform_hazard_spectra,
+)
+from psha_disag_mod.utils import timed
+
+# Decimals of the longitudes and latitudes matching the sites of two runs
+SITE_DECIMALS = 5
+
+
+class Run(NamedTuple):
+    """Outputs of a run: an export directory, or its archive, and one of its seeds."""
+
+    export_dir: str
+    seed: Optional[int] = None
+    label: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        """The label, or else the name of the directory and the seed."""
+        if self.label:
+            return self.label
+        name = os.path.basename(os.path.normpath(self.export_dir))
+        return name if self.seed is None else f"{name}_{self.seed}"
+
+
+def parse_run(spec: str) -> Run:
+    """Run of ``<export_dir>`` or ``<export_dir>:<seed>``, e.g. ``output:14``."""
+    export_dir, _, seed = spec.rpartition(":")
+    if export_dir and seed.isdigit():
+        return Run(export_dir, int(seed))
+    return Run(spec)
+
+
+@dataclass
+class RunStack:
+    """Hazard curves of several runs, aligned on the curves of a reference run.
+
+    Attributes:
+        runs: names of the runs.
+        type_datas: kinds of curves of the reference run.
+        imts: intensity measure types of the reference run, sorted by period.
+        sites: (lon, lat, depth) of the sites of the reference run, shape (site, 3).
+        imls: levels of the reference run, shape (IMT, IML).
+        poes: probabilities of exceedance, shape (run, type_data, IMT, site,
+            IML), NaN where a run does not have the curve, the site or the
+            level.
+    """
+
+    runs: List[str]
+    type_datas: List[str]
+    imts: List[str]
+    sites: np.ndarray
+    imls: np.ndarray
+    poes: np.ndarray
+
+    def curves(self, run: int) -> HazardCurves:
+        """Aligned curves of one run."""
+        return HazardCurves(
+            self.type_datas, self.imts, self.sites, self.imls, self.poes[run], {}
+        )
+
+
+def _positions(values: Sequence, reference: Sequence) -> np.ndarray:
+    """Index of each reference value among the values, -1 where it is missing."""
+    index = {value: i for i, value in enumerate(values)}
+    return np.array([index.get(value, -1) for value in reference], dtype=int)
+
+
+def _poe_positions(poes: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """Index of each reference PoE among the PoEs, -1 where it is missing."""
+    close = np.isclose(np.asarray(reference)[:, np.newaxis], np.asarray(poes))
+    return np.where(close.any(axis=1), close.argmax(axis=1), -1)
+
+
+def _site_positions(sites: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """Index of each reference site among the sites, matched on (lon, lat)."""
+    if sites.shape == reference.shape and np.allclose(sites[:, :2], reference[:, :2]):
+        return np.arange(len(reference))
+    keys = [tuple(row) for row in np.round(sites[:, :2], SITE_DECIMALS)]
+    reference_keys = [tuple(row) for row in np.round(reference[:, :2], SITE_DECIMALS)]
+    return _positions(keys, reference_keys)
+
+
+def _level_coordinates(levels: np.ndarray, first_positive: float) -> np.ndarray:
+    """Log of the levels, continued linearly below the first positive level.
+
+    As in :func:`~psha_disag_mod.drouet_curves.uniform_hazard_spectra`, the
+    first bin of a curve starting at a zero level is linear in the level.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(
+            levels >= first_positive,
+            np.log(levels),
+            np.log(first_positive) - 1 + levels / first_positive,
+        )
+
+
+def interpolate_levels(
+    levels: np.ndarray, poes: np.ndarray, targets: np.ndarray
+) -> np.ndarray:
+    """PoEs of curves at other levels, linear between the logs of the levels and of the PoEs.
+
+    Between a zero level and the first positive level, the log of the PoE
+    is linear in the level instead, and the PoE at a zero target is the one
+    of the zero level.
+
+    Args:
+        levels: levels of the curves, NaN padded, shape (IML,).
+        poes: PoEs of the curves, shape (..., IML).
+        targets: levels to interpolate at, NaN padded.
+
+    Returns:
+        The PoEs at the ``targets``, NaN outside of the ``levels``.
+    """
+    valid = ~np.isnan(levels)
+    levels, poes = levels[valid], poes[..., valid]
+    targets = np.asarray(targets, dtype=float)
+    positive = levels[levels > 0]
+    if len(levels) < 2 or len(positive) == 0:
+        return np.full(poes.shape[:-1] + targets.shape, np.nan)
+    coordinates = _level_coordinates(levels, positive[0])
+    target_coordinates = _level_coordinates(targets, positive[0])
+    with np.errstate(invalid="ignore"):
+        upper = np.clip(
+            np.searchsorted(coordinates, target_coordinates), 1, len(levels) - 1
+        )
+        lower = upper - 1
+        fraction = (target_coordinates - coordinates[lower]) / (
+            coordinates[upper] - coordinates[lower]
+        )
+    log_poes = np.log(np.maximum(poes, EPSILON))
+    interpolated = np.exp(
+        log_poes[..., lower] + fraction * (log_poes[..., upper] - log_poes[..., lower])
+    )
+    # Zero PoEs, up to the rounding of the logarithms
+    interpolated = np.where(interpolated < 2 * EPSILON, 0.0, interpolated)
+    if levels[0] == 0:
+        interpolated[..., targets == 0] = poes[..., :1]
+    with np.errstate(invalid="ignore"):
+        outside = ~(
+            (target_coordinates >= coordinates[0] - 1e-9)
+            & (target_coordinates <= coordinates[-1] + 1e-9)
+        )
+    interpolated[..., outside] = np.nan
+    return interpolated
+
+
+def align_curves(curves: HazardCurves, reference: HazardCurves) -> np.ndarray:
+    """PoEs of curves on the type_datas, IMTs, sites and levels of reference curves.
+
+    Returns:
+        Array of the shape of ``reference.poes``, NaN where the curves do not
+        have a curve, a site or a level of the reference.
+    """
+    i_datas = _positions(curves.type_datas, reference.type_datas)
+    i_imts = _positions(curves.imts, reference.imts)
+    i_sites = _site_positions(curves.sites, reference.sites)
+    aligned = np.full(reference.poes.shape, np.nan)
+    datas, sites = np.flatnonzero(i_datas >= 0), np.flatnonzero(i_sites >= 0)
+    for i_imt in np.flatnonzero(i_imts >= 0):
+        j_imt = i_imts[i_imt]
+        poes = curves.poes[np.ix_(i_datas[datas], [j_imt], i_sites[sites])][:, 0]
+        levels, targets = curves.imls[j_imt], reference.imls[i_imt]
+        if levels.shape == targets.shape and np.allclose(
+            levels, targets, equal_nan=True
+        ):
+            aligned[np.ix_(datas, [i_imt], sites)] = poes[:, np.newaxis]
+        else:
+            aligned[np.ix_(datas, [i_imt], sites)] = interpolate_levels(
+                levels, poes, targets
+            )[:, np.newaxis]
+    return aligned
+
+
+@timed
+def stack_runs(
+    runs: Sequence[Run], reference: int = 0, use_cache: bool = True, **patterns
+) -> RunStack:
+    """Load the hazard curves of runs, aligned on the ones of a reference run.
+
+    Each run is loaded by :func:`~psha_disag_mod.drouet_curves.load_hazard_curves`
+    (cached and memory-mapped), its seed and the ``patterns`` selecting the
+    files, and every export directory is listed once whatever its number
+    of runs.
+
+    Args:
+        reference: index of the run the others are aligned on.
+        patterns: patterns of the curves, e.g. ``type_data=["mean"]``.
+    """
+    indices: Dict[str, FilenameIndex] = {}
+    loaded = []
+    for run in runs:
+        if run.export_dir not in indices:
+            indices[run.export_dir] = FilenameIndex.from_directory(run.export_dir)
+        run_patterns = dict(patterns)
+        if run.seed is not None:
+            run_patterns["seed"] = [run.seed]
+        loaded.append(
+            load_hazard_curves(
+                run.export_dir,
+                indices[run.export_dir],
+                use_cache=use_cache,
+                **run_patterns,
+            )
+        )
+    base = loaded[reference]
+    poes = np.full((len(runs),) + base.poes.shape, np.nan)
+    for i, curves in enumerate(loaded):
+        poes[i] = base.poes if i == reference else align_curves(curves, base)
+    return RunStack(
+        runs=[run.name for run in runs],
+        type_datas=list(base.type_datas),
+        imts=list(base.imts),
+        sites=np.asarray(base.sites),
+        imls=np.asarray(base.imls),
+        poes=poes,
+    )
+
+
+def _count(values: np.ndarray) -> np.ndarray:
+    return (~np.isnan(values)).sum(axis=-1)
+
+
+def _mean(values: np.ndarray) -> np.ndarray:
+    """Mean over the last axis ignoring NaN, NaN where there is nothing."""
+    counts = _count(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, np.nansum(values, axis=-1) / counts, np.nan)
+
+
+@timed
+def curve_deviations(
+    stack: RunStack, reference: int = 0, min_poe: float = 0.0
+) -> Dict[str, np.ndarray]:
+    """Ratio and log-difference of the PoEs of every run to the ones of the reference.
+
+    The levels where either PoE is zero, or where the PoE of the reference
+    is below ``min_poe`` (where the curves of a Monte Carlo sampling are
+    noisy), are left out.
+
+    Returns:
+        Arrays of shape (run, type_data, IMT, site): ``min_ratio`` and
+        ``max_ratio`` of the PoEs, ``mean_log_diff`` and ``max_abs_log_diff``
+        of their base 10 logarithms, NaN where no level is compared.
+    """
+    base = stack.poes[reference]
+    compared = (stack.poes > 0) & (base > 0) & (base >= min_poe)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratios = np.where(compared, stack.poes / base, np.nan)
+    log_diffs = np.log10(ratios)
+    return {
+        "min_ratio": np.fmin.reduce(ratios, axis=-1),
+        "max_ratio": np.fmax.reduce(ratios, axis=-1),
+        "mean_log_diff": _mean(log_diffs),
+        "max_abs_log_diff": np.fmax.reduce(np.abs(log_diffs), axis=-1),
+    }
+
+
+@timed
+def spectra_deviations(
+    stack: RunStack, poes: Sequence[float], reference: int = 0
+) -> np.ndarray:
+    """Relative deviations of the UHS of every run from the ones of the reference.
+
+    The spectra of all the runs are interpolated in one call of
+    :func:`~psha_disag_mod.drouet_curves.uniform_hazard_spectra`.
+
+    Args:
+        poes: PoEs of the spectra, e.g. the ``poes`` of ``job.ini``.
+
+    Returns:
+        ``acceleration / reference acceleration - 1``, shape
+        (run, type_data, site, poe, IMT), NaN where a spectrum is missing
+        or the reference acceleration is zero.
+    """
+    n_runs, n_datas = stack.poes.shape[:2]
+    curves = HazardCurves(
+        type_datas=[f"{run}:{data}" for run in stack.runs for data in stack.type_datas],
+        imts=stack.imts,
+        sites=stack.sites,
+        imls=stack.imls,
+        poes=stack.poes.reshape((n_runs * n_datas,) + stack.poes.shape[2:]),
+        metadata={},
+    )
+    spectra = uniform_hazard_spectra(curves, poes)
+    spectra = spectra.reshape((n_runs, n_datas) + spectra.shape[1:])
+    base = spectra[reference]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(base > 0, spectra / base - 1, np.nan)
+
+
+def _weighted_rates(matrix: DisaggregationMatrix) -> np.ndarray:
+    """Rates of the bins averaged over the realizations, shape (imt, poe, bin)."""
+    rates = np.average(bin_rates(matrix), axis=-1, weights=matrix.weights)
+    return rates.reshape(rates.shape[:2] + (-1,))
+
+
+def _check_bins(matrix: DisaggregationMatrix, reference: DisaggregationMatrix):
+    if matrix.axes != reference.axes:
+        raise ValueError(f"Axes {matrix.axes} differ from {reference.axes}")
+    for axis in reference.axes:
+        edges, reference_edges = matrix.bin_edges[axis], reference.bin_edges[axis]
+        if axis == "TRT":
+            same = list(edges) == list(reference_edges)
+        else:
+            same = len(edges) == len(reference_edges) and np.allclose(
+                edges, reference_edges
+            )
+        if not same:
+            raise ValueError(f"The {axis} bins differ from the ones of the reference")
+
+
+@timed
+def disaggregation_distances(
+    matrices: Sequence[DisaggregationMatrix], reference: int = 0
+) -> Dict[str, np.ndarray]:
+    """Distances of the disaggregations of runs to the one of a reference run.
+
+    The rates of the bins, averaged over the realizations with their
+    weights, are normalized into a distribution over the bins for each IMT
+    and PoE of the reference. The IMTs and PoEs missing from a run are NaN.
+
+    Returns:
+        Arrays of shape (run, imt, poe): ``total_variation`` (half the sum of
+        the absolute differences of the distributions, 0 when equal, 1 when
+        disjoint), ``hellinger`` distance and ``rate_ratio`` of the total
+        disaggregated rates.
+
+    Raises:
+        ValueError: if the axes or the bins of the matrices differ.
+    """
+    base = matrices[reference]
+    shape = (len(matrices), len(base.imts), len(base.poes))
+    rates = np.full(shape + (int(np.prod(base.values.shape[2:-1])),), np.nan)
+    for i, matrix in enumerate(matrices):
+        _check_bins(matrix, base)
+        i_imts = _positions(matrix.imts, base.imts)
+        i_poes = _poe_positions(matrix.poes, base.poes)
+        imts, poes = np.flatnonzero(i_imts >= 0), np.flatnonzero(i_poes >= 0)
+        rates[np.ix_([i], imts, poes)] = _weighted_rates(matrix)[
+            np.ix_(i_imts[imts], i_poes[poes])
+        ]
+    totals = rates.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        distributions = rates / totals[..., np.newaxis]
+        rate_ratio = totals / totals[reference]
+    base_distribution = distributions[reference]
+    return {
+        "total_variation": 0.5 * np.abs(distributions - base_distribution).sum(-1),
+        "hellinger": np.sqrt(
+            0.5 * ((np.sqrt(distributions) - np.sqrt(base_distribution)) ** 2).sum(-1)
+        ),
+        "rate_ratio": rate_ratio,
+    }
+
+
+@timed
+def load_disaggregations(
+    runs: Sequence[Run], site: int = 0, axes: Optional[Sequence[str]] = None
+) -> List[DisaggregationMatrix]:
+    """Disaggregation of a site for every run, cached and memory-mapped.
+
+    Args:
+        axes: axes of the files, the Magnitude-Distance disaggregation if
+            None (see :func:`~psha_disag_mod.disaggregation.find_mag_dist_file`).
+
+    Raises:
+        FileNotFoundError: if a run has no such disaggregation.
+    """
+    indices: Dict[str, FilenameIndex] = {}
+    matrices = []
+    for run in runs:
+        if run.export_dir not in indices:
+            indices[run.export_dir] = FilenameIndex.from_directory(run.export_dir)
+        seed = None if run.seed is None else [run.seed]
+        if axes is None:
+            path = find_mag_dist_file(
+                run.export_dir, site, indices[run.export_dir], seed
+            )
+            if path is None:
+                raise FileNotFoundError(
+                    f"No Mag_Dist disaggregation of site {site} in {run.name}"
+                )
+        else:
+            path = find_disaggregation_file(
+                run.export_dir, axes, site, indices[run.export_dir], seed
+            )
+        matrices.append(read_disaggregation(path, use_cache=True))
+    return matrices
+
+
+def _argmax_location(stack: RunStack, deviations: np.ndarray) -> List[tuple]:
+    """(type_data, IMT, site) of the largest deviation of each run, empty if none."""
+    locations = []
+    for run_deviations in deviations:
+        if np.isnan(run_deviations).all():
+            locations.append(("", "", -1))
+            continue
+        i_data, i_imt, site = np.unravel_index(
+            np.nanargmax(run_deviations), run_deviations.shape
+        )
+        locations.append((stack.type_datas[i_data], stack.imts[i_imt], int(site)))
+    return locations
+
+
+@timed
+def comparison_report(
+    stack: RunStack,
+    poes: Optional[Sequence[float]] = None,
+    matrices: Optional[Sequence[DisaggregationMatrix]] = None,
+    reference: int = 0,
+    min_poe: float = 0.0,
+) -> Dict[str, np.ndarray]:
+    """Deviations of every run from the reference run, one row per run.
+
+    Args:
+        poes: PoEs of the UHS compared, e.g. the ``poes`` of ``job.ini``.
+        matrices: disaggregations of the runs (see :func:`load_disaggregations`).
+        min_poe: see :func:`curve_deviations`.
+
+    Returns:
+        Columns of equal length (see
+        :func:`~psha_disag_mod.disag_analytics.write_table`): ``run``, number
+        of ``curves`` compared, ``max_abs_log_diff`` and ``mean_abs_log_diff``
+        of the PoEs, ``min_ratio`` and ``max_ratio``, and the
+        ``worst_type_data``, ``worst_imt`` and ``worst_site`` of the largest
+        log-difference. With ``poes``, ``max_uhs_deviation`` is the largest
+        relative deviation of the UHS, and with ``matrices``,
+        ``max_total_variation`` and ``max_hellinger`` the largest distances of
+        the disaggregations.
+    """
+    deviations = curve_deviations(stack, reference, min_poe)
+    max_abs = deviations["max_abs_log_diff"]
+    n_runs = len(stack.runs)
+    flat = max_abs.reshape(n_runs, -1)
+    base = stack.poes[reference]
+    compared = (stack.poes > 0) & (base > 0) & (base >= min_poe)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        abs_log_diffs = np.where(compared, np.abs(np.log10(stack.poes / base)), np.nan)
+    locations = _argmax_location(stack, max_abs)
+    report = {
+        "run": np.array(stack.runs, dtype=str),
+        "curves": _count(flat),
+        "max_abs_log_diff": np.fmax.reduce(flat, axis=-1),
+        "mean_abs_log_diff": _mean(abs_log_diffs.reshape(n_runs, -1)),
+        "min_ratio": np.fmin.reduce(
+            deviations["min_ratio"].reshape(n_runs, -1), axis=-1
+        ),
+        "max_ratio": np.fmax.reduce(
+            deviations["max_ratio"].reshape(n_runs, -1), axis=-1
+        ),
+        "worst_type_data": np.array([data for data, _, _ in locations], dtype=str),
+        "worst_imt": np.array([imt for _, imt, _ in locations], dtype=str),
+        "worst_site": np.array([site for _, _, site in locations], dtype=int),
+    }
+    if poes is not None and len(poes):
+        uhs = np.abs(spectra_deviations(stack, poes, reference))
+        report["max_uhs_deviation"] = np.fmax.reduce(uhs.reshape(n_runs, -1), axis=-1)
+    if matrices is not None:
+        distances = disaggregation_distances(matrices, reference)
+        for name in ("total_variation", "hellinger"):
+            report[f"max_{name}"] = np.fmax.reduce(
+                distances[name].reshape(n_runs, -1), axis=-1
+            )
+    return report
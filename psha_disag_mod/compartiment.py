@@ -0,0 +1,401 @@
+"""Sort the files exported by OpenQuake according to the patterns of their names.
+
+PSHA outputs are named ``<startname>_<type_filename>-<type_data>[-<type_acc>]_<seed>.csv``
+(e.g. ``hazard_curve-rlz-001-SA(0.1)_14.csv``, ``quantile_uhs-0.95_42.csv``) and
+disaggregation outputs ``<axes>-<site>_<seed>.csv`` (e.g. ``Mag_Dist_Eps-0_14.csv``).
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Union
+
+from psha_disag_mod.utils import timed, timer
+
+CALCULATION_MODES = ("psha", "disaggregation")
+PSHA_STARTNAMES = ("hazard", "quantile")
+PSHA_TYPE_FILENAMES = ("curve", "uhs", "map")
+PSHA_PATTERNS = ("startname", "type_filename", "type_data", "type_acc", "seed")
+DISAG_AXES = ("Mag", "Dist", "Lon", "Lat", "Eps", "TRT")
+
+# Outputs gathering every intensity measure type in one file
+WITHOUT_TYPE_ACC = ("uhs", "map")
+
+# Number of filenames whose parameters are kept by read_psha_params
+PSHA_PARAMS_CACHE_SIZE = 2**16
+
+_PSHA_FILENAME = re.compile(
+    r"(?P<startname>[^_]+)_(?P<type_filename>[^-]+)-(?P<types>.+)_(?P<seed>\d+)"
+)
+_TYPE_ACC = re.compile(r"(?P<type_data>.+)-(?P<type_acc>[^-]+)")
+
+# Whole grammar of the known PSHA outputs, for the bulk parsing of listings
+_PSHA_GRAMMAR = re.compile(
+    r"(?:.*[/\\])?"
+    rf"({'|'.join(PSHA_STARTNAMES)})_"
+    rf"(?:({'|'.join(WITHOUT_TYPE_ACC)})-(.+)"
+    rf"|({'|'.join(t for t in PSHA_TYPE_FILENAMES if t not in WITHOUT_TYPE_ACC)})"
+    r"-(.+)-([^-]+))"
+    r"_(\d+)(?:\.\w+)?"
+)
+_DISAG_FILENAME = re.compile(r"(?P<axes>.+)-(?P<site>\d+)_(?P<seed>\d+)")
+
+PshaParams = Dict[str, Union[str, int, None]]
+Pattern = Union[str, int]
+
+
+class PshaFileParams(NamedTuple):
+    """Parameters encoded in the name of a PSHA output of OpenQuake."""
+
+    startname: str
+    type_filename: str
+    type_data: str
+    type_acc: Optional[str]
+    seed: int
+
+
+def _stem(filename: str) -> str:
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+@lru_cache(maxsize=PSHA_PARAMS_CACHE_SIZE)
+def parse_psha_filename(filename: str) -> PshaFileParams:
+    """Parse the name of a PSHA output of OpenQuake, with a bounded cache.
+
+    Raises:
+        ValueError: if the name does not follow the naming of PSHA outputs.
+    """
+    match = _PSHA_FILENAME.fullmatch(_stem(filename))
+    if match is None:
+        raise ValueError(f"{filename!r} is not named like a PSHA output")
+    type_filename = match["type_filename"]
+    type_data, type_acc = match["types"], None
+    if type_filename not in WITHOUT_TYPE_ACC:
+        types = _TYPE_ACC.fullmatch(type_data)
+        if types is None:
+            raise ValueError(f"{filename!r} does not give an acceleration type")
+        type_data, type_acc = types["type_data"], types["type_acc"]
+    return PshaFileParams(
+        match["startname"], type_filename, type_data, type_acc, int(match["seed"])
+    )
+
+
+def read_psha_params(filename: str) -> PshaParams:
+    """Read the parameters encoded in the name of a PSHA output of OpenQuake.
+
+    Args:
+        filename: name (or path) of the file, e.g. ``hazard_curve-mean-PGA_14.csv``.
+
+    Returns:
+        The ``startname``, ``type_filename``, ``type_data``, ``type_acc``
+        (None for uhs and maps) and ``seed`` of the file.
+    """
+    return parse_psha_filename(filename)._asdict()
+
+
+@timed
+def read_psha_params_many(filenames: Iterable[str]) -> List[Optional[PshaFileParams]]:
+    """Parse the names of many files at once, e.g. the listing of an export directory.
+
+    Returns:
+        One :class:`PshaFileParams` per filename, or None for the files which
+        are not PSHA outputs (see :func:`is_psha_filename`).
+    """
+    grammar = _PSHA_GRAMMAR.fullmatch
+    parsed: Dict[str, Optional[PshaFileParams]] = {}
+    records: List[Optional[PshaFileParams]] = []
+    for filename in filenames:
+        if filename in parsed:
+            records.append(parsed[filename])
+            continue
+        match = grammar(filename)
+        record = None
+        if match is not None:
+            startname, filename_all, data_all, type_filename, data, acc, seed = (
+                match.groups()
+            )
+            if filename_all is None:
+                record = PshaFileParams(startname, type_filename, data, acc, int(seed))
+            else:
+                record = PshaFileParams(
+                    startname, filename_all, data_all, None, int(seed)
+                )
+        parsed[filename] = record
+        records.append(record)
+    return records
+
+
+def read_disag_params(filename: str) -> Dict[str, Union[List[str], int]]:
+    """Read the parameters encoded in the name of a disaggregation output of OpenQuake.
+
+    Args:
+        filename: name (or path) of the file, e.g. ``Mag_Dist_Eps-0_14.csv``.
+
+    Returns:
+        The ``disaggregation_axes`` (e.g. ``["Mag", "Dist", "Eps"]``), the
+        ``site`` index and the ``seed`` of the file.
+    """
+    match = _DISAG_FILENAME.fullmatch(_stem(filename))
+    if match is None:
+        raise ValueError(f"{filename!r} is not named like a disaggregation output")
+    return {
+        "disaggregation_axes": match["axes"].split("_"),
+        "site": int(match["site"]),
+        "seed": int(match["seed"]),
+    }
+
+
+def is_psha_filename(filename: str) -> bool:
+    """Whether the file is a PSHA output (hazard curve, uhs, map or quantile)."""
+    try:
+        params = parse_psha_filename(filename)
+    except ValueError:
+        return False
+    return (
+        params.startname in PSHA_STARTNAMES
+        and params.type_filename in PSHA_TYPE_FILENAMES
+    )
+
+
+def is_disag_filename(filename: str) -> bool:
+    """Whether the file is a disaggregation output (e.g. ``Mag_Dist-0_14.csv``)."""
+    try:
+        params = read_disag_params(filename)
+    except ValueError:
+        return False
+    return all(axis in DISAG_AXES for axis in params["disaggregation_axes"])
+
+
+def match_pattern(value: Optional[Pattern], patterns: Sequence[Pattern]) -> bool:
+    """Whether a parameter of a filename is selected by one of the patterns.
+
+    A pattern selects the values equal to it; a pattern ending with ``-``
+    (e.g. ``rlz-``) selects every value starting with it.
+    """
+    if value is None:
+        return False
+    if isinstance(value, int):
+        return any(int(pattern) == value for pattern in patterns)
+    for pattern in patterns:
+        pattern = str(pattern)
+        if value == pattern or (pattern.endswith("-") and value.startswith(pattern)):
+            return True
+    return False
+
+
+def _check_patterns(
+    calculation_mode: str, psha_patterns: Dict, disaggregation_patterns, sites=None
+):
+    if calculation_mode not in CALCULATION_MODES:
+        raise ValueError(
+            f"Unknown calculation mode {calculation_mode!r}, "
+            f"expected one of {CALCULATION_MODES}"
+        )
+    if calculation_mode == "psha" and disaggregation_patterns is not None:
+        raise ValueError("disaggregation_patterns only apply to disaggregation files")
+    if calculation_mode == "psha" and sites is not None:
+        raise ValueError(
+            "sites only apply to disaggregation files, psha files hold every site"
+        )
+    if calculation_mode == "disaggregation":
+        unexpected = [
+            key
+            for key, patterns in psha_patterns.items()
+            if key != "seed" and patterns is not None
+        ]
+        if unexpected:
+            raise ValueError(f"{unexpected} only apply to psha files")
+
+
+@timed
+def filter_filenames(
+    filenames: Union[Sequence[str], "FilenameIndex"],
+    calculation_mode: str = "psha",
+    startname: Optional[Sequence[str]] = None,
+    type_filename: Optional[Sequence[str]] = None,
+    type_data: Optional[Sequence[str]] = None,
+    type_acc: Optional[Sequence[str]] = None,
+    seed: Optional[Sequence[int]] = None,
+    disaggregation_patterns: Optional[Sequence[str]] = None,
+    sites: Optional[Sequence[int]] = None,
+) -> List[str]:
+    """Keep the OpenQuake outputs of a calculation mode matching the given patterns.
+
+    Each PSHA pattern is a list of accepted values for the corresponding
+    parameter of :func:`read_psha_params` (see :func:`match_pattern`), and a
+    disaggregation file is kept when all its ``disaggregation_patterns`` are
+    axes of the file. Patterns left to None do not filter anything.
+
+    Args:
+        filenames: names of the files, or a :class:`FilenameIndex` built on them.
+        calculation_mode: "psha" or "disaggregation".
+        sites: indices of the sites of the disaggregation files to keep, e.g.
+            from a query of a :class:`~psha_disag_mod.sites.SiteTable`.
+
+    Returns:
+        The matching filenames, in their original order.
+    """
+    if isinstance(filenames, FilenameIndex):
+        return filenames.filter_filenames(
+            calculation_mode,
+            startname=startname,
+            type_filename=type_filename,
+            type_data=type_data,
+            type_acc=type_acc,
+            seed=seed,
+            disaggregation_patterns=disaggregation_patterns,
+            sites=sites,
+        )
+
+    psha_patterns = {
+        "startname": startname,
+        "type_filename": type_filename,
+        "type_data": type_data,
+        "type_acc": type_acc,
+        "seed": seed,
+    }
+    _check_patterns(calculation_mode, psha_patterns, disaggregation_patterns, sites)
+    if sites is not None:
+        sites = {int(site) for site in sites}
+
+    filtered = []
+    for filename in filenames:
+        if calculation_mode == "psha":
+            if not is_psha_filename(filename):
+                continue
+            params = parse_psha_filename(filename)
+            if all(
+                match_pattern(getattr(params, key), patterns)
+                for key, patterns in psha_patterns.items()
+                if patterns is not None
+            ):
+                filtered.append(filename)
+        else:
+            if not is_disag_filename(filename):
+                continue
+            params = read_disag_params(filename)
+            if seed is not None and not match_pattern(params["seed"], seed):
+                continue
+            if sites is not None and params["site"] not in sites:
+                continue
+            if disaggregation_patterns is None or all(
+                pattern in params["disaggregation_axes"]
+                for pattern in disaggregation_patterns
+            ):
+                filtered.append(filename)
+    return filtered
+
+
+class FilenameIndex:
+    """Names of the files of an OpenQuake export, parsed once and indexed per parameter.
+
+    Each filename is parsed a single time into columnar fields, and every field
+    gets an inverted index from its values to the rows holding them, so that
+    :meth:`filter_filenames` only intersects sets of rows. Filtering an index
+    gives the same result as :func:`filter_filenames` on the list of names.
+    """
+
+    @timed
+    def __init__(self, filenames: Iterable[str]):
+        self.filenames = list(filenames)
+        self.fields: Dict[str, List] = {
+            key: [None] * len(self.filenames)
+            for key in PSHA_PATTERNS + ("disaggregation_axes", "site")
+        }
+        self.psha_rows: Set[int] = set()
+        self.disag_rows: Set[int] = set()
+        self._inverted: Dict[str, Dict] = {
+            key: {} for key in PSHA_PATTERNS + ("disaggregation_axes", "site")
+        }
+
+        psha_records = read_psha_params_many(self.filenames)
+        for row, (filename, record) in enumerate(zip(self.filenames, psha_records)):
+            if record is not None:
+                self.psha_rows.add(row)
+                for key, value in zip(PSHA_PATTERNS, record):
+                    self.fields[key][row] = value
+                    if value is not None:
+                        self._inverted[key].setdefault(value, set()).add(row)
+            elif is_disag_filename(filename):
+                self.disag_rows.add(row)
+                params = read_disag_params(filename)
+                for key, value in params.items():
+                    self.fields[key][row] = value
+                self._inverted["seed"].setdefault(params["seed"], set()).add(row)
+                self._inverted["site"].setdefault(params["site"], set()).add(row)
+                for axis in params["disaggregation_axes"]:
+                    self._inverted["disaggregation_axes"].setdefault(axis, set()).add(
+                        row
+                    )
+
+    @classmethod
+    def from_directory(cls, directory: str) -> "FilenameIndex":
+        """Index the files of an export directory, sorted by name.
+
+        The directory may also be an archive of it (see
+        :func:`~psha_disag_mod.archive.ingest_export`).
+        """
+        from psha_disag_mod.archive import is_archive, open_archive
+
+        if is_archive(directory):
+            return cls(open_archive(directory).filenames)
+        with timer("compartiment.list_directory"):
+            filenames = sorted(os.listdir(directory))
+        return cls(filenames)
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def _rows_matching(self, key: str, patterns: Sequence[Pattern]) -> Set[int]:
+        """Rows whose ``key`` parameter is selected by one of the patterns."""
+        inverted = self._inverted[key]
+        rows: Set[int] = set()
+        for pattern in patterns:
+            if key == "seed":
+                rows |= inverted.get(int(pattern), set())
+            elif str(pattern).endswith("-"):
+                for value, value_rows in inverted.items():
+                    if value.startswith(str(pattern)):
+                        rows |= value_rows
+            else:
+                rows |= inverted.get(str(pattern), set())
+        return rows
+
+    def filter_filenames(
+        self,
+        calculation_mode: str = "psha",
+        startname: Optional[Sequence[str]] = None,
+        type_filename: Optional[Sequence[str]] = None,
+        type_data: Optional[Sequence[str]] = None,
+        type_acc: Optional[Sequence[str]] = None,
+        seed: Optional[Sequence[int]] = None,
+        disaggregation_patterns: Optional[Sequence[str]] = None,
+        sites: Optional[Sequence[int]] = None,
+    ) -> List[str]:
+        """Same as :func:`filter_filenames` on the indexed filenames."""
+        psha_patterns = {
+            "startname": startname,
+            "type_filename": type_filename,
+            "type_data": type_data,
+            "type_acc": type_acc,
+            "seed": seed,
+        }
+        _check_patterns(calculation_mode, psha_patterns, disaggregation_patterns, sites)
+
+        if calculation_mode == "psha":
+            rows = self.psha_rows
+            for key, patterns in psha_patterns.items():
+                if patterns is not None:
+                    rows = rows & self._rows_matching(key, patterns)
+        else:
+            rows = self.disag_rows
+            if seed is not None:
+                rows = rows & self._rows_matching("seed", seed)
+            for axis in disaggregation_patterns or ():
+                rows = rows & self._inverted["disaggregation_axes"].get(axis, set())
+            if sites is not None:
+                site_rows: Set[int] = set()
+                for site in sites:
+                    site_rows |= self._inverted["site"].get(int(site), set())
+                rows = rows & site_rows
+        return [self.filenames[row] for row in sorted(rows)]
@@ -0,0 +1,176 @@
+"""Marginals and modal/mean scenarios of the disaggregation matrices.
+
+OpenQuake gives each bin of a disaggregation the probability of exceedance
+of its ruptures only. The bins are independent contributions, so they add
+up in rate space, ``rate = -ln(1 - poe) / investigation_time``, where the
+marginals are sums and the means are weighted by the rates. Every function
+works on the whole (imt, poe, bins..., rlz) array at once.
+"""
+
+from typing import Dict, Sequence, TextIO, Union
+
+import numpy as np
+
+from psha_disag_mod.disaggregation import DisaggregationMatrix
+from psha_disag_mod.utils import return_period, timed
+
+
+def poe_to_rate(poes: np.ndarray, investigation_time: float = 1.0) -> np.ndarray:
+    """Annual rates of exceedance of probabilities of exceedance over the investigation time."""
+    with np.errstate(divide="ignore"):
+        return -np.log1p(-np.asarray(poes, dtype=float)) / investigation_time
+
+
+def rate_to_poe(rates: np.ndarray, investigation_time: float = 1.0) -> np.ndarray:
+    """Probabilities of exceedance over the investigation time of annual rates."""
+    return -np.expm1(-np.asarray(rates, dtype=float) * investigation_time)
+
+
+def _investigation_time(matrix: DisaggregationMatrix) -> float:
+    return float(matrix.metadata.get("investigation_time", 1.0))
+
+
+def bin_rates(matrix: DisaggregationMatrix) -> np.ndarray:
+    """Rates of exceedance of each bin, shape (imt, poe, bins..., rlz)."""
+    return poe_to_rate(matrix.values, _investigation_time(matrix))
+
+
+def marginal_rates(matrix: DisaggregationMatrix, axes: Sequence[str]) -> np.ndarray:
+    """Rates of the bins of some axes, summed over the others.
+
+    Returns:
+        Array of shape (imt, poe, bins of ``axes`` in their given order..., rlz),
+        e.g. (imt, poe, mag, dist, rlz) for ``["Mag", "Dist"]``.
+    """
+    missing = [axis for axis in axes if axis not in matrix.axes]
+    if missing:
+        raise ValueError(f"No {', '.join(missing)} axis in {matrix.axes}")
+    others = tuple(2 + i for i, axis in enumerate(matrix.axes) if axis not in axes)
+    rates = bin_rates(matrix).sum(axis=others)
+    kept = [axis for axis in matrix.axes if axis in axes]
+    order = [kept.index(axis) for axis in axes]
+    return np.moveaxis(rates, [2 + i for i in order], range(2, 2 + len(axes)))
+
+
+def marginal_poes(matrix: DisaggregationMatrix, axes: Sequence[str]) -> np.ndarray:
+    """Probabilities of exceedance of the bins of some axes, see :func:`marginal_rates`."""
+    return rate_to_poe(marginal_rates(matrix, axes), _investigation_time(matrix))
+
+
+def _by_rlz(rates: np.ndarray) -> np.ndarray:
+    """Rates with the realizations before the bins, shape (imt, poe, rlz, bins...)."""
+    return np.moveaxis(rates, -1, 2)
+
+
+def _modal_bins(axes: Sequence[str], rates: np.ndarray) -> Dict[str, np.ndarray]:
+    leading, bins = rates.shape[:3], rates.shape[3:]
+    flat = rates.reshape(leading + (-1,)).argmax(axis=-1)
+    return dict(zip(axes, np.unravel_index(flat, bins)))
+
+
+def modal_bins(matrix: DisaggregationMatrix) -> Dict[str, np.ndarray]:
+    """Bin of the largest contribution of every IMT, PoE and realization.
+
+    The mode is taken over the joint bins of all the axes, as the scenario
+    dominating the hazard.
+
+    Returns:
+        The index of the modal bin on each axis, shape (imt, poe, rlz).
+    """
+    return _modal_bins(matrix.axes, _by_rlz(bin_rates(matrix)))
+
+
+def _mean_values(
+    matrix: DisaggregationMatrix, rates: np.ndarray, totals: np.ndarray
+) -> Dict[str, np.ndarray]:
+    means = {}
+    for i, axis in enumerate(matrix.axes):
+        if axis == "TRT":
+            continue
+        others = tuple(3 + j for j in range(len(matrix.axes)) if j != i)
+        weighted = rates.sum(axis=others) @ matrix.bin_centers(axis)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means[axis] = np.where(totals > 0, weighted / totals, np.nan)
+    return means
+
+
+def _totals(rates: np.ndarray) -> np.ndarray:
+    """Rates summed over every bin, shape (imt, poe, rlz)."""
+    return rates.reshape(rates.shape[:3] + (-1,)).sum(axis=-1)
+
+
+def mean_values(matrix: DisaggregationMatrix) -> Dict[str, np.ndarray]:
+    """Means of the numeric axes weighted by the rates of the bins.
+
+    Returns:
+        The mean of each axis but ``TRT``, shape (imt, poe, rlz), NaN where
+        nothing contributes.
+    """
+    rates = _by_rlz(bin_rates(matrix))
+    return _mean_values(matrix, rates, _totals(rates))
+
+
+@timed
+def scenario_table(matrix: DisaggregationMatrix) -> Dict[str, np.ndarray]:
+    """Modal and mean scenario of every IMT, PoE and realization, one row each.
+
+    Returns:
+        Columns of equal length, the rows ordered by IMT, PoE then
+        realization: ``imt``, ``poe``, ``return_period``, ``rlz``, the
+        disaggregated ``rate`` and, for each axis, ``mode_<axis>`` (center
+        of the modal bin, name of the region for ``TRT``) and
+        ``mean_<axis>`` (except for ``TRT``). The modes are NaN (or empty)
+        where nothing contributes.
+    """
+    imts, poes, rlzs = np.meshgrid(
+        np.array(matrix.imts, dtype=str),
+        np.asarray(matrix.poes, dtype=float),
+        np.array(matrix.rlz_ids, dtype=int),
+        indexing="ij",
+    )
+    rates = _by_rlz(bin_rates(matrix))
+    totals = _totals(rates)
+    contributing = totals > 0
+    table = {
+        "imt": imts.ravel(),
+        "poe": poes.ravel(),
+        "return_period": return_period(poes, _investigation_time(matrix)).ravel(),
+        "rlz": rlzs.ravel(),
+        "rate": totals.ravel(),
+    }
+    means = _mean_values(matrix, rates, totals)
+    for axis, index in _modal_bins(matrix.axes, rates).items():
+        name = axis.lower()
+        centers = np.asarray(matrix.bin_centers(axis))
+        if axis == "TRT":
+            table[f"mode_{name}"] = np.where(contributing, centers[index], "").ravel()
+            continue
+        table[f"mode_{name}"] = np.where(contributing, centers[index], np.nan).ravel()
+        table[f"mean_{name}"] = means[axis].ravel()
+    return table
+
+
+def write_table(path: Union[str, TextIO], table: Dict[str, np.ndarray]):
+    """Write the columns of a table (e.g. :func:`scenario_table`) in a CSV file.
+
+    Args:
+        path: path of the file, or a file open for writing (e.g. ``sys.stdout``).
+    """
+    if not isinstance(path, str):
+        _write_rows(path, table)
+        return
+    with open(path, "w") as csv_file:
+        _write_rows(csv_file, table)
+
+
+def _write_rows(csv_file: TextIO, table: Dict[str, np.ndarray]):
+    columns = list(table)
+    csv_file.write(",".join(columns) + "\n")
+    for row in zip(*(table[column] for column in columns)):
+        csv_file.write(",".join(_format(value) for value in row) + "\n")
+
+
+def _format(value) -> str:
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.6E}"
+    return str(value)
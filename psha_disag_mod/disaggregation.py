@@ -0,0 +1,338 @@
+"""Read the disaggregation outputs of OpenQuake (``Mag_Dist-0_14.csv``, ``Mag_Dist_Eps-0_14.csv``...).
+
+The rows of a file are streamed by chunks straight into a dense histogram
+indexed by (imt, poe, bins..., rlz), so that even the multi-dimensional
+outputs of fine grids are read with a bounded memory.
+"""
+
+import itertools
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    read_disag_params,
+)
+from psha_disag_mod.utils import (
+    cache_dir,
+    content_hash,
+    count_file,
+    files_key,
+    load_array_cache,
+    parse_oq_metadata,
+    save_array_cache,
+    timed,
+)
+
+# Key of the bins of each disaggregation axis in the ``#`` line of the files
+BIN_EDGES_KEYS = {
+    "Mag": "mag_bin_edges",
+    "Dist": "dist_bin_edges",
+    "Lon": "lon_bin_edges",
+    "Lat": "lat_bin_edges",
+    "Eps": "eps_bin_edges",
+    "TRT": "tectonic_region_types",
+}
+
+# Number of rows parsed at once by read_disaggregation
+CHUNKSIZE = 100_000
+
+
+@dataclass
+class DisaggregationMatrix:
+    """Disaggregation of a site, for every IMT, PoE and realization of a file.
+
+    Attributes:
+        axes: disaggregation axes of the file, e.g. ``["Mag", "Dist", "Eps"]``.
+        imts: intensity measure types.
+        poes: probabilities of exceedance of the disaggregation (``poes_disagg``).
+        bin_edges: edges of the bins of each axis (names of the tectonic
+            regions for ``TRT``).
+        rlz_ids: realizations of the columns, with their ``weights``.
+        values: probabilities of exceedance of each bin, shape
+            (imt, poe, bins..., rlz).
+        metadata: ``#`` line of the file.
+    """
+
+    axes: List[str]
+    imts: List[str]
+    poes: np.ndarray
+    bin_edges: Dict[str, np.ndarray]
+    rlz_ids: List[int]
+    weights: np.ndarray
+    values: np.ndarray
+    metadata: Dict
+
+    @property
+    def site(self) -> Optional[tuple]:
+        """(lon, lat) of the site, if given by the file."""
+        if "lon" in self.metadata and "lat" in self.metadata:
+            return self.metadata["lon"], self.metadata["lat"]
+        return None
+
+    def bin_centers(self, axis: str) -> np.ndarray:
+        """Centers of the bins of an axis (names of the regions for ``TRT``)."""
+        edges = self.bin_edges[axis]
+        if axis == "TRT":
+            return edges
+        return (edges[:-1] + edges[1:]) / 2
+
+    def matrix(self, imt: str, poe: float, rlz: Optional[int] = None) -> np.ndarray:
+        """Bins of one IMT and PoE, for every realization or only ``rlz``."""
+        i_poe = int(np.argmin(np.abs(self.poes - poe)))
+        values = self.values[self.imts.index(imt), i_poe]
+        if rlz is None:
+            return values
+        return values[..., self.rlz_ids.index(rlz)]
+
+    def marginal(self, axes: Sequence[str]) -> np.ndarray:
+        """Disaggregation over some of the axes only, shape (imt, poe, bins..., rlz).
+
+        See :func:`~psha_disag_mod.disag_analytics.marginal_poes`, the bins
+        of ``axes`` come in their given order.
+        """
+        # Imported here, as disag_analytics is built on this module
+        from psha_disag_mod.disag_analytics import marginal_poes
+
+        return marginal_poes(self, axes)
+
+    def save(self, path: str, key: str = ""):
+        """Write the matrix in a cache folder, see :func:`~psha_disag_mod.utils.save_array_cache`."""
+        arrays = {"poes": self.poes, "weights": self.weights, "values": self.values}
+        for axis in self.axes:
+            if axis != "TRT":
+                arrays[f"bin_edges_{axis}"] = self.bin_edges[axis]
+        save_array_cache(
+            path,
+            key,
+            arrays,
+            {
+                "axes": self.axes,
+                "imts": self.imts,
+                "rlz_ids": self.rlz_ids,
+                "regions": self.bin_edges.get("TRT"),
+                "metadata": self.metadata,
+            },
+        )
+
+    @classmethod
+    def load(
+        cls, path: str, key: Optional[str] = None
+    ) -> Optional["DisaggregationMatrix"]:
+        """Map the matrix written by :meth:`save`, as read-only memory-mapped arrays.
+
+        Returns:
+            None if there is no such matrix, or if ``key`` is given and
+            differs from the saved one.
+        """
+        cache = load_array_cache(path, key)
+        if cache is None:
+            return None
+        arrays, extra = cache
+        bin_edges = {
+            axis: extra["regions"] if axis == "TRT" else arrays[f"bin_edges_{axis}"]
+            for axis in extra["axes"]
+        }
+        return cls(
+            axes=extra["axes"],
+            imts=extra["imts"],
+            poes=arrays["poes"],
+            bin_edges=bin_edges,
+            rlz_ids=extra["rlz_ids"],
+            weights=arrays["weights"],
+            values=arrays["values"],
+            metadata=extra["metadata"],
+        )
+
+
+def _bin_indices(axis: str, values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Index of the bins whose centers are the values of a column."""
+    if axis == "TRT":
+        names = {name: i for i, name in enumerate(edges)}
+        return np.array([names[value] for value in values])
+    indices = np.searchsorted(edges, values.astype(float)) - 1
+    return np.clip(indices, 0, len(edges) - 2)
+
+
+def _poe_index(poes: List[float], poe: float) -> int:
+    """Index of a PoE in the list, appended if new."""
+    for i, known in enumerate(poes):
+        if np.isclose(known, poe, rtol=1e-6, atol=0):
+            return i
+    poes.append(float(poe))
+    return len(poes) - 1
+
+
+def _grow(values: np.ndarray, axis: int, size: int) -> np.ndarray:
+    """Extend an axis of the histogram with zeros up to ``size``."""
+    if values.shape[axis] >= size:
+        return values
+    shape = list(values.shape)
+    shape[axis] = size - values.shape[axis]
+    return np.concatenate([values, np.zeros(shape)], axis=axis)
+
+
+@timed
+def read_disaggregation(
+    path: str,
+    imts: Optional[Sequence[str]] = None,
+    poes: Optional[Sequence[float]] = None,
+    chunksize: int = CHUNKSIZE,
+    use_cache: bool = False,
+) -> DisaggregationMatrix:
+    """Read a disaggregation file of OpenQuake by chunks of rows.
+
+    With ``use_cache``, the matrix is kept in the cache folder of the
+    directory of the file, and memory-mapped read-only from it as long as
+    the file keeps its size and modification time: every process reading the
+    same file then shares one copy of the matrix.
+
+    Args:
+        path: file, e.g. ``Mag_Dist-0_14.csv``, possibly inside an archive
+            (``<export_dir>.psha.zip/Mag_Dist-0_14.csv``).
+        imts: intensity measure types expected in the file (e.g. from
+            ``job.ini``), to allocate the histogram once. Other IMTs found in
+            the file are appended.
+        poes: same for the ``poes_disagg``.
+        chunksize: number of rows parsed at once.
+        use_cache: whether to read and write the cache, and return a
+            memory-mapped matrix.
+    """
+    from psha_disag_mod.archive import open_archive, split_archive_path
+
+    in_archive = split_archive_path(path)
+    if in_archive is not None:
+        archive_path, filename = in_archive
+        return open_archive(archive_path).disaggregation(filename)
+    if not use_cache:
+        return _parse_disaggregation(path, imts, poes, chunksize)
+
+    key = content_hash([files_key([path]), imts, poes])
+    cache_path = os.path.join(
+        cache_dir(os.path.dirname(os.path.abspath(path))),
+        f"disaggregation-{os.path.splitext(os.path.basename(path))[0]}",
+    )
+    matrix = DisaggregationMatrix.load(cache_path, key)
+    if matrix is None:
+        matrix = _parse_disaggregation(path, imts, poes, chunksize)
+        matrix.save(cache_path, key)
+        matrix = DisaggregationMatrix.load(cache_path, key) or matrix
+    return matrix
+
+
+def _parse_disaggregation(
+    path: str,
+    imts: Optional[Sequence[str]],
+    poes: Optional[Sequence[float]],
+    chunksize: int,
+) -> DisaggregationMatrix:
+    axes = read_disag_params(path)["disaggregation_axes"]
+    imts = [] if imts is None else list(imts)
+    poes = [] if poes is None else [float(poe) for poe in poes]
+
+    count_file(path)
+    with open(path) as csv_file:
+        metadata = parse_oq_metadata(csv_file.readline())
+        header = csv_file.readline().strip().split(",")
+        bin_edges = {
+            axis: (
+                np.array(metadata[BIN_EDGES_KEYS[axis]])
+                if axis != "TRT"
+                else list(metadata[BIN_EDGES_KEYS[axis]])
+            )
+            for axis in axes
+        }
+        n_bins = [len(bin_edges[axis]) - (axis != "TRT") for axis in axes]
+        rlz_columns = header[2 + len(axes) :]
+        values = np.zeros([len(imts), len(poes)] + n_bins + [len(rlz_columns)])
+
+        while True:
+            lines = list(itertools.islice(csv_file, chunksize))
+            if not lines:
+                break
+            rows = np.loadtxt(lines, delimiter=",", dtype=str, ndmin=2)
+
+            row_imts, imt_first, imt_inverse = np.unique(
+                rows[:, 0], return_index=True, return_inverse=True
+            )
+            imt_indices = np.zeros(len(row_imts), dtype=int)
+            for i in np.argsort(imt_first):
+                if row_imts[i] not in imts:
+                    imts.append(str(row_imts[i]))
+                imt_indices[i] = imts.index(row_imts[i])
+            row_poes, poe_first, poe_inverse = np.unique(
+                rows[:, 1].astype(float), return_index=True, return_inverse=True
+            )
+            poe_indices = np.zeros(len(row_poes), dtype=int)
+            for i in np.argsort(poe_first):
+                poe_indices[i] = _poe_index(poes, row_poes[i])
+            values = _grow(_grow(values, 0, len(imts)), 1, len(poes))
+
+            index = [imt_indices[imt_inverse], poe_indices[poe_inverse]]
+            for i, axis in enumerate(axes):
+                index.append(_bin_indices(axis, rows[:, 2 + i], bin_edges[axis]))
+            values[tuple(index)] = rows[:, 2 + len(axes) :].astype(float)
+
+    return DisaggregationMatrix(
+        axes=axes,
+        imts=imts,
+        poes=np.array(poes),
+        bin_edges=bin_edges,
+        rlz_ids=list(metadata.get("rlz_ids", range(len(rlz_columns)))),
+        weights=np.array(metadata.get("weights", [1.0] * len(rlz_columns))),
+        values=values,
+        metadata=metadata,
+    )
+
+
+@timed
+def find_disaggregation_file(
+    export_dir: str,
+    axes: Sequence[str],
+    site: int = 0,
+    filenames=None,
+    seed: Optional[Sequence[int]] = None,
+) -> str:
+    """Path of the disaggregation file of exactly these axes for a site.
+
+    Raises:
+        FileNotFoundError: if the export directory has no such file.
+    """
+    if filenames is None:
+        filenames = FilenameIndex.from_directory(export_dir)
+    for filename in filter_filenames(
+        filenames,
+        "disaggregation",
+        seed=seed,
+        disaggregation_patterns=list(axes),
+        sites=[site],
+    ):
+        if read_disag_params(filename)["disaggregation_axes"] == list(axes):
+            return os.path.join(export_dir, filename)
+    raise FileNotFoundError(
+        f"No {'_'.join(axes)} disaggregation of site {site} in {export_dir}"
+    )
+
+
+@timed
+def find_mag_dist_file(
+    export_dir: str,
+    site: int = 0,
+    filenames=None,
+    seed: Optional[Sequence[int]] = None,
+) -> Optional[str]:
+    """Path of the Magnitude-Distance disaggregation of a site, ``Mag_Dist`` or else ``Mag_Dist_Eps``.
+
+    Returns:
+        None if the export directory has neither.
+    """
+    for axes in (["Mag", "Dist"], ["Mag", "Dist", "Eps"]):
+        try:
+            return find_disaggregation_file(export_dir, axes, site, filenames, seed)
+        except FileNotFoundError:
+            continue
+    return None
@@ -0,0 +1,468 @@
+"""Read the hazard curves exported by OpenQuake (``hazard_curve-*``, ``quantile_curve-*``).
+
+The curves of a run are gathered in a :class:`HazardCurves`, one dense array
+indexed by (type_data, IMT, site, IML), cached on disk next to the CSV files.
+"""
+
+import os
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    parse_psha_filename,
+)
+from psha_disag_mod.sites import SiteSelection, SiteTable
+from psha_disag_mod.utils import (
+    cache_dir,
+    count_file,
+    files_key,
+    imt_period,
+    load_array_cache,
+    names_key,
+    parse_oq_metadata,
+    return_period,
+    save_array_cache,
+    timed,
+)
+
+
+@timed
+def read_hazard_curve(path: str) -> Tuple[Dict, np.ndarray, np.ndarray, np.ndarray]:
+    """Read one hazard curve file of OpenQuake.
+
+    Returns:
+        The metadata of the ``#`` line, the sites (lon, lat, depth) of the
+        rows, the intensity measure levels of the ``poe-<level>`` columns and
+        the probabilities of exceedance with shape (site, IML).
+    """
+    count_file(path)
+    with open(path) as csv_file:
+        metadata = parse_oq_metadata(csv_file.readline())
+        header = csv_file.readline().strip().split(",")
+        values = np.loadtxt(csv_file, delimiter=",", ndmin=2)
+    poe_columns = [i for i, name in enumerate(header) if name.startswith("poe-")]
+    imls = np.array([float(header[i][len("poe-") :]) for i in poe_columns])
+    return metadata, values[:, :3], imls, values[:, poe_columns]
+
+
+@dataclass
+class HazardCurves:
+    """Hazard curves of a run of OpenQuake, gathered in one array.
+
+    Attributes:
+        type_datas: kinds of curves, e.g. ``mean``, ``rlz-001``, ``0.95``.
+        imts: intensity measure types, sorted by period.
+        sites: (lon, lat, depth) of the sites, shape (site, 3).
+        imls: intensity measure levels, shape (IMT, IML).
+        poes: probabilities of exceedance, shape (type_data, IMT, site, IML),
+            NaN for the curves which were not exported.
+        metadata: ``#`` line of each file, per filename.
+    """
+
+    type_datas: List[str]
+    imts: List[str]
+    sites: np.ndarray
+    imls: np.ndarray
+    poes: np.ndarray
+    metadata: Dict[str, Dict]
+
+    def curve(
+        self, type_data: str, imt: str, site: int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Levels and probabilities of exceedance of one curve."""
+        i_imt = self.imts.index(imt)
+        return (
+            self.imls[i_imt],
+            self.poes[self.type_datas.index(type_data), i_imt, site],
+        )
+
+    @cached_property
+    def site_table(self) -> SiteTable:
+        """Spatial index of the sites, built on first use."""
+        return SiteTable(self.sites)
+
+    def select(
+        self,
+        type_datas: Optional[Sequence[str]] = None,
+        imts: Optional[Sequence[str]] = None,
+        sites: Optional[SiteSelection] = None,
+    ) -> "HazardCurves":
+        """Curves of some type_datas, IMTs and sites only (all of them if None).
+
+        The sites are indices, or a spatial query such as
+        ``WithinRadius(lon, lat, 20)`` (see :class:`~psha_disag_mod.sites.SiteTable`).
+        """
+        i_datas = [self.type_datas.index(t) for t in type_datas or self.type_datas]
+        i_imts = [self.imts.index(imt) for imt in imts or self.imts]
+        if sites is None:
+            i_sites = list(range(len(self.sites)))
+        else:
+            i_sites = self.site_table.select(sites).tolist()
+        return HazardCurves(
+            type_datas=[self.type_datas[i] for i in i_datas],
+            imts=[self.imts[i] for i in i_imts],
+            sites=self.sites[i_sites],
+            imls=self.imls[i_imts],
+            poes=self.poes[np.ix_(i_datas, i_imts, i_sites)],
+            metadata=self.metadata,
+        )
+
+    def save(self, path: str, key: str = ""):
+        """Write the curves in a cache folder, with the key of the CSV files they come from.
+
+        See :func:`~psha_disag_mod.utils.save_array_cache`.
+        """
+        save_array_cache(
+            path,
+            key,
+            {"sites": self.sites, "imls": self.imls, "poes": self.poes},
+            {
+                "type_datas": self.type_datas,
+                "imts": self.imts,
+                "metadata": self.metadata,
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str, key: Optional[str] = None) -> Optional["HazardCurves"]:
+        """Map the curves written by :meth:`save`, as read-only memory-mapped arrays.
+
+        Returns:
+            None if there are no such curves, or if ``key`` is given and
+            differs from the saved one.
+        """
+        cache = load_array_cache(path, key)
+        if cache is None:
+            return None
+        arrays, extra = cache
+        return cls(**extra, **arrays)
+
+
+@timed
+def stack_hazard_curves(paths: Sequence[str]) -> HazardCurves:
+    """Read hazard curve files of a single run into one :class:`HazardCurves`.
+
+    The type_datas keep the order of the files, the IMTs are sorted by period.
+
+    Raises:
+        ValueError: if the files come from several runs or do not share their sites.
+    """
+    return assemble_hazard_curves(paths, [read_hazard_curve(path) for path in paths])
+
+
+def assemble_hazard_curves(
+    paths: Sequence[str],
+    curves: Sequence[Tuple[Dict, np.ndarray, np.ndarray, np.ndarray]],
+) -> HazardCurves:
+    """Gather hazard curve files already read into one :class:`HazardCurves`.
+
+    Args:
+        paths: the files, see :func:`stack_hazard_curves`.
+        curves: what :func:`read_hazard_curve` gave for each of them, possibly
+            restricted to some of the sites.
+
+    Raises:
+        ValueError: if the files come from several runs or do not share their sites.
+    """
+    params = [parse_psha_filename(path) for path in paths]
+    seeds = {param.seed for param in params}
+    if len(seeds) > 1:
+        raise ValueError(f"Curves of several runs {sorted(seeds)}, filter one seed")
+
+    type_datas = list(dict.fromkeys(param.type_data for param in params))
+    imts = sorted({param.type_acc for param in params}, key=imt_period)
+
+    sites = curves[0][1] if curves else np.empty((0, 3))
+    n_imls = max((len(imls) for _, _, imls, _ in curves), default=0)
+    imls = np.full((len(imts), n_imls), np.nan)
+    poes = np.full((len(type_datas), len(imts), len(sites), n_imls), np.nan)
+    metadata = {}
+    for path, param, (file_metadata, file_sites, file_imls, file_poes) in zip(
+        paths, params, curves
+    ):
+        if file_sites.shape != sites.shape or not np.allclose(file_sites, sites):
+            raise ValueError(f"{path} does not have the sites of {paths[0]}")
+        i_imt = imts.index(param.type_acc)
+        imls[i_imt, : len(file_imls)] = file_imls
+        poes[type_datas.index(param.type_data), i_imt, :, : len(file_imls)] = file_poes
+        metadata[os.path.basename(path)] = file_metadata
+    return HazardCurves(type_datas, imts, sites, imls, poes, metadata)
+
+
+def hazard_curves_cache_path(export_dir: str, filenames: Sequence[str]) -> str:
+    """Cache folder of the curves of some files of an export directory, see :func:`load_hazard_curves`.
+
+    The curves saved there with the :func:`~psha_disag_mod.utils.files_key`
+    of the files are the ones ``load_hazard_curves`` maps when it selects
+    the same files.
+    """
+    return os.path.join(cache_dir(export_dir), f"hazard_curves-{names_key(filenames)}")
+
+
+@timed
+def load_hazard_curves(
+    export_dir: str,
+    filenames: Optional[Sequence[str]] = None,
+    use_cache: bool = True,
+    **patterns,
+) -> HazardCurves:
+    """Load every hazard curve of an export directory matching the given patterns.
+
+    The curves are selected with :func:`~psha_disag_mod.compartiment.filter_filenames`
+    (``type_filename=["curve"]`` plus the ``patterns``) and gathered by
+    :func:`stack_hazard_curves`. The result is cached in the cache folder of
+    the directory, and reused as long as the CSV files keep their sizes and
+    modification times. The arrays of the curves are then memory-mapped
+    read-only from the cache, so that every process loading the same run
+    shares one copy of them, and starts without parsing anything. The
+    curves of an archive of the directory are read from it instead.
+
+    Args:
+        export_dir: ``export_dir`` of the job, where the CSV files are, or
+            its archive (see :func:`~psha_disag_mod.archive.ingest_export`).
+        filenames: listing of the directory (or a FilenameIndex of it), read
+            if not given.
+        use_cache: whether to read and write the cache, and return
+            memory-mapped curves.
+    """
+    from psha_disag_mod.archive import is_archive, open_archive
+
+    if is_archive(export_dir):
+        return open_archive(export_dir).hazard_curves(filenames, **patterns)
+    if filenames is None:
+        filenames = FilenameIndex.from_directory(export_dir)
+    selected = filter_filenames(filenames, "psha", type_filename=["curve"], **patterns)
+    paths = [os.path.join(export_dir, filename) for filename in selected]
+    if not use_cache:
+        return stack_hazard_curves(paths)
+
+    key = files_key(paths)
+    cache_path = hazard_curves_cache_path(export_dir, selected)
+    curves = HazardCurves.load(cache_path, key)
+    if curves is None:
+        curves = stack_hazard_curves(paths)
+        curves.save(cache_path, key)
+        # Shared with the other processes, unless one is replacing the cache
+        curves = HazardCurves.load(cache_path, key) or curves
+    return curves
+
+
+@timed
+def stack_realizations(curves: HazardCurves) -> Tuple[List[int], np.ndarray]:
+    """Curves of the realizations (``rlz-NNN``) only, sorted by realization.
+
+    Returns:
+        The realization numbers and their probabilities of exceedance, shape
+        (rlz, IMT, site, IML).
+    """
+    rlzs = sorted(
+        (int(type_data[len("rlz-") :]), i)
+        for i, type_data in enumerate(curves.type_datas)
+        if type_data.startswith("rlz-")
+    )
+    return [rlz for rlz, _ in rlzs], curves.poes[[i for _, i in rlzs]]
+
+
+@timed
+def weighted_quantiles(
+    values: np.ndarray, weights: np.ndarray, quantiles: Sequence[float]
+) -> np.ndarray:
+    """Weighted quantiles over the first axis of an array.
+
+    Same definition as ``quantile_curve`` of OpenQuake: the values are sorted,
+    and each quantile is interpolated in their cumulated weights, for every
+    element of the other axes at once.
+
+    Args:
+        values: shape (rlz, ...).
+        weights: weight of each realization, summing to 1.
+        quantiles: levels between 0 and 1.
+
+    Returns:
+        The quantiles, shape (quantile, ...).
+    """
+    order = np.argsort(values, axis=0)
+    values = np.take_along_axis(values, order, axis=0)
+    weights = np.broadcast_to(
+        np.asarray(weights, dtype=float).reshape((-1,) + (1,) * (values.ndim - 1)),
+        values.shape,
+    )
+    cum_weights = np.cumsum(np.take_along_axis(weights, order, axis=0), axis=0)
+
+    last = len(values) - 1
+    result = np.empty((len(quantiles),) + values.shape[1:])
+    for i, quantile in enumerate(quantiles):
+        # first sorted value whose cumulated weight reaches the quantile
+        upper = np.clip((cum_weights < quantile).sum(axis=0, keepdims=True), 0, last)
+        lower = np.maximum(upper - 1, 0)
+        x0 = np.take_along_axis(cum_weights, lower, axis=0)[0]
+        x1 = np.take_along_axis(cum_weights, upper, axis=0)[0]
+        y0 = np.take_along_axis(values, lower, axis=0)[0]
+        y1 = np.take_along_axis(values, upper, axis=0)[0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip((quantile - x0) / (x1 - x0), 0, 1)
+        result[i] = np.where(x1 > x0, y0 + fraction * (y1 - y0), y1)
+    return result
+
+
+@timed
+def logic_tree_statistics(
+    curves: HazardCurves,
+    weights: np.ndarray,
+    quantiles: Sequence[float] = (0.05, 0.5, 0.95),
+) -> HazardCurves:
+    """Mean and quantile curves of the realizations of a run, for every IMT at once.
+
+    Args:
+        curves: curves with every ``rlz-NNN`` of the run, e.g.
+            ``load_hazard_curves(export_dir, type_data=["rlz-"])``.
+        weights: weight of each realization, indexed by its number, see
+            :func:`~psha_disag_mod.euro_xml.realization_weights`. They are
+            normalized to sum to 1.
+        quantiles: levels of the quantile curves.
+
+    Returns:
+        Curves with the type_datas ``mean`` and one per quantile (``0.05``...),
+        like the ones exported by OpenQuake.
+
+    Raises:
+        ValueError: if curves of some realizations are missing.
+    """
+    rlzs, poes = stack_realizations(curves)
+    weights = np.asarray(weights, dtype=float)
+    missing = sorted(set(range(len(weights))) - set(rlzs))
+    if missing:
+        raise ValueError(f"Curves of the realizations {missing} are missing")
+    return weighted_statistics(
+        curves, rlzs, poes, weights[rlzs] / weights[rlzs].sum(), quantiles
+    )
+
+
+def weighted_statistics(
+    curves: HazardCurves,
+    rlzs: Sequence[int],
+    poes: np.ndarray,
+    weights: np.ndarray,
+    quantiles: Sequence[float] = (0.05, 0.5, 0.95),
+) -> HazardCurves:
+    """Mean and quantile curves of some realizations, already stacked.
+
+    Args:
+        curves: curves the realizations come from, for their IMTs, sites and levels.
+        rlzs: numbers of the realizations, for the errors.
+        poes: curves of the realizations, shape (rlz, IMT, site, IML).
+        weights: weight of each realization, summing to 1.
+        quantiles: levels of the quantile curves.
+
+    Raises:
+        ValueError: if some curves of the realizations are missing.
+    """
+    not_exported = np.isnan(poes) & ~np.isnan(curves.imls)[:, np.newaxis, :]
+    if not_exported.any():
+        rlz, i_imt = np.argwhere(not_exported)[0][:2]
+        raise ValueError(
+            f"Curve {curves.imts[i_imt]} of the realization {rlzs[rlz]} is missing"
+        )
+    mean = np.tensordot(weights, poes, axes=1)
+    statistics = np.concatenate(
+        [mean[np.newaxis], weighted_quantiles(poes, weights, quantiles)]
+    )
+    return HazardCurves(
+        type_datas=["mean"] + [f"{quantile:g}" for quantile in quantiles],
+        imts=list(curves.imts),
+        sites=curves.sites,
+        imls=curves.imls,
+        poes=statistics,
+        metadata={},
+    )
+
+
+# Smallest probability of exceedance taken in logarithm, as in OpenQuake
+EPSILON = 1e-30
+
+
+@timed
+def uniform_hazard_spectra(curves: HazardCurves, poes: Sequence[float]) -> np.ndarray:
+    """Accelerations reaching the given probabilities of exceedance, for every curve at once.
+
+    Each curve is made monotone (non-increasing) and interpolated linearly
+    between the log of its levels and the log of its PoEs. In the first bin
+    of the curves starting at a zero level, the level is interpolated
+    linearly against the log of the PoE instead. As in OpenQuake, a PoE
+    higher than the whole curve gives 0, a PoE lower than the whole curve
+    gives its highest level.
+
+    Args:
+        curves: hazard curves, over the same investigation time as ``poes``.
+        poes: probabilities of exceedance of the spectra (``poes`` of ``job.ini``).
+
+    Returns:
+        The spectra, shape (type_data, site, poe, IMT), NaN for the curves
+        which were not exported.
+    """
+    imls = curves.imls[np.newaxis, :, np.newaxis, np.newaxis, :]
+    curve_poes = np.minimum.accumulate(curves.poes, axis=-1)[..., np.newaxis, :]
+    targets = np.asarray(poes, dtype=float)
+    n_levels = (~np.isnan(curves.imls)).sum(axis=-1)[
+        np.newaxis, :, np.newaxis, np.newaxis
+    ]
+
+    # number of levels whose PoE exceeds the target, the crossing follows them
+    above = (curve_poes > targets[:, np.newaxis]).sum(axis=-1)
+    upper = np.clip(above, 1, n_levels - 1)[..., np.newaxis]
+    lower = upper - 1
+    imls = np.broadcast_to(imls, curve_poes.shape)
+    iml0 = np.take_along_axis(imls, lower, axis=-1)[..., 0]
+    iml1 = np.take_along_axis(imls, upper, axis=-1)[..., 0]
+    log_poe0 = np.log(np.maximum(np.take_along_axis(curve_poes, lower, -1), EPSILON))
+    log_poe1 = np.log(np.maximum(np.take_along_axis(curve_poes, upper, -1), EPSILON))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = (np.log(targets) - log_poe0[..., 0]) / (
+            log_poe1[..., 0] - log_poe0[..., 0]
+        )
+        log_iml = np.log(iml0) + fraction * (np.log(iml1) - np.log(iml0))
+        spectra = np.where(iml0 > 0, np.exp(log_iml), iml0 + fraction * (iml1 - iml0))
+
+    spectra = np.where(curve_poes[..., 0] < targets, 0.0, spectra)
+    spectra = np.where(above >= n_levels, iml1, spectra)
+    spectra = np.where(
+        np.isnan(curves.poes).all(axis=-1)[..., np.newaxis], np.nan, spectra
+    )
+    # (type_data, IMT, site, poe) -> (type_data, site, poe, IMT)
+    return np.moveaxis(spectra, 1, -1)
+
+
+def uhs_table(
+    curves: HazardCurves,
+    poes: Sequence[float],
+    site: int = 0,
+    investigation_time: float = 1.0,
+) -> Dict[str, np.ndarray]:
+    """Accelerations of the UHS of every curve of a site, one row per type_data, PoE and IMT.
+
+    Returns:
+        Columns of equal length: ``type_data``, ``poe``, ``return_period``,
+        ``imt`` and ``acceleration`` (see :func:`uniform_hazard_spectra`).
+    """
+    site_curves = replace(
+        curves, sites=curves.sites[[site]], poes=curves.poes[:, :, [site]]
+    )
+    spectra = uniform_hazard_spectra(site_curves, poes)[:, 0]
+    type_datas, poe_grid, imts = np.meshgrid(
+        np.array(curves.type_datas, dtype=str),
+        np.asarray(poes, dtype=float),
+        np.array(curves.imts, dtype=str),
+        indexing="ij",
+    )
+    return {
+        "type_data": type_datas.ravel(),
+        "poe": poe_grid.ravel(),
+        "return_period": return_period(poe_grid, investigation_time).ravel(),
+        "imt": imts.ravel(),
+        "acceleration": spectra.ravel(),
+    }
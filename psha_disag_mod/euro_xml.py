@@ -0,0 +1,573 @@
+"""Read the NRML source models given to OpenQuake (``area_sources_*.xml``, ``smoothed_source_model_*.xml``).
+
+The XML is streamed with ``iterparse`` and every source is turned into arrays
+as soon as it is read, then released. A model is kept in a columnar
+:class:`SourceModel` and cached on disk, keyed by the hash of the XML file.
+"""
+
+import hashlib
+import itertools
+import os
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, fields
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from psha_disag_mod.utils import cache_dir, count_file, timed
+
+SOURCE_TAGS = ("areaSource", "pointSource", "multiPointSource")
+
+
+@dataclass
+class SourceRecord:
+    """One seismic source of a model.
+
+    Attributes:
+        geometry: (lon, lat) of the polygon of an area source, or of the
+            points of a (multi) point source.
+        mfd: truncated Gutenberg-Richter MFD per point, columns
+            (aValue, bValue, minMag, maxMag). A single row for area and
+            point sources.
+        nodal_planes: columns (probability, strike, dip, rake).
+        hypo_depths: columns (probability, depth).
+    """
+
+    id: str
+    name: str
+    kind: str
+    tectonic_region: str
+    upper_depth: float
+    lower_depth: float
+    mag_scale_rel: str
+    rupt_aspect_ratio: float
+    geometry: np.ndarray
+    mfd: np.ndarray
+    bin_width: Optional[float]
+    nodal_planes: np.ndarray
+    hypo_depths: np.ndarray
+
+
+# Arrays of a SourceRecord, concatenated over the sources in a SourceModel
+_RAGGED = ("geometry", "mfd", "nodal_planes", "hypo_depths")
+_WIDTHS = {"geometry": 2, "mfd": 4, "nodal_planes": 4, "hypo_depths": 2}
+
+
+@dataclass
+class SourceModel:
+    """Sources of a model, stored by columns.
+
+    The scalar attributes of the sources are arrays with one value per
+    source, and each ragged array of :class:`SourceRecord` (e.g.
+    ``geometry``) is concatenated over the sources, the rows of source ``i``
+    being ``offsets[name][i]:offsets[name][i + 1]``.
+    """
+
+    name: str
+    id: np.ndarray
+    source_name: np.ndarray
+    kind: np.ndarray
+    tectonic_region: np.ndarray
+    upper_depth: np.ndarray
+    lower_depth: np.ndarray
+    mag_scale_rel: np.ndarray
+    rupt_aspect_ratio: np.ndarray
+    bin_width: np.ndarray
+    geometry: np.ndarray
+    mfd: np.ndarray
+    nodal_planes: np.ndarray
+    hypo_depths: np.ndarray
+    offsets: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def source(self, i: int) -> SourceRecord:
+        """Record of the ``i``-th source."""
+        ragged = {
+            name: getattr(self, name)[self.offsets[name][i] : self.offsets[name][i + 1]]
+            for name in _RAGGED
+        }
+        bin_width = float(self.bin_width[i])
+        return SourceRecord(
+            id=str(self.id[i]),
+            name=str(self.source_name[i]),
+            kind=str(self.kind[i]),
+            tectonic_region=str(self.tectonic_region[i]),
+            upper_depth=float(self.upper_depth[i]),
+            lower_depth=float(self.lower_depth[i]),
+            mag_scale_rel=str(self.mag_scale_rel[i]),
+            rupt_aspect_ratio=float(self.rupt_aspect_ratio[i]),
+            bin_width=None if np.isnan(bin_width) else bin_width,
+            **ragged,
+        )
+
+    def sources(self) -> List[SourceRecord]:
+        return [self.source(i) for i in range(len(self))]
+
+    @classmethod
+    def from_records(cls, name: str, records: List[SourceRecord]) -> "SourceModel":
+        columns = {}
+        for attribute, array_name in (
+            ("id", "id"),
+            ("name", "source_name"),
+            ("kind", "kind"),
+            ("tectonic_region", "tectonic_region"),
+            ("mag_scale_rel", "mag_scale_rel"),
+        ):
+            columns[array_name] = np.array(
+                [getattr(record, attribute) for record in records], dtype=str
+            )
+        for array_name in ("upper_depth", "lower_depth", "rupt_aspect_ratio"):
+            columns[array_name] = np.array(
+                [getattr(record, array_name) for record in records], dtype=float
+            )
+        columns["bin_width"] = np.array(
+            [np.nan if r.bin_width is None else r.bin_width for r in records]
+        )
+        offsets = {}
+        for array_name in _RAGGED:
+            arrays = [getattr(record, array_name) for record in records]
+            offsets[array_name] = np.concatenate(
+                [[0], np.cumsum([len(array) for array in arrays])]
+            ).astype(int)
+            columns[array_name] = (
+                np.concatenate(arrays) if arrays else np.empty((0, _WIDTHS[array_name]))
+            )
+        return cls(name=name, offsets=offsets, **columns)
+
+    def save(self, path: str, key: str = ""):
+        """Write the model in a ``.npz`` file, with the key of the XML it comes from."""
+        arrays = {
+            field.name: getattr(self, field.name)
+            for field in fields(self)
+            if field.name not in ("name", "offsets")
+        }
+        arrays.update(
+            {f"offsets_{name}": offsets for name, offsets in self.offsets.items()}
+        )
+        np.savez(path, key=np.array(key), name=np.array(self.name), **arrays)
+
+    @classmethod
+    def load(cls, path: str, key: Optional[str] = None) -> Optional["SourceModel"]:
+        """Read a model written by :meth:`save`, None if ``key`` differs from the saved one."""
+        with np.load(path) as arrays:
+            if key is not None and str(arrays["key"]) != key:
+                return None
+            columns = {
+                field.name: arrays[field.name]
+                for field in fields(cls)
+                if field.name not in ("name", "offsets")
+            }
+            offsets = {name: arrays[f"offsets_{name}"] for name in _RAGGED}
+            return cls(name=str(arrays["name"]), offsets=offsets, **columns)
+
+
+def _local(tag: str) -> str:
+    """Tag without its namespace."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _floats(text: Optional[str]) -> np.ndarray:
+    return np.array((text or "").split(), dtype=float)
+
+
+def _parse_source(element: ET.Element, group_region: str) -> SourceRecord:
+    kind = _local(element.tag)
+    children: Dict[str, ET.Element] = {}
+    nodal_planes, hypo_depths = [], []
+    for child in element.iter():
+        name = _local(child.tag)
+        if name == "nodalPlane":
+            nodal_planes.append(
+                [
+                    float(child.get(key))
+                    for key in ("probability", "strike", "dip", "rake")
+                ]
+            )
+        elif name == "hypoDepth":
+            hypo_depths.append(
+                [float(child.get(key)) for key in ("probability", "depth")]
+            )
+        else:
+            children[name] = child
+
+    if kind == "pointSource":
+        geometry = _floats(children["pos"].text).reshape(-1, 2)
+    else:
+        geometry = _floats(children["posList"].text).reshape(-1, 2)
+
+    bin_width = None
+    if "truncGutenbergRichterMFD" in children:
+        mfd_element = children["truncGutenbergRichterMFD"]
+        mfd = np.array(
+            [
+                [
+                    float(mfd_element.get(key))
+                    for key in ("aValue", "bValue", "minMag", "maxMag")
+                ]
+            ]
+        )
+    elif "multiMFD" in children:
+        if children["multiMFD"].get("kind") != "truncGutenbergRichterMFD":
+            raise ValueError(
+                f"Unsupported {children['multiMFD'].get('kind')} MFD of source "
+                f"{element.get('id')}"
+            )
+        columns = [
+            _floats(children[key].text)
+            for key in ("a_val", "b_val", "min_mag", "max_mag")
+        ]
+        mfd = np.column_stack(np.broadcast_arrays(*columns))
+        mfd = np.broadcast_to(mfd, (len(geometry), 4)).copy()
+        bin_width = float(children["bin_width"].text)
+    else:
+        tags = [name for name in children if name.endswith("MFD")] or ["no"]
+        raise ValueError(f"Unsupported {tags[0]} MFD of source {element.get('id')}")
+
+    return SourceRecord(
+        id=element.get("id"),
+        name=element.get("name", ""),
+        kind=kind,
+        tectonic_region=element.get("tectonicRegion", group_region),
+        upper_depth=float(children["upperSeismoDepth"].text),
+        lower_depth=float(children["lowerSeismoDepth"].text),
+        mag_scale_rel=children["magScaleRel"].text.strip(),
+        rupt_aspect_ratio=float(children["ruptAspectRatio"].text),
+        geometry=geometry,
+        mfd=mfd,
+        bin_width=bin_width,
+        nodal_planes=np.array(nodal_planes).reshape(-1, 4),
+        hypo_depths=np.array(hypo_depths).reshape(-1, 2),
+    )
+
+
+@timed
+def parse_source_model(path: str) -> SourceModel:
+    """Stream the sources of a NRML source model.
+
+    Raises:
+        ValueError: for the sources other than area, point and multi-point
+            sources, and the MFDs other than truncated Gutenberg-Richter,
+            naming the source and the tag.
+    """
+    records = []
+    model_name, group_region = "", ""
+    count_file(path)
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        name = _local(element.tag)
+        if event == "start":
+            if name == "sourceModel":
+                model_name = element.get("name", "")
+            elif name == "sourceGroup":
+                group_region = element.get("tectonicRegion", "")
+            continue
+        if name in SOURCE_TAGS:
+            records.append(_parse_source(element, group_region))
+            element.clear()
+        elif name.endswith("Source"):
+            raise ValueError(f"Unsupported {name} {element.get('id')} in {path}")
+    return SourceModel.from_records(model_name, records)
+
+
+def file_hash(path: str) -> str:
+    """SHA-1 of the content of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as xml_file:
+        for block in iter(lambda: xml_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@timed
+def read_source_model(path: str, use_cache: bool = True) -> SourceModel:
+    """Read a NRML source model, from its cache if the file was already parsed.
+
+    The cache is a ``.npz`` in the cache folder of the directory of the XML,
+    named after the hash of the file, so that every branch of a logic tree
+    sharing the same file shares the same cache.
+    """
+    if not use_cache:
+        return parse_source_model(path)
+    key = file_hash(path)
+    cache_path = os.path.join(
+        cache_dir(os.path.dirname(os.path.abspath(path))), f"source_model-{key}.npz"
+    )
+    if os.path.exists(cache_path):
+        model = SourceModel.load(cache_path, key)
+        if model is not None:
+            return model
+    model = parse_source_model(path)
+    model.save(cache_path, key)
+    return model
+
+
+class LogicTreeBranch(NamedTuple):
+    """A branch of a NRML logic tree."""
+
+    branch_set: str
+    uncertainty_type: str
+    branch_id: str
+    uncertainty_model: str
+    weight: float
+    apply_to_tectonic_region: Optional[str]
+
+
+@timed
+def read_logic_tree(path: str) -> List[LogicTreeBranch]:
+    """Read the branches of a NRML logic tree (``logicTree_SRCS.xml``, ``logicTree_GMPE.xml``)."""
+    branches = []
+    branch_set: Dict[str, Optional[str]] = {}
+    count_file(path)
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        name = _local(element.tag)
+        if event == "start":
+            if name == "logicTreeBranchSet":
+                branch_set = {
+                    "id": element.get("branchSetID"),
+                    "type": element.get("uncertaintyType"),
+                    "region": element.get("applyToTectonicRegionType"),
+                }
+            continue
+        if name == "logicTreeBranch":
+            children = {_local(child.tag): child.text.strip() for child in element}
+            branches.append(
+                LogicTreeBranch(
+                    branch_set=branch_set["id"],
+                    uncertainty_type=branch_set["type"],
+                    branch_id=element.get("branchID"),
+                    uncertainty_model=children["uncertaintyModel"],
+                    weight=float(children["uncertaintyWeight"]),
+                    apply_to_tectonic_region=branch_set["region"],
+                )
+            )
+    return branches
+
+
+@dataclass
+class MagnitudeRates:
+    """Annual occurrence rates of the magnitude bins of sources.
+
+    Attributes:
+        mags: centers of the magnitude bins.
+        rates: annual rates, shape (source, magnitude bin), or
+            (branch, source, magnitude bin) for a logic tree, where the
+            branches with fewer sources are padded with zeros.
+        source_ids: ids of the sources (of each branch for a logic tree).
+        weights: weights of the branches of a logic tree.
+    """
+
+    mags: np.ndarray
+    rates: np.ndarray
+    source_ids: list
+    weights: Optional[np.ndarray] = None
+
+    def total(self) -> np.ndarray:
+        """Rates of the magnitude bins summed over the sources."""
+        return self.rates.sum(axis=-2)
+
+
+def _mfd_bins(min_mags: np.ndarray, max_mags: np.ndarray, bin_width: float):
+    """First and last bin of each truncated Gutenberg-Richter MFD, as OpenQuake discretizes them.
+
+    The bounds are rounded to the bin width, then shrunk by half a bin, so
+    that the bins are centered on ``(k + 1/2) * bin_width``.
+    """
+    first = np.round(min_mags / bin_width)
+    last = np.round(max_mags / bin_width)
+    single = first == last
+    return first, np.where(single, last, last - 1), single
+
+
+def mfd_row_rates(
+    model: SourceModel, bin_width: float = 0.1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Annual rates of the magnitude bins of every row of the MFDs of a model.
+
+    Each row of the truncated Gutenberg-Richter MFDs (one per area source,
+    one per point of a multi-point source) is discretized on a common grid
+    of magnitudes. As in OpenQuake, the top bin of a row is cut at its
+    unrounded ``maxMag``.
+
+    Returns:
+        The centers of the magnitude bins, and the rates of shape (MFD row,
+        magnitude bin).
+    """
+    a, b, min_mags, max_mags = model.mfd.T
+    first, last, single = _mfd_bins(min_mags, max_mags, bin_width)
+    if len(first) == 0:
+        return np.empty(0), np.empty((0, 0))
+
+    k = np.arange(first.min(), last.max() + 1)
+    mags = (k + 0.5) * bin_width
+    lower = k[np.newaxis] * bin_width
+    # the top bin ends at maxMag, when maxMag is not on the grid of the bins
+    upper = np.minimum(lower + bin_width, max_mags[:, None])
+    rates = 10 ** (a[:, None] - b[:, None] * lower) - 10 ** (
+        a[:, None] - b[:, None] * upper
+    )
+    inside = (k[np.newaxis] >= first[:, None]) & (k[np.newaxis] <= last[:, None])
+    rates = np.where(inside & ~single[:, None], rates, 0.0)
+    if single.any():
+        # a MFD narrower than a bin is a single bin centered on its rounded
+        # magnitude, its rate goes in the bin of the grid starting there
+        rows = np.flatnonzero(single)
+        mag = first[rows] * bin_width
+        rates[rows, (first[rows] - k[0]).astype(int)] = 10 ** (
+            a[rows] - b[rows] * (mag - bin_width / 2)
+        ) - 10 ** (a[rows] - b[rows] * np.minimum(mag + bin_width / 2, max_mags[rows]))
+    return mags, rates
+
+
+@timed
+def gr_rates(
+    model: SourceModel, bin_width: float = 0.1, min_mag: Optional[float] = None
+) -> MagnitudeRates:
+    """Annual rates of the magnitude bins of every source of a model, in one pass.
+
+    The rows of the MFDs are discretized by :func:`mfd_row_rates`, and the
+    rows of a source are summed.
+
+    Args:
+        model: source model, e.g. from :func:`read_source_model`.
+        bin_width: ``width_of_mfd_bin`` of ``job.ini``.
+        min_mag: ``minimum_magnitude`` of ``job.ini``, the bins whose center
+            is below are dropped.
+    """
+    mags, rates = mfd_row_rates(model, bin_width)
+    if len(mags) == 0:
+        return MagnitudeRates(np.empty(0), np.empty((len(model), 0)), model.id.tolist())
+
+    rates = np.add.reduceat(rates, model.offsets["mfd"][:-1], axis=0)
+    if min_mag is not None:
+        kept = mags >= min_mag
+        mags, rates = mags[kept], rates[:, kept]
+    return MagnitudeRates(mags, rates, model.id.tolist())
+
+
+@timed
+def logic_tree_gr_rates(
+    logic_tree_path: str,
+    bin_width: float = 0.1,
+    min_mag: Optional[float] = None,
+    use_cache: bool = True,
+) -> MagnitudeRates:
+    """Annual rates of the magnitude bins of the sources of every branch of a source logic tree.
+
+    The source models are looked for next to the logic tree. The rates of
+    the branches are stacked in one array (see :class:`MagnitudeRates`).
+    """
+    directory = os.path.dirname(os.path.abspath(logic_tree_path))
+    branches = [
+        branch
+        for branch in read_logic_tree(logic_tree_path)
+        if branch.uncertainty_type == "sourceModel"
+    ]
+    branch_rates = []
+    for branch in branches:
+        models = [
+            read_source_model(os.path.join(directory, filename), use_cache)
+            for filename in branch.uncertainty_model.split()
+        ]
+        rates = [gr_rates(model, bin_width, min_mag) for model in models]
+        branch_rates.append(rates)
+
+    all_rates = [rates for branch in branch_rates for rates in branch]
+    mags = _common_mags(all_rates, bin_width)
+    n_sources = max(sum(len(r.source_ids) for r in branch) for branch in branch_rates)
+    stacked = np.zeros((len(branches), n_sources, len(mags)))
+    source_ids = []
+    for i, branch in enumerate(branch_rates):
+        row = 0
+        ids = []
+        for rates in branch:
+            if len(rates.mags):
+                start = int(np.round((rates.mags[0] - mags[0]) / bin_width))
+                stacked[
+                    i,
+                    row : row + len(rates.source_ids),
+                    start : start + len(rates.mags),
+                ] = rates.rates
+            row += len(rates.source_ids)
+            ids.extend(rates.source_ids)
+        source_ids.append(ids)
+    return MagnitudeRates(
+        mags, stacked, source_ids, np.array([branch.weight for branch in branches])
+    )
+
+
+def _common_mags(all_rates: List[MagnitudeRates], bin_width: float) -> np.ndarray:
+    """Grid of magnitudes covering the grids of several MagnitudeRates."""
+    grids = [rates.mags for rates in all_rates if len(rates.mags)]
+    if not grids:
+        return np.empty(0)
+    first = min(np.round(grid[0] / bin_width - 0.5) for grid in grids)
+    last = max(np.round(grid[-1] / bin_width - 0.5) for grid in grids)
+    return (np.arange(first, last + 1) + 0.5) * bin_width
+
+
+@timed
+def logic_tree_paths(
+    branches: List[LogicTreeBranch], branch_weights: Optional[Dict[str, float]] = None
+) -> Tuple[List[Tuple[str, ...]], np.ndarray]:
+    """Paths through the branch sets of a logic tree, enumerated as OpenQuake does.
+
+    Args:
+        branches: branches of the logic tree, see :func:`read_logic_tree`.
+        branch_weights: weights replacing those of the XML, per branchID.
+
+    Returns:
+        The branchIDs of each path and the weight of each path, product of
+        the weights of its branches.
+    """
+    branch_weights = branch_weights or {}
+    branch_sets: Dict[str, List[LogicTreeBranch]] = {}
+    for branch in branches:
+        branch_sets.setdefault(branch.branch_set, []).append(branch)
+    paths = list(itertools.product(*branch_sets.values()))
+    weights = np.array(
+        [
+            np.prod(
+                [branch_weights.get(b.branch_id, b.weight) for b in path],
+            )
+            for path in paths
+        ]
+    )
+    return [tuple(b.branch_id for b in path) for path in paths], weights
+
+
+@timed
+def realization_weights(
+    source_model_logic_tree: Union[str, List[LogicTreeBranch]],
+    gsim_logic_tree: Union[str, List[LogicTreeBranch]],
+    branch_weights: Optional[Dict[str, float]] = None,
+) -> Tuple[List[Tuple[str, ...]], np.ndarray]:
+    """Weights of the realizations of a fully enumerated job (``number_of_logic_tree_samples = 0``).
+
+    The realizations are numbered like ``rlz-NNN`` by OpenQuake: the paths of
+    the source model logic tree, each combined with every path of the GMPE
+    logic tree.
+
+    Args:
+        source_model_logic_tree: ``source_model_logic_tree_file`` of ``job.ini``,
+            or its branches already read by :func:`read_logic_tree`.
+        gsim_logic_tree: ``gsim_logic_tree_file`` of ``job.ini``, or its branches.
+        branch_weights: weights replacing those of the XMLs, per branchID.
+
+    Returns:
+        The branchIDs of each realization and the weight of each realization.
+    """
+    if isinstance(source_model_logic_tree, str):
+        source_model_logic_tree = read_logic_tree(source_model_logic_tree)
+    if isinstance(gsim_logic_tree, str):
+        gsim_logic_tree = read_logic_tree(gsim_logic_tree)
+    source_paths, source_weights = logic_tree_paths(
+        source_model_logic_tree, branch_weights
+    )
+    gsim_paths, gsim_weights = logic_tree_paths(gsim_logic_tree, branch_weights)
+    paths = [
+        source_path + gsim_path
+        for source_path in source_paths
+        for gsim_path in gsim_paths
+    ]
+    return paths, np.outer(source_weights, gsim_weights).ravel()
@@ -0,0 +1,351 @@
+"""Monte Carlo sampling of the paths of the source model and GMPE logic trees.
+
+With ``number_of_logic_tree_samples = 0`` OpenQuake enumerates every path of
+the logic trees, whose number is the product of the sizes of all the branch
+sets. The branch sets of both trees are kept here in a
+:class:`CompactLogicTree`, one padded (branch set, branch) array of weights,
+and M paths are drawn at once by comparing an (M, branch set) array of
+uniform numbers to the cumulated weights of every set. A path is numbered
+like the realization of the full enumeration it falls on, so that the mean
+and quantiles of a sample only read the curves and disaggregations of the
+realizations it drew, each one weighted by the number of times it was drawn.
+
+The samples are drawn by numpy, they are not the ones OpenQuake would draw
+for the same ``random_seed``.
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from psha_disag_mod.disaggregation import DisaggregationMatrix
+from psha_disag_mod.drouet_curves import (
+    HazardCurves,
+    weighted_quantiles,
+    weighted_statistics,
+)
+from psha_disag_mod.euro_xml import LogicTreeBranch, read_logic_tree
+from psha_disag_mod.metadata_ini import JobConfig
+from psha_disag_mod.utils import timed
+
+
+@dataclass
+class CompactLogicTree:
+    """Branch sets of the source model and GMPE logic trees, as arrays.
+
+    Attributes:
+        branch_sets: branchSetIDs, those of the source model logic tree first,
+            the same ID may come once per tree.
+        branch_ids: branchIDs of each set.
+        weights: weights of the branches, shape (branch set, branch), each
+            row normalized to sum to 1 and padded with zeros.
+    """
+
+    branch_sets: List[str]
+    branch_ids: List[List[str]]
+    weights: np.ndarray
+
+    @classmethod
+    def from_logic_trees(
+        cls,
+        source_model_logic_tree: Union[str, List[LogicTreeBranch]],
+        gsim_logic_tree: Union[str, List[LogicTreeBranch]],
+        branch_weights: Optional[Dict[str, float]] = None,
+    ) -> "CompactLogicTree":
+        """Branch sets of the logic trees of a job, in the order OpenQuake enumerates them.
+
+        Args:
+            source_model_logic_tree: ``source_model_logic_tree_file`` of ``job.ini``,
+                or its branches already read by
+                :func:`~psha_disag_mod.euro_xml.read_logic_tree`.
+            gsim_logic_tree: ``gsim_logic_tree_file`` of ``job.ini``, or its branches.
+            branch_weights: weights replacing those of the XMLs, per branchID.
+
+        Raises:
+            ValueError: if the branches of a set have no weight.
+        """
+        if isinstance(source_model_logic_tree, str):
+            source_model_logic_tree = read_logic_tree(source_model_logic_tree)
+        if isinstance(gsim_logic_tree, str):
+            gsim_logic_tree = read_logic_tree(gsim_logic_tree)
+        branch_weights = branch_weights or {}
+        # keyed by tree too, as both trees may use the same branchSetIDs
+        branch_sets: Dict[Tuple[int, str], List[LogicTreeBranch]] = {}
+        for i_tree, tree in enumerate([source_model_logic_tree, gsim_logic_tree]):
+            for branch in tree:
+                branch_sets.setdefault((i_tree, branch.branch_set), []).append(branch)
+
+        weights = np.zeros((len(branch_sets), max(map(len, branch_sets.values()))))
+        for i, ((_, branch_set), branches) in enumerate(branch_sets.items()):
+            weights[i, : len(branches)] = [
+                branch_weights.get(b.branch_id, b.weight) for b in branches
+            ]
+            total = weights[i].sum()
+            if total <= 0:
+                raise ValueError(f"The branches of {branch_set!r} have no weight")
+            weights[i] /= total
+        return cls(
+            branch_sets=[branch_set for _, branch_set in branch_sets],
+            branch_ids=[[b.branch_id for b in bs] for bs in branch_sets.values()],
+            weights=weights,
+        )
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """Number of branches of each set."""
+        return np.array([len(ids) for ids in self.branch_ids])
+
+    @property
+    def n_paths(self) -> int:
+        """Number of paths of the full enumeration, as a Python int (it may be huge)."""
+        return int(np.prod([len(ids) for ids in self.branch_ids], dtype=object))
+
+    def path(self, indices: Sequence[int]) -> Tuple[str, ...]:
+        """branchIDs of a path, given the index of its branch in every set."""
+        return tuple(ids[i] for ids, i in zip(self.branch_ids, indices))
+
+    def realizations(self, paths: np.ndarray) -> np.ndarray:
+        """Numbers of the realizations of the full enumeration of some paths.
+
+        The last branch set varies the fastest, as in
+        :func:`~psha_disag_mod.euro_xml.realization_weights`.
+
+        Args:
+            paths: index of the branch of every set, shape (path, branch set).
+
+        Raises:
+            ValueError: if the full enumeration is too large to be numbered.
+        """
+        return np.ravel_multi_index(tuple(np.asarray(paths).T), tuple(self.sizes))
+
+
+@timed
+def sample_paths(
+    tree: CompactLogicTree, n_samples: int, seed: Optional[int] = None
+) -> np.ndarray:
+    """Draw paths through the logic trees, each branch with the probability of its weight.
+
+    The branch of every set is drawn independently, for every sample and
+    every set at once.
+
+    Returns:
+        The index of the branch of every set, shape (sample, branch set).
+
+    Raises:
+        ValueError: if ``n_samples`` is not positive.
+    """
+    if n_samples < 1:
+        raise ValueError(f"Cannot draw {n_samples} paths of the logic trees")
+    cum_weights = np.cumsum(tree.weights, axis=1)
+    draws = np.random.default_rng(seed).random((n_samples, len(tree.branch_sets)))
+    indices = (draws[:, :, np.newaxis] >= cum_weights).sum(axis=-1)
+    # a draw above a total rounded below 1 falls on the last branch
+    return np.minimum(indices, tree.sizes - 1)
+
+
+@timed
+def sample_realizations(
+    config: JobConfig,
+    n_samples: Optional[int] = None,
+    branch_weights: Optional[Dict[str, float]] = None,
+) -> np.ndarray:
+    """Draw the realizations of a job, with its logic trees and ``random_seed``.
+
+    Args:
+        n_samples: number of paths, ``number_of_logic_tree_samples`` of the
+            job if None.
+        branch_weights: weights replacing those of the XMLs, per branchID.
+
+    Returns:
+        The number of the realization of every sample, in the order they
+        were drawn.
+
+    Raises:
+        ValueError: if the job has no logic trees or nothing to sample.
+    """
+    if not config.source_model_logic_tree or not config.gsim_logic_tree:
+        raise ValueError(f"No logic trees in {config.path}")
+    n_samples = n_samples or config.number_of_logic_tree_samples
+    if not n_samples:
+        raise ValueError(f"{config.path} enumerates every path of its logic trees")
+    tree = CompactLogicTree.from_logic_trees(
+        config.source_model_logic_tree, config.gsim_logic_tree, branch_weights
+    )
+    return tree.realizations(sample_paths(tree, n_samples, config.random_seed))
+
+
+def sampled_type_datas(samples: np.ndarray) -> List[str]:
+    """type_datas of the distinct realizations of a sample, to load their curves only.
+
+    e.g. ``load_hazard_curves(export_dir, type_data=sampled_type_datas(samples))``.
+    """
+    return [f"rlz-{rlz:03d}" for rlz in np.unique(samples)]
+
+
+def _sampled_curves(
+    curves: HazardCurves, samples: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Curves of the distinct realizations of a sample.
+
+    Returns:
+        The realizations, the position of every sample among them and their
+        curves, shape (rlz, IMT, site, IML).
+    """
+    rlzs, inverse = np.unique(samples, return_inverse=True)
+    positions = {
+        int(type_data[len("rlz-") :]): i
+        for i, type_data in enumerate(curves.type_datas)
+        if type_data.startswith("rlz-")
+    }
+    missing = [int(rlz) for rlz in rlzs if rlz not in positions]
+    if missing:
+        raise ValueError(f"Curves of the realizations {missing} are missing")
+    # only the rows of the sampled realizations are read from a memory-map
+    return rlzs, inverse, curves.poes[[positions[rlz] for rlz in rlzs]]
+
+
+@timed
+def sampled_statistics(
+    curves: HazardCurves,
+    samples: np.ndarray,
+    quantiles: Sequence[float] = (0.05, 0.5, 0.95),
+) -> HazardCurves:
+    """Mean and quantile curves of the realizations of a sample.
+
+    Every sample has the same weight, as the realizations of a job with
+    ``number_of_logic_tree_samples``: a realization drawn twice counts twice.
+
+    Args:
+        curves: curves with at least the realizations of the sample.
+        samples: realization of every sample, see :func:`sample_realizations`.
+        quantiles: levels of the quantile curves.
+
+    Returns:
+        Curves with the type_datas ``mean`` and one per quantile, like
+        :func:`~psha_disag_mod.drouet_curves.logic_tree_statistics`.
+
+    Raises:
+        ValueError: if curves of sampled realizations are missing.
+    """
+    rlzs, inverse, poes = _sampled_curves(curves, samples)
+    weights = np.bincount(inverse, minlength=len(rlzs)) / len(inverse)
+    return weighted_statistics(curves, rlzs.tolist(), poes, weights, quantiles)
+
+
+@timed
+def sampled_disaggregation(
+    matrix: DisaggregationMatrix,
+    samples: np.ndarray,
+    quantiles: Sequence[float] = (),
+) -> np.ndarray:
+    """Mean and quantile disaggregation of the realizations of a sample.
+
+    Args:
+        matrix: disaggregation with at least the realizations of the sample.
+        samples: realization of every sample, see :func:`sample_realizations`.
+        quantiles: levels of the quantiles of every bin.
+
+    Returns:
+        The mean then the quantiles of the PoEs of every bin, shape
+        (1 + quantile, imt, poe, bins...).
+
+    Raises:
+        ValueError: if the matrix lacks sampled realizations.
+    """
+    rlzs, counts = np.unique(samples, return_counts=True)
+    missing = [int(rlz) for rlz in rlzs if rlz not in matrix.rlz_ids]
+    if missing:
+        raise ValueError(f"No realizations {missing} in the disaggregation")
+    values = matrix.values[..., [matrix.rlz_ids.index(rlz) for rlz in rlzs]]
+    weights = counts / counts.sum()
+    mean = np.tensordot(values, weights, axes=([-1], [0]))
+    return np.concatenate(
+        [
+            mean[np.newaxis],
+            weighted_quantiles(np.moveaxis(values, -1, 0), weights, quantiles),
+        ]
+    )
+
+
+def default_checkpoints(n_samples: int) -> np.ndarray:
+    """Powers of 2 up to the number of samples, and the number of samples."""
+    powers = 2 ** np.arange(int(np.log2(n_samples)) + 1)
+    return np.unique(np.append(powers, n_samples))
+
+
+def _largest(values: np.ndarray, compared: np.ndarray) -> float:
+    return float(np.max(values[compared], initial=0.0))
+
+
+def _relative_change(values: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.abs(values / reference - 1)
+
+
+@timed
+def convergence_table(
+    curves: HazardCurves,
+    samples: np.ndarray,
+    checkpoints: Optional[Sequence[int]] = None,
+    quantiles: Sequence[float] = (0.05, 0.5, 0.95),
+    min_poe: float = 0.0,
+) -> Dict[str, np.ndarray]:
+    """Convergence of the statistics of a sample as more of its samples are taken.
+
+    The statistics of the first ``m`` samples are compared to the ones of
+    the whole sample, at every checkpoint ``m``. The curves are only read
+    once per distinct realization: the first ``m`` samples are counted per
+    realization, which then weights their curves.
+
+    Args:
+        curves: curves with at least the realizations of the sample.
+        samples: realization of every sample, in the order they were drawn.
+        checkpoints: numbers of samples, powers of 2 by default, see
+            :func:`default_checkpoints`.
+        quantiles: levels of the quantile curves followed.
+        min_poe: PoEs of the final mean below which the levels are left out,
+            where a few samples are noisy.
+
+    Returns:
+        One row per checkpoint, columns ``n_samples``, ``n_realizations``
+        (distinct ones drawn), ``max_std_error`` (standard error of the mean
+        over the mean, the largest of every level), ``max_change_mean`` and
+        ``max_change_<quantile>`` (relative difference to the statistics of
+        the whole sample, the largest of every level).
+    """
+    rlzs, inverse, poes = _sampled_curves(curves, samples)
+    if checkpoints is None:
+        checkpoints = default_checkpoints(len(samples))
+    final = sampled_statistics(curves, samples, quantiles).poes
+    compared = (final[0] > 0) & (final[0] >= min_poe)
+
+    table: Dict[str, list] = {
+        "n_samples": [],
+        "n_realizations": [],
+        "max_std_error": [],
+        "max_change_mean": [],
+    }
+    table.update({f"max_change_{quantile:g}": [] for quantile in quantiles})
+    for n_samples in checkpoints:
+        counts = np.bincount(inverse[:n_samples], minlength=len(rlzs))
+        drawn = counts > 0
+        weights = counts[drawn] / n_samples
+        mean = np.tensordot(weights, poes[drawn], axes=1)
+        variance = np.tensordot(weights, (poes[drawn] - mean) ** 2, axes=1)
+        std_error = np.sqrt(variance / n_samples)
+        table["n_samples"].append(n_samples)
+        table["n_realizations"].append(int(drawn.sum()))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            table["max_std_error"].append(_largest(std_error / mean, compared))
+        table["max_change_mean"].append(
+            _largest(_relative_change(mean, final[0]), compared)
+        )
+        estimates = weighted_quantiles(poes[drawn], weights, quantiles)
+        for quantile, estimate, reference in zip(quantiles, estimates, final[1:]):
+            table[f"max_change_{quantile:g}"].append(
+                _largest(
+                    _relative_change(estimate, reference), compared & (reference > 0)
+                )
+            )
+    return {column: np.array(values) for column, values in table.items()}
@@ -0,0 +1,281 @@
+"""Read the configuration of an OpenQuake job (``job.ini``).
+
+The file is parsed once per process into a frozen :class:`JobConfig`, shared
+by every module reading the same ``job.ini`` until the file is modified.
+"""
+
+import configparser
+import json
+import os
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    parse_psha_filename,
+)
+from psha_disag_mod.drouet_curves import HazardCurves
+from psha_disag_mod.utils import imt_period, timed
+
+# Number of job.ini kept parsed, one per (path, modification time)
+JOB_CONFIG_CACHE_SIZE = 32
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    """The array, made read-only as it is shared by every user of a config."""
+    array.setflags(write=False)
+    return array
+
+
+def _floats(value: Optional[str]) -> np.ndarray:
+    """Array of a space separated list of numbers, e.g. ``poes = 0.002105 0.000404``."""
+    return _read_only(np.array(value.split() if value else [], dtype=float))
+
+
+def _sites(value: Optional[str]) -> np.ndarray:
+    """(lon, lat) of the ``sites`` of a job, e.g. ``5.73 45.19, 6.1 45.3``."""
+    if not value:
+        return _read_only(np.empty((0, 2)))
+    return _read_only(
+        np.array([site.split()[:2] for site in value.split(",")], dtype=float)
+    )
+
+
+def _boolean(value: Optional[str]) -> bool:
+    return value is not None and value.strip().lower() in ("true", "1", "yes")
+
+
+@dataclass(frozen=True)
+class JobConfig:
+    """Parameters of an OpenQuake job, with the lists of numbers as arrays.
+
+    The ``intensity_measure_types_and_levels`` are only decoded on the first
+    access to :attr:`imtls`.
+
+    Attributes:
+        path: absolute path of the ``job.ini``.
+        params: every parameter of the file as written, whatever its section.
+        number_of_logic_tree_samples: paths drawn in the logic trees, 0 when
+            every path is enumerated.
+        sites: (lon, lat) of the sites, shape (site, 2).
+        poes: PoEs of the hazard maps and UHS.
+        poes_disagg: PoEs of the disaggregation.
+        quantiles: levels of the ``quantile_hazard_curves``.
+    """
+
+    path: str
+    params: Dict[str, str] = field(repr=False)
+    description: str
+    calculation_mode: str
+    random_seed: Optional[int]
+    number_of_logic_tree_samples: int
+    sites: np.ndarray = field(repr=False)
+    investigation_time: float
+    poes: np.ndarray
+    poes_disagg: np.ndarray
+    quantiles: np.ndarray
+    area_source_discretization: Optional[float]
+    width_of_mfd_bin: Optional[float]
+    mag_bin_width: Optional[float]
+    distance_bin_width: Optional[float]
+    coordinate_bin_width: Optional[float]
+    num_epsilon_bins: Optional[int]
+    truncation_level: Optional[float]
+    maximum_distance: Optional[float]
+    minimum_magnitude: Optional[float]
+    individual_curves: bool
+
+    @classmethod
+    def from_params(cls, path: str, params: Dict[str, str]) -> "JobConfig":
+        """Config of the parameters of a ``job.ini``, converted to their types."""
+
+        def optional(name: str, kind=float):
+            return kind(params[name]) if params.get(name) else None
+
+        return cls(
+            path=path,
+            params=params,
+            description=params.get("description", ""),
+            calculation_mode=params.get("calculation_mode", ""),
+            random_seed=optional("random_seed", int),
+            number_of_logic_tree_samples=int(
+                params.get("number_of_logic_tree_samples") or 0
+            ),
+            sites=_sites(params.get("sites")),
+            investigation_time=float(params.get("investigation_time", 1.0)),
+            poes=_floats(params.get("poes")),
+            poes_disagg=_floats(params.get("poes_disagg")),
+            quantiles=_floats(params.get("quantile_hazard_curves")),
+            area_source_discretization=optional("area_source_discretization"),
+            width_of_mfd_bin=optional("width_of_mfd_bin"),
+            mag_bin_width=optional("mag_bin_width"),
+            distance_bin_width=optional("distance_bin_width"),
+            coordinate_bin_width=optional("coordinate_bin_width"),
+            num_epsilon_bins=optional("num_epsilon_bins", int),
+            truncation_level=optional("truncation_level"),
+            maximum_distance=optional("maximum_distance"),
+            minimum_magnitude=optional("minimum_magnitude"),
+            individual_curves=_boolean(params.get("individual_curves")),
+        )
+
+    @cached_property
+    def imtls(self) -> Dict[str, np.ndarray]:
+        """Intensity measure levels of each IMT, the IMTs sorted by period."""
+        levels = json.loads(self.params.get("intensity_measure_types_and_levels", "{}"))
+        return {
+            imt: _read_only(np.array(levels[imt], dtype=float))
+            for imt in sorted(levels, key=imt_period)
+        }
+
+    @property
+    def imts(self) -> List[str]:
+        """Intensity measure types, sorted by period."""
+        return list(self.imtls)
+
+    @cached_property
+    def distance_bin_edges(self) -> np.ndarray:
+        """Edges of the distance bins of the disaggregation, up to ``maximum_distance``."""
+        if self.distance_bin_width is None or self.maximum_distance is None:
+            return _read_only(np.empty(0))
+        n_bins = int(np.ceil(self.maximum_distance / self.distance_bin_width))
+        return _read_only(np.arange(n_bins + 1) * self.distance_bin_width)
+
+    @cached_property
+    def eps_bin_edges(self) -> np.ndarray:
+        """Edges of the epsilon bins of the disaggregation, within the truncation level."""
+        if self.num_epsilon_bins is None or self.truncation_level is None:
+            return _read_only(np.empty(0))
+        return _read_only(
+            np.linspace(
+                -self.truncation_level, self.truncation_level, self.num_epsilon_bins + 1
+            )
+        )
+
+    def mag_bin_edges(self, min_mag: float, max_mag: float) -> np.ndarray:
+        """Edges of the magnitude bins of the disaggregation covering some magnitudes.
+
+        OpenQuake aligns the edges on multiples of ``mag_bin_width``, from the
+        smallest to the largest magnitude of the ruptures.
+        """
+        width = self.mag_bin_width
+        first = np.floor(min_mag / width + 1e-9)
+        last = np.ceil(max_mag / width - 1e-9)
+        return np.arange(first, last + 1) * width
+
+    @property
+    def source_model_logic_tree(self) -> Optional[str]:
+        """Path of the ``source_model_logic_tree_file``."""
+        return self._relative_path("source_model_logic_tree_file")
+
+    @property
+    def gsim_logic_tree(self) -> Optional[str]:
+        """Path of the ``gsim_logic_tree_file``."""
+        return self._relative_path("gsim_logic_tree_file")
+
+    @property
+    def export_dir(self) -> Optional[str]:
+        """Path of the ``export_dir`` of the outputs."""
+        return self._relative_path("export_dir")
+
+    def _relative_path(self, name: str) -> Optional[str]:
+        if not self.params.get(name):
+            return None
+        return os.path.join(os.path.dirname(self.path), self.params[name])
+
+
+def parse_job_ini(text: str, path: str) -> JobConfig:
+    """Config of the content of a ``job.ini``, ``path`` locating the files it refers to."""
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text, source=path)
+    params = {}
+    for section in parser.sections():
+        params.update(parser[section])
+    return JobConfig.from_params(path, params)
+
+
+@lru_cache(maxsize=JOB_CONFIG_CACHE_SIZE)
+def _read_job_config(path: str, mtime_ns: int) -> JobConfig:
+    with open(path) as ini_file:
+        return parse_job_ini(ini_file.read(), path)
+
+
+def read_job_config(path: str) -> JobConfig:
+    """Read a ``job.ini``, parsed once per process as long as it is not modified.
+
+    Returns:
+        The same :class:`JobConfig` to every caller of the same file, so do
+        not modify its arrays.
+    """
+    path = os.path.abspath(path)
+    return _read_job_config(path, os.stat(path).st_mtime_ns)
+
+
+def _curve_levels(path: str) -> np.ndarray:
+    """Levels of the ``poe-<level>`` columns of a hazard curve file, read from its header only."""
+    with open(path) as csv_file:
+        csv_file.readline()
+        header = csv_file.readline().strip().split(",")
+    return np.array(
+        [float(name[len("poe-") :]) for name in header if name.startswith("poe-")]
+    )
+
+
+def _check_levels(config: JobConfig, imt: str, levels: np.ndarray, origin: str):
+    if imt not in config.imtls:
+        raise ValueError(f"{origin}: {imt} is not an IMT of {config.path}")
+    expected = config.imtls[imt]
+    if levels.shape != expected.shape or not np.allclose(
+        levels, expected, rtol=1e-6, atol=1e-9
+    ):
+        raise ValueError(
+            f"{origin}: the levels of {imt} differ from the ones of {config.path}"
+        )
+
+
+@timed
+def validate_export(
+    config: JobConfig,
+    export_dir: Optional[str] = None,
+    filenames: Optional[Sequence[str]] = None,
+):
+    """Check that the hazard curves of an export directory have the levels of the job.
+
+    Only the two first lines of the files are read, so a run which does not
+    match its ``job.ini`` fails before anything is loaded or plotted.
+
+    Args:
+        config: configuration of the job.
+        export_dir: folder of the CSV files, ``config.export_dir`` if not given.
+        filenames: listing of the directory (or a FilenameIndex of it).
+
+    Raises:
+        ValueError: if the IMT or the ``poe-<level>`` columns of a file are not
+            the ones of ``intensity_measure_types_and_levels``.
+    """
+    from psha_disag_mod.archive import is_archive, open_archive
+
+    export_dir = export_dir or config.export_dir
+    if is_archive(export_dir):
+        archive = open_archive(export_dir)
+        for seed in archive.index["curves"]:
+            validate_hazard_curves(config, archive.hazard_curves(seed=[int(seed)]))
+        return
+    if filenames is None:
+        filenames = FilenameIndex.from_directory(export_dir)
+    for filename in filter_filenames(filenames, "psha", type_filename=["curve"]):
+        _check_levels(
+            config,
+            parse_psha_filename(filename).type_acc,
+            _curve_levels(os.path.join(export_dir, filename)),
+            filename,
+        )
+
+
+def validate_hazard_curves(config: JobConfig, curves: HazardCurves):
+    """Check that loaded hazard curves have the levels of the job (see :func:`validate_export`)."""
+    for imt, imls in zip(curves.imts, curves.imls):
+        _check_levels(config, imt, imls[~np.isnan(imls)], "hazard curves")
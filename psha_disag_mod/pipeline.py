@@ -0,0 +1,163 @@
+"""Streaming stages to overlap the listing, the reading and the processing of files.
+
+An export directory on a network file system spends most of its time waiting
+on I/O while it is listed and its CSV files are read, and nothing is read
+while the figures are rendered. :func:`scan_directory` yields the matching
+filenames while the directory is walked, and :func:`stream_map` reads them in
+a pool of threads as they come, handing the results over as soon as they are
+parsed. The stages are linked by bounded queues: when a consumer falls
+behind, the readers stop, then the scan, so that the memory held in flight
+stays bounded whatever the number of files.
+"""
+
+import os
+import threading
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from psha_disag_mod.compartiment import filter_filenames
+from psha_disag_mod.utils import count
+
+# Threads reading the files, they mostly wait on I/O
+DEFAULT_READERS = 4
+# Items waiting between two stages
+QUEUE_SIZE = 64
+# Entries of a directory filtered at once by scan_directory
+SCAN_CHUNKSIZE = 256
+# Seconds between two checks of the cancellation of a blocked stage
+_POLL = 0.1
+
+_END = object()
+
+
+class _Failed(NamedTuple):
+    """Exception raised by a stage, handed over to the consumer."""
+
+    error: BaseException
+
+
+def scan_directory(
+    directory: str, calculation_mode: Optional[str] = None, **patterns
+) -> Iterator[str]:
+    """Names of the files of a directory matching patterns, as the directory is walked.
+
+    The names are filtered by chunks of :data:`SCAN_CHUNKSIZE` entries with
+    :func:`~psha_disag_mod.compartiment.filter_filenames`, and come in the
+    order of the directory, not sorted.
+
+    Args:
+        calculation_mode: "psha" or "disaggregation", every file if None.
+        patterns: patterns of ``filter_filenames``, e.g. ``type_filename=["curve"]``.
+    """
+    with os.scandir(directory) as entries:
+        chunk = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if calculation_mode is None:
+                yield entry.name
+                continue
+            chunk.append(entry.name)
+            if len(chunk) == SCAN_CHUNKSIZE:
+                yield from filter_filenames(chunk, calculation_mode, **patterns)
+                chunk = []
+        if chunk:
+            yield from filter_filenames(chunk, calculation_mode, **patterns)
+
+
+def _put(queue: Queue, item: Any, stop: threading.Event) -> bool:
+    """Wait for room in the queue, unless the stream is stopped."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_POLL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _get(queue: Queue, stop: threading.Event) -> Any:
+    """Wait for an item of the queue, :data:`_END` if the stream is stopped."""
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=_POLL)
+        except Empty:
+            continue
+    return _END
+
+
+def stream_map(
+    function: Callable,
+    items: Iterable,
+    workers: int = DEFAULT_READERS,
+    maxsize: int = QUEUE_SIZE,
+) -> Iterator[Tuple[Any, Any]]:
+    """Apply a function to items in a pool of threads, while the items are produced.
+
+    One thread iterates over the ``items`` (e.g. :func:`scan_directory`) and
+    hands them to the ``workers`` threads through a queue of ``maxsize``
+    items, the results come back through another one. At most
+    ``2 * maxsize + workers`` items are then in flight: a slow consumer
+    blocks the workers, which block the iteration over the items. Leaving
+    the loop over the results stops every thread, and the first exception
+    raised by ``function`` or by the iteration over the items is raised again
+    by the loop, which stops it too.
+
+    Yields:
+        ``(item, function(item))``, in the order of completion.
+
+    Raises:
+        ValueError: if there are no ``workers``.
+    """
+    if workers < 1:
+        raise ValueError(f"stream_map needs at least one worker, not {workers}")
+    inputs: Queue = Queue(maxsize)
+    outputs: Queue = Queue(maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(inputs, item, stop):
+                    return
+        except BaseException as error:
+            _put(outputs, _Failed(error), stop)
+        finally:
+            for _ in range(workers):
+                _put(inputs, _END, stop)
+
+    def work():
+        try:
+            while True:
+                item = _get(inputs, stop)
+                if item is _END:
+                    return
+                try:
+                    result = (item, function(item))
+                except BaseException as error:
+                    result = _Failed(error)
+                if not _put(outputs, result, stop):
+                    return
+                count("pipeline.items")
+        finally:
+            _put(outputs, _END, stop)
+
+    threads = [threading.Thread(target=produce, daemon=True)] + [
+        threading.Thread(target=work, daemon=True) for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        running = workers
+        while running:
+            result = outputs.get()
+            if result is _END:
+                running -= 1
+            elif isinstance(result, _Failed):
+                raise result.error
+            else:
+                yield result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
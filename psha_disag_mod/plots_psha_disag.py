@@ -0,0 +1,894 @@
+"""Plot the results of OpenQuake: hazard curves, UHS and Magnitude-Distance disaggregation.
+
+Every figure is described by a :class:`FigureJob`: a render function, the path
+of the PNG and only the arrays it needs. The jobs of a whole run can then be
+rendered serially or fanned out over a pool of processes by :func:`render_jobs`,
+each process drawing all the figures of a kind on one :class:`FigureTemplate`.
+
+Figures are written in ``<plot_dir>/curve``, ``<plot_dir>/uhs`` and
+``<plot_dir>/disag``. A
+:class:`PlotManifest` in ``<plot_dir>`` keeps the hash of the inputs of each
+figure, so that a rebuild only renders the figures whose inputs changed.
+"""
+
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+)
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (registers the 3d projection)
+
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    is_disag_filename,
+    is_psha_filename,
+    parse_psha_filename,
+    read_disag_params,
+)
+from psha_disag_mod.disag_analytics import marginal_poes
+from psha_disag_mod.disaggregation import (
+    DisaggregationMatrix,
+    find_mag_dist_file,
+    read_disaggregation,
+)
+from psha_disag_mod.drouet_curves import (
+    HazardCurves,
+    assemble_hazard_curves,
+    load_hazard_curves,
+    read_hazard_curve,
+    uniform_hazard_spectra,
+)
+from psha_disag_mod.metadata_ini import JobConfig, read_job_config, validate_export
+from psha_disag_mod.pipeline import (
+    DEFAULT_READERS,
+    QUEUE_SIZE,
+    scan_directory,
+    stream_map,
+)
+from psha_disag_mod.sites import Nearest, SiteSelection, WithinRadius
+from psha_disag_mod.utils import (
+    content_hash,
+    imt_frequency,
+    profiling,
+    return_period,
+    timed,
+)
+
+FONT = {"font.family": "serif", "font.size": 12}
+TITLE_FONT = {"fontsize": 16, "fontweight": "bold"}
+LABEL_FONT = {"fontsize": 15}
+
+# Kinds of figures of a run, also the names of their folders in the plot directory
+FIGURE_KINDS = ("curve", "uhs", "disag")
+
+MANIFEST_FILENAME = ".manifest.json"
+# Change it when the look of the figures changes, to render them all again
+MANIFEST_VERSION = 1
+
+
+class FigureJob(NamedTuple):
+    """A figure to render: ``render(path, **data)``."""
+
+    render: Callable
+    path: str
+    data: Dict[str, Any]
+
+    def hash(self) -> str:
+        """Digest of the render function and of the data of the figure."""
+        return content_hash(
+            [self.render.__module__, self.render.__qualname__, self.data]
+        )
+
+
+def curve_filename(imt: Optional[str] = None) -> str:
+    """Name of the hazard curve figure of an IMT, or of all the IMTs if None."""
+    if imt is None:
+        return "hazard_curve_all_type_acc_plot.png"
+    return f"hazard_curve_all_type_data_{imt}_plot.png"
+
+
+def uhs_filename(poe: float, investigation_time: float = 1.0) -> str:
+    """Name of the UHS figure of a PoE, after its return period."""
+    return f"hazard_uhs_{return_period(poe, investigation_time):.0f}_plot.png"
+
+
+def disag_filename(poe: float, imt: str) -> str:
+    """Name of the Magnitude-Distance disaggregation figure of a PoE and an IMT."""
+    return f"disagg_Mag_Dist_hist3Dplot_{poe:g}_{imt}.png"
+
+
+def type_data_style(type_data: str) -> Dict[str, Any]:
+    """Label and line style of a kind of curve (mean, quantile or realization)."""
+    if type_data == "mean":
+        return {"label": "mean", "color": "red", "linestyle": "-"}
+    if type_data.startswith("rlz-"):
+        return {"color": "grey", "linestyle": "-", "linewidth": 0.5}
+    linestyle = "-" if float(type_data) == 0.5 else "--"
+    return {"label": f"quantile {type_data}", "color": "black", "linestyle": linestyle}
+
+
+def _new_figure(**subplot_kw) -> Figure:
+    figure = Figure(figsize=(12.8, 7.2))
+    FigureCanvasAgg(figure)
+    figure.add_subplot(**subplot_kw)
+    return figure
+
+
+class FigureTemplate:
+    """Skeleton of a kind of figure (axes, scales, labels, grid), to draw many figures on.
+
+    The skeleton is built once, each figure then only replaces the data
+    artists (lines, bars, legend) and the title of the previous one, instead
+    of building a new figure, axes and labels.
+    """
+
+    def __init__(self, build: Callable[[Figure], None], **subplot_kw):
+        with matplotlib.rc_context(FONT):
+            self.figure = _new_figure(**subplot_kw)
+            build(self.figure.axes[0])
+
+    def clear(self) -> Figure:
+        """Remove the data of the previous figure, and give the skeleton."""
+        ax = self.figure.axes[0]
+        for artist in [*ax.lines, *ax.collections, *ax.patches]:
+            artist.remove()
+        if ax.legend_ is not None:
+            ax.legend_.remove()
+        ax.set_prop_cycle(None)
+        return self.figure
+
+
+# Templates of the figures rendered by the process, per kind of figure
+_TEMPLATES: Dict[str, FigureTemplate] = {}
+
+
+def _skeleton(
+    kind: str, build: Callable[[Figure], None], template: bool, **subplot_kw
+) -> Figure:
+    """Figure of a kind, built from scratch or from the template of the process."""
+    if not template:
+        figure = _new_figure(**subplot_kw)
+        build(figure.axes[0])
+        return figure
+    if kind not in _TEMPLATES:
+        _TEMPLATES[kind] = FigureTemplate(build, **subplot_kw)
+    return _TEMPLATES[kind].clear()
+
+
+def _curves_skeleton(ax):
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("Acc. [g]", **LABEL_FONT)
+    ax.set_ylabel("Annual Probability of exceedance", **LABEL_FONT)
+    ax.grid(True)
+
+
+def _uhs_skeleton(ax):
+    ax.set_xscale("log")
+    ax.set_xlabel("Frequency [Hz]", **LABEL_FONT)
+    ax.set_ylabel("Acceleration [g]", **LABEL_FONT)
+    ax.grid(True)
+
+
+def _disag_skeleton(ax):
+    ax.set_xlabel("Magnitude")
+    ax.set_ylabel("Distance [km]")
+    ax.set_zlabel("Contribution")
+
+
+def _finish_lines(ax, title: str):
+    """Title, legend and limits of axes of lines, for their current lines."""
+    ax.set_title(title, **TITLE_FONT)
+    if ax.get_legend_handles_labels()[0]:
+        ax.legend()
+    ax.relim()
+    ax.autoscale_view()
+
+
+@timed
+def render_hazard_curves(
+    path: str,
+    imls: Dict[str, np.ndarray],
+    poes: Dict[str, np.ndarray],
+    styles: Dict[str, Dict[str, Any]],
+    title: str,
+    template: bool = False,
+):
+    """Draw hazard curves on log-log axes, one line per key of ``poes``.
+
+    Args:
+        imls: intensity measure levels of each curve.
+        poes: annual probabilities of exceedance of each curve.
+        styles: keyword arguments of ``loglog`` for each curve.
+        template: draw on the :class:`FigureTemplate` of the hazard curves of
+            the process, rather than on a new figure.
+    """
+    with matplotlib.rc_context(FONT):
+        figure = _skeleton("curve", _curves_skeleton, template)
+        ax = figure.axes[0]
+        for key, curve in poes.items():
+            ax.plot(imls[key], curve, **styles[key])
+        _finish_lines(
+            ax,
+            f"Annual Probability of exceedance in function of acceleration\n{title}",
+        )
+        figure.savefig(path, bbox_inches="tight")
+
+
+@timed
+def render_uhs(
+    path: str,
+    frequencies: np.ndarray,
+    accelerations: Dict[str, np.ndarray],
+    styles: Dict[str, Dict[str, Any]],
+    title: str,
+    template: bool = False,
+):
+    """Draw uniform hazard spectra, one line per key of ``accelerations``.
+
+    Args:
+        frequencies: frequencies of the IMTs of the spectra.
+        accelerations: spectral accelerations of each spectrum.
+        styles: keyword arguments of ``semilogx`` for each spectrum.
+        template: see :func:`render_hazard_curves`.
+    """
+    order = np.argsort(frequencies)
+    with matplotlib.rc_context(FONT):
+        figure = _skeleton("uhs", _uhs_skeleton, template)
+        ax = figure.axes[0]
+        for key, spectrum in accelerations.items():
+            ax.plot(frequencies[order], spectrum[order], **styles[key])
+        _finish_lines(ax, f"Uniformed Hazard (response) Spectra\n{title}")
+        figure.savefig(path, bbox_inches="tight")
+
+
+@timed
+def render_disag_mag_dist(
+    path: str,
+    mag_bin_edges: np.ndarray,
+    dist_bin_edges: np.ndarray,
+    contributions: np.ndarray,
+    poe: float,
+    imt: str,
+    investigation_time: float = 1.0,
+    template: bool = False,
+):
+    """Draw the 3D histogram of the contributions of the Magnitude-Distance bins.
+
+    Args:
+        contributions: probabilities of exceedance of the bins, shape (mag, dist).
+        template: draw on the :class:`FigureTemplate` of the 3D histograms of
+            the process, only the bars and the title are then new.
+    """
+    mag_width = np.diff(mag_bin_edges)
+    dist_width = np.diff(dist_bin_edges)
+    mags, dists = np.meshgrid(mag_bin_edges[:-1], dist_bin_edges[:-1], indexing="ij")
+    dmags, ddists = np.meshgrid(mag_width, dist_width, indexing="ij")
+    nonzero = contributions > 0
+    heights = contributions[nonzero]
+    colors = matplotlib.colormaps["rainbow"](
+        heights / heights.max() if heights.size else heights
+    )
+
+    with matplotlib.rc_context(FONT):
+        figure = _skeleton("disag", _disag_skeleton, template, projection="3d")
+        ax = figure.axes[0]
+        ax.bar3d(
+            mags[nonzero] + 0.1 * dmags[nonzero],
+            dists[nonzero] + 0.1 * ddists[nonzero],
+            np.zeros_like(heights),
+            0.8 * dmags[nonzero],
+            0.8 * ddists[nonzero],
+            heights,
+            color=colors,
+        )
+        ax.set_title(
+            f"Return period : {return_period(poe, investigation_time):.0f} years\n"
+            "Seismic Hazard Weight in function of Magnitude and Distance\n"
+            f"F = {imt_frequency(imt):.2f} Hz"
+        )
+        figure.savefig(path, bbox_inches="tight")
+
+
+def imt_curve_job(
+    curves: HazardCurves, imt: str, plot_dir: str, site: int = 0
+) -> Optional[FigureJob]:
+    """Figure of every kind of hazard curve of an IMT at a site, None if it has none."""
+    i_imt = curves.imts.index(imt)
+    poes = {
+        type_data: curves.poes[i_data, i_imt, site]
+        for i_data, type_data in enumerate(curves.type_datas)
+        if not np.isnan(curves.poes[i_data, i_imt, site]).all()
+    }
+    if not poes:
+        return None
+    return FigureJob(
+        render_hazard_curves,
+        os.path.join(plot_dir, "curve", curve_filename(imt)),
+        {
+            "imls": {key: curves.imls[i_imt] for key in poes},
+            "poes": poes,
+            "styles": {key: type_data_style(key) for key in poes},
+            "title": imt,
+        },
+    )
+
+
+def mean_curves_job(
+    curves: HazardCurves, plot_dir: str, site: int = 0
+) -> Optional[FigureJob]:
+    """Figure of the mean hazard curves of all the IMTs at a site, None without means."""
+    if "mean" not in curves.type_datas:
+        return None
+    means = curves.poes[curves.type_datas.index("mean"), :, site]
+    poes = {
+        imt: means[i_imt]
+        for i_imt, imt in enumerate(curves.imts)
+        if not np.isnan(means[i_imt]).all()
+    }
+    if not poes:
+        return None
+    return FigureJob(
+        render_hazard_curves,
+        os.path.join(plot_dir, "curve", curve_filename()),
+        {
+            "imls": {imt: curves.imls[curves.imts.index(imt)] for imt in poes},
+            "poes": poes,
+            "styles": {imt: {"label": imt} for imt in poes},
+            "title": "mean",
+        },
+    )
+
+
+@timed
+def hazard_curve_jobs(
+    curves: HazardCurves, plot_dir: str, site: int = 0
+) -> List[FigureJob]:
+    """Figures of the hazard curves of a site: one per IMT and one for all the IMTs."""
+    jobs = [imt_curve_job(curves, imt, plot_dir, site) for imt in curves.imts]
+    jobs.append(mean_curves_job(curves, plot_dir, site))
+    return [job for job in jobs if job is not None]
+
+
+@timed
+def uhs_jobs(
+    curves: HazardCurves,
+    poes: Sequence[float],
+    plot_dir: str,
+    site: int = 0,
+    investigation_time: float = 1.0,
+) -> List[FigureJob]:
+    """Figures of the uniform hazard spectra of a site: one per PoE.
+
+    The spectra are interpolated from the hazard curves (see
+    :func:`~psha_disag_mod.drouet_curves.uniform_hazard_spectra`), so any PoE
+    can be drawn, not only the ones exported by OpenQuake.
+    """
+    spectra = uniform_hazard_spectra(curves, poes)[:, site]
+    frequencies = np.array([imt_frequency(imt) for imt in curves.imts])
+    jobs = []
+    for i_poe, poe in enumerate(poes):
+        accelerations = {
+            type_data: spectra[i_data, i_poe]
+            for i_data, type_data in enumerate(curves.type_datas)
+            if not np.isnan(spectra[i_data, i_poe]).any()
+        }
+        if accelerations:
+            jobs.append(
+                FigureJob(
+                    render_uhs,
+                    os.path.join(
+                        plot_dir, "uhs", uhs_filename(poe, investigation_time)
+                    ),
+                    {
+                        "frequencies": frequencies,
+                        "accelerations": accelerations,
+                        "styles": {key: type_data_style(key) for key in accelerations},
+                        "title": f"{return_period(poe, investigation_time):.0f} years",
+                    },
+                )
+            )
+    return jobs
+
+
+def mag_dist_contributions(matrix: DisaggregationMatrix) -> np.ndarray:
+    """Magnitude-Distance contributions averaged over the realizations with their weights.
+
+    Returns:
+        Array of shape (imt, poe, mag, dist).
+    """
+    return np.average(
+        marginal_poes(matrix, ["Mag", "Dist"]), axis=-1, weights=matrix.weights
+    )
+
+
+@timed
+def disag_jobs(matrix: DisaggregationMatrix, plot_dir: str) -> List[FigureJob]:
+    """Figures of a Magnitude-Distance disaggregation: one per PoE and IMT."""
+    contributions = mag_dist_contributions(matrix)
+    investigation_time = matrix.metadata.get("investigation_time", 1.0)
+    jobs = []
+    for i_poe, poe in enumerate(matrix.poes):
+        for i_imt, imt in enumerate(matrix.imts):
+            jobs.append(
+                FigureJob(
+                    render_disag_mag_dist,
+                    os.path.join(plot_dir, "disag", disag_filename(poe, imt)),
+                    {
+                        "mag_bin_edges": matrix.bin_edges["Mag"],
+                        "dist_bin_edges": matrix.bin_edges["Dist"],
+                        "contributions": contributions[i_imt, i_poe],
+                        "poe": float(poe),
+                        "imt": imt,
+                        "investigation_time": investigation_time,
+                    },
+                )
+            )
+    return jobs
+
+
+def _use_agg_backend():
+    matplotlib.use("Agg")
+
+
+def _render(job: FigureJob, templates: bool = True) -> str:
+    job.render(job.path, template=templates, **job.data)
+    return job.path
+
+
+@timed
+def render_jobs(
+    jobs: Sequence[FigureJob], workers: Optional[int] = 1, templates: bool = True
+) -> List[str]:
+    """Render figures, serially or in a pool of processes.
+
+    Args:
+        jobs: figures to render, their folders are created if needed.
+        workers: number of processes, all the cores if None, no pool if 1.
+        templates: draw the figures of a kind on one :class:`FigureTemplate`
+            per process, rather than each on a new figure. The images are
+            the same, the axes and labels are only built once.
+
+    Returns:
+        The paths of the figures, in the order of the jobs.
+    """
+    for directory in {os.path.dirname(job.path) for job in jobs}:
+        os.makedirs(directory, exist_ok=True)
+    render = partial(_render, templates=templates)
+    if workers == 1 or len(jobs) <= 1:
+        return [render(job) for job in jobs]
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_use_agg_backend
+    ) as executor:
+        return list(executor.map(render, jobs))
+
+
+class PlotManifest:
+    """Hash of the inputs of each figure of a plot folder, saved in ``.manifest.json``."""
+
+    def __init__(self, plot_dir: str):
+        self.plot_dir = plot_dir
+        self.path = os.path.join(plot_dir, MANIFEST_FILENAME)
+        self.hashes: Dict[str, str] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                content = json.load(manifest_file)
+            if content.get("version") == MANIFEST_VERSION:
+                self.hashes = content["figures"]
+
+    def _key(self, job: FigureJob) -> str:
+        return os.path.relpath(job.path, self.plot_dir)
+
+    def is_fresh(self, job: FigureJob) -> bool:
+        """Whether the figure exists and was rendered from the same inputs."""
+        return (
+            os.path.exists(job.path) and self.hashes.get(self._key(job)) == job.hash()
+        )
+
+    def stale_jobs(self, jobs: Sequence[FigureJob]) -> List[FigureJob]:
+        """Jobs whose figure is missing or outdated."""
+        return [job for job in jobs if not self.is_fresh(job)]
+
+    def update(self, jobs: Sequence[FigureJob]):
+        """Record the jobs as rendered."""
+        for job in jobs:
+            self.hashes[self._key(job)] = job.hash()
+
+    def save(self):
+        os.makedirs(self.plot_dir, exist_ok=True)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(
+                {"version": MANIFEST_VERSION, "figures": self.hashes},
+                manifest_file,
+                indent=1,
+                sort_keys=True,
+            )
+        os.replace(temporary_path, self.path)
+
+
+@timed
+def render_stale_jobs(
+    jobs: Sequence[FigureJob],
+    plot_dir: str,
+    workers: Optional[int] = 1,
+    force: bool = False,
+    templates: bool = True,
+) -> List[str]:
+    """Render only the figures whose inputs changed since the last rendering.
+
+    Args:
+        jobs: figures of the plot folder.
+        plot_dir: folder of the figures, where the manifest is kept.
+        force: render every figure anyway.
+        templates: see :func:`render_jobs`.
+
+    Returns:
+        The paths of the rendered figures.
+    """
+    manifest = PlotManifest(plot_dir)
+    stale = list(jobs) if force else manifest.stale_jobs(jobs)
+    paths = render_jobs(stale, workers=workers, templates=templates)
+    manifest.update(stale)
+    manifest.save()
+    return paths
+
+
+def site_plot_dir(plot_dir: str, sites: Sequence[int], site: int) -> str:
+    """Folder of the figures of a site, its own one when several sites are drawn."""
+    return plot_dir if len(sites) == 1 else os.path.join(plot_dir, f"site-{site}")
+
+
+@timed
+def run_jobs(
+    export_dir: str,
+    plot_dir: str,
+    site: SiteSelection = 0,
+    filenames: Optional[FilenameIndex] = None,
+    poes: Optional[Sequence[float]] = None,
+    config: Optional[JobConfig] = None,
+    kinds: Sequence[str] = FIGURE_KINDS,
+) -> List[FigureJob]:
+    """Figures of every hazard curve and Magnitude-Distance disaggregation of a run.
+
+    The UHS of the ``poes`` are drawn too if given, by default the ``poes``
+    of the ``config`` of the job. With a ``config``, the levels of the
+    curves are checked against it before anything is loaded.
+
+    Args:
+        site: index of a site, indices or a spatial query of sites (see
+            :data:`~psha_disag_mod.sites.SiteSelection`). When several sites
+            are selected, the figures of each go to ``<plot_dir>/site-<index>``.
+        kinds: kinds of figures to draw, among :data:`FIGURE_KINDS`.
+    """
+    if filenames is None:
+        filenames = FilenameIndex.from_directory(export_dir)
+    if config is not None:
+        validate_export(config, export_dir, filenames)
+        if poes is None:
+            poes = config.poes.tolist()
+    curves = load_hazard_curves(export_dir, filenames)
+    investigation_time = next(iter(curves.metadata.values()), {}).get(
+        "investigation_time", 1.0
+    )
+    sites = curves.site_table.select(site).tolist()
+    jobs = []
+    for i_site in sites:
+        site_dir = site_plot_dir(plot_dir, sites, i_site)
+        if "curve" in kinds:
+            jobs.extend(hazard_curve_jobs(curves, site_dir, site=i_site))
+        if poes and "uhs" in kinds:
+            jobs.extend(uhs_jobs(curves, poes, site_dir, i_site, investigation_time))
+        if "disag" not in kinds:
+            continue
+        path = find_mag_dist_file(export_dir, i_site, filenames)
+        if path is not None:
+            if config is not None:
+                matrix = read_disaggregation(
+                    path, config.imts, config.poes_disagg, use_cache=True
+                )
+            else:
+                matrix = read_disaggregation(path, use_cache=True)
+            jobs.extend(disag_jobs(matrix, site_dir))
+    return jobs
+
+
+@timed
+def plot_run(
+    export_dir: str,
+    plot_dir: str,
+    site: SiteSelection = 0,
+    workers: Optional[int] = 1,
+    force: bool = False,
+    poes: Optional[Sequence[float]] = None,
+    job_ini: Optional[str] = None,
+    profile: Optional[str] = None,
+    kinds: Sequence[str] = FIGURE_KINDS,
+    stream: bool = False,
+) -> List[str]:
+    """Render the figures of a run (see :func:`run_jobs`) with ``workers`` processes.
+
+    Only the figures whose inputs changed since the last call are rendered,
+    unless ``force`` is set (see :func:`render_stale_jobs`). The ``job.ini``
+    of the run, if given, is checked against the outputs and gives the
+    PoEs of the UHS.
+
+    Args:
+        profile: JSON file where the time spent in each stage of the run is
+            written (see :func:`~psha_disag_mod.utils.profiling`), a Chrome
+            trace if it ends with ``.trace.json``. The figures rendered by
+            worker processes only count in ``render_jobs``.
+        kinds: kinds of figures to draw, among :data:`FIGURE_KINDS`.
+        stream: overlap the scan of the directory, the reading of the files
+            and the rendering, see :func:`stream_plot_run`.
+
+    Returns:
+        The paths of the rendered figures.
+    """
+    config = read_job_config(job_ini) if job_ini else None
+    with profiling(profile) if profile else nullcontext():
+        if stream:
+            return stream_plot_run(
+                export_dir,
+                plot_dir,
+                site=site,
+                workers=workers,
+                force=force,
+                poes=poes,
+                config=config,
+                kinds=kinds,
+            )
+        return render_stale_jobs(
+            run_jobs(
+                export_dir,
+                plot_dir,
+                site=site,
+                poes=poes,
+                config=config,
+                kinds=kinds,
+            ),
+            plot_dir,
+            workers=workers,
+            force=force,
+        )
+
+
+class _RunInput(NamedTuple):
+    """File of a run to read: a hazard curve of an IMT or a disaggregation of a site."""
+
+    kind: str
+    filename: str
+    key: Union[str, int]
+
+
+class _ScanEnd(NamedTuple):
+    """Last input of a scan, with the number of hazard curve files of each IMT."""
+
+    imt_files: Dict[str, int]
+
+
+def _scan_run(
+    export_dir: str, sites: Sequence[int], kinds: Sequence[str]
+) -> Iterator[Union[_RunInput, _ScanEnd]]:
+    """Files of a run to read for the figures, as the directory is walked.
+
+    A ``Mag_Dist_Eps`` disaggregation is only read, at the end of the scan,
+    for the sites without ``Mag_Dist`` one (see
+    :func:`~psha_disag_mod.disaggregation.find_mag_dist_file`).
+    """
+    imt_files: Dict[str, int] = {}
+    mag_dist: Dict[int, str] = {}
+    mag_dist_eps: Dict[int, str] = {}
+    with_curves = "curve" in kinds or "uhs" in kinds
+    for filename in scan_directory(export_dir):
+        if with_curves and is_psha_filename(filename):
+            params = parse_psha_filename(filename)
+            if params.type_filename == "curve":
+                imt_files[params.type_acc] = imt_files.get(params.type_acc, 0) + 1
+                yield _RunInput("curve", filename, params.type_acc)
+        elif "disag" in kinds and is_disag_filename(filename):
+            params = read_disag_params(filename)
+            site = params["site"]
+            if site not in sites:
+                continue
+            if params["disaggregation_axes"] == ["Mag", "Dist"]:
+                if site not in mag_dist:
+                    mag_dist[site] = filename
+                    yield _RunInput("disag", filename, site)
+            elif params["disaggregation_axes"] == ["Mag", "Dist", "Eps"]:
+                mag_dist_eps.setdefault(site, filename)
+    for site, filename in mag_dist_eps.items():
+        if site not in mag_dist:
+            yield _RunInput("disag", filename, site)
+    yield _ScanEnd(imt_files)
+
+
+def _read_run_input(
+    item: Union[_RunInput, _ScanEnd],
+    export_dir: str,
+    sites: Sequence[int],
+    config: Optional[JobConfig],
+):
+    """Curves of the selected sites, or disaggregation matrix of a file of a run."""
+    if isinstance(item, _ScanEnd):
+        return None
+    path = os.path.join(export_dir, item.filename)
+    if item.kind == "curve":
+        metadata, file_sites, imls, poes = read_hazard_curve(path)
+        if max(sites) >= len(file_sites):
+            raise IndexError(f"Sites {sites} out of the {len(file_sites)} sites")
+        return metadata, file_sites[sites], imls, poes[sites]
+    if config is not None:
+        return read_disaggregation(
+            path, config.imts, config.poes_disagg, use_cache=True
+        )
+    return read_disaggregation(path, use_cache=True)
+
+
+class _StreamRenderer:
+    """Renders the stale figures as they come, with at most 2 jobs per process pending."""
+
+    def __init__(self, plot_dir: str, workers: Optional[int], force: bool):
+        self.manifest = PlotManifest(plot_dir)
+        self.force = force
+        self.rendered: List[FigureJob] = []
+        self.pending: set = set()
+        self.executor = None
+        if workers != 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_use_agg_backend
+            )
+        self.limit = 2 * (workers or os.cpu_count() or 1)
+
+    def submit(self, jobs: Sequence[Optional[FigureJob]]):
+        for job in jobs:
+            if job is None or (not self.force and self.manifest.is_fresh(job)):
+                continue
+            os.makedirs(os.path.dirname(job.path), exist_ok=True)
+            self.rendered.append(job)
+            if self.executor is None:
+                _render(job)
+                continue
+            if len(self.pending) >= self.limit:
+                done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            self.pending.add(self.executor.submit(_render, job))
+
+    def finish(self) -> List[str]:
+        """Wait for the figures, and record them in the manifest."""
+        for future in self.pending:
+            future.result()
+        self.manifest.update(self.rendered)
+        self.manifest.save()
+        return [job.path for job in self.rendered]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+@timed
+def stream_plot_run(
+    export_dir: str,
+    plot_dir: str,
+    site: SiteSelection = 0,
+    workers: Optional[int] = 1,
+    force: bool = False,
+    poes: Optional[Sequence[float]] = None,
+    config: Optional[JobConfig] = None,
+    kinds: Sequence[str] = FIGURE_KINDS,
+    readers: int = DEFAULT_READERS,
+    maxsize: int = QUEUE_SIZE,
+) -> List[str]:
+    """Render the figures of a run while its directory is scanned and its files read.
+
+    Same figures as :func:`plot_run`, drawn as soon as their inputs are read:
+    the disaggregation figures of a site once its file is parsed, the figure
+    of an IMT once the scan is over and all its curves are parsed, the UHS
+    and the mean curves of all the IMTs at the end. The files are read by
+    ``readers`` threads (see :func:`~psha_disag_mod.pipeline.stream_map`)
+    and only the rows of the selected sites are kept. The export is not
+    checked against the ``config``, as it is never listed as a whole. An
+    archive, already indexed, and the sites of a spatial query, which needs
+    the sites of the run beforehand, are drawn by :func:`run_jobs` instead.
+
+    Args:
+        site: index, indices or a spatial query of the sites, see :func:`run_jobs`.
+        workers: number of processes rendering the figures, all the cores if
+            None, no pool if 1 (the figures are then rendered while the
+            readers read the next files).
+        readers: number of threads reading the files.
+        maxsize: number of files waiting to be read, and of read files
+            waiting to be drawn.
+
+    Returns:
+        The paths of the rendered figures, in the order they were submitted.
+    """
+    from psha_disag_mod.archive import is_archive
+
+    if is_archive(export_dir) or isinstance(site, (Nearest, WithinRadius)):
+        return render_stale_jobs(
+            run_jobs(export_dir, plot_dir, site, poes=poes, config=config, kinds=kinds),
+            plot_dir,
+            workers=workers,
+            force=force,
+        )
+    if config is not None and poes is None:
+        poes = config.poes.tolist()
+    sites = np.atleast_1d(np.asarray(site, dtype=int)).tolist()
+    site_dirs = [site_plot_dir(plot_dir, sites, i_site) for i_site in sites]
+    # Curves of the selected sites read so far, per IMT
+    curve_files: Dict[str, Dict[str, tuple]] = {}
+    imt_files: Optional[Dict[str, int]] = None
+    drawn_imts = set()
+    renderer = _StreamRenderer(plot_dir, workers, force)
+    try:
+        for item, result in stream_map(
+            partial(_read_run_input, export_dir=export_dir, sites=sites, config=config),
+            _scan_run(export_dir, sites, kinds),
+            workers=readers,
+            maxsize=maxsize,
+        ):
+            if isinstance(item, _ScanEnd):
+                imt_files = item.imt_files
+            elif item.kind == "disag":
+                renderer.submit(disag_jobs(result, site_dirs[sites.index(item.key)]))
+                continue
+            else:
+                curve_files.setdefault(item.key, {})[item.filename] = result
+            if imt_files is None or "curve" not in kinds:
+                continue
+            for imt, files in curve_files.items():
+                if imt not in drawn_imts and len(files) == imt_files[imt]:
+                    curves = _assemble(files)
+                    renderer.submit(
+                        [
+                            imt_curve_job(curves, imt, site_dir, i)
+                            for i, site_dir in enumerate(site_dirs)
+                        ]
+                    )
+                    drawn_imts.add(imt)
+        if curve_files:
+            curves = _assemble(
+                {
+                    filename: read
+                    for files in curve_files.values()
+                    for filename, read in files.items()
+                }
+            )
+            investigation_time = next(iter(curves.metadata.values()), {}).get(
+                "investigation_time", 1.0
+            )
+            for i, site_dir in enumerate(site_dirs):
+                if "curve" in kinds:
+                    renderer.submit([mean_curves_job(curves, site_dir, i)])
+                if poes and "uhs" in kinds:
+                    renderer.submit(
+                        uhs_jobs(curves, poes, site_dir, i, investigation_time)
+                    )
+        return renderer.finish()
+    finally:
+        renderer.close()
+
+
+def _assemble(files: Dict[str, tuple]) -> HazardCurves:
+    """Curves of files read by :func:`_read_run_input`, in the order of their names."""
+    filenames = sorted(files)
+    return assemble_hazard_curves(filenames, [files[name] for name in filenames])
@@ -0,0 +1,512 @@
+"""Post-process one run of OpenQuake under several variants (scenarios).
+
+A :class:`ScenarioSpec` selects the PoEs, IMTs and sites of a variant and may
+reweight the branches of the logic trees. :func:`run_sweep` loads the outputs
+needed by all the scenarios of a sweep once, shares their arrays with a pool
+of processes and caches the result of each scenario under the hash of its
+spec, so that only the new scenarios of a sweep are computed again.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field, fields, replace
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from psha_disag_mod.archive import is_archive
+from psha_disag_mod.compartiment import FilenameIndex, filter_filenames
+from psha_disag_mod.disag_analytics import marginal_poes
+from psha_disag_mod.disaggregation import (
+    DisaggregationMatrix,
+    find_mag_dist_file,
+    read_disaggregation,
+)
+from psha_disag_mod.drouet_curves import (
+    HazardCurves,
+    load_hazard_curves,
+    logic_tree_statistics,
+    uniform_hazard_spectra,
+)
+from psha_disag_mod.euro_xml import (
+    LogicTreeBranch,
+    read_logic_tree,
+    realization_weights,
+)
+from psha_disag_mod.metadata_ini import JobConfig, read_job_config
+from psha_disag_mod.utils import (
+    cache_dir,
+    content_hash,
+    files_key,
+    profiling,
+    timed,
+)
+
+
+@dataclass(frozen=True)
+class ScenarioSpec:
+    """A variant of the post-processing of a run.
+
+    Attributes:
+        name: label of the scenario, not part of its hash.
+        poes: PoEs of the UHS and of the disaggregation, the ``poes`` of
+            ``job.ini`` if empty.
+        imts: intensity measure types, all of them if None.
+        sites: indices of the sites, all of them if None.
+        branch_weights: (branchID, weight) replacing the weights of the logic
+            trees. The statistics are then recomputed from the realizations.
+        quantiles: levels of the quantile curves.
+    """
+
+    name: str = ""
+    poes: Tuple[float, ...] = ()
+    imts: Optional[Tuple[str, ...]] = None
+    sites: Optional[Tuple[int, ...]] = None
+    branch_weights: Tuple[Tuple[str, float], ...] = ()
+    quantiles: Tuple[float, ...] = (0.05, 0.5, 0.95)
+
+    @classmethod
+    def create(
+        cls,
+        name: str = "",
+        poes: Sequence[float] = (),
+        imts: Optional[Sequence[str]] = None,
+        sites: Optional[Sequence[int]] = None,
+        branch_weights: Optional[Dict[str, float]] = None,
+        quantiles: Sequence[float] = (0.05, 0.5, 0.95),
+    ) -> "ScenarioSpec":
+        """Spec of lists and dicts, turned into the tuples of a hashable spec."""
+        return cls(
+            name=name,
+            poes=tuple(float(poe) for poe in poes),
+            imts=None if imts is None else tuple(imts),
+            sites=None if sites is None else tuple(int(site) for site in sites),
+            branch_weights=tuple(sorted((branch_weights or {}).items())),
+            quantiles=tuple(float(quantile) for quantile in quantiles),
+        )
+
+    def key(self, inputs_key: str = "") -> str:
+        """Hash of the spec (but its name) and of the inputs it is evaluated on."""
+        values = [getattr(self, f.name) for f in fields(self) if f.name != "name"]
+        return content_hash([values, inputs_key])
+
+
+@dataclass
+class ScenarioResult:
+    """Result of a scenario.
+
+    Attributes:
+        key: hash of the spec and of the inputs, see :meth:`ScenarioSpec.key`.
+        statistics: mean and quantile curves of the IMTs and sites of the scenario.
+        poes: PoEs of the spectra.
+        spectra: UHS of the statistics, shape (type_data, site, poe, IMT).
+        mag_dist: Magnitude-Distance contributions averaged over the
+            realizations, shape (imt, poe, mag, dist), per site.
+        disag_imts: IMTs of ``mag_dist``, with the PoEs ``disag_poes``.
+    """
+
+    key: str
+    name: str
+    statistics: HazardCurves
+    poes: np.ndarray
+    spectra: np.ndarray
+    mag_dist: Dict[int, np.ndarray] = field(default_factory=dict)
+    disag_imts: List[str] = field(default_factory=list)
+    disag_poes: np.ndarray = field(default_factory=lambda: np.empty(0))
+
+    def save(self, path: str):
+        """Write the result in a ``.npz`` file."""
+        np.savez(
+            path,
+            key=np.array(self.key),
+            name=np.array(self.name),
+            type_datas=np.array(self.statistics.type_datas),
+            imts=np.array(self.statistics.imts),
+            sites=self.statistics.sites,
+            imls=self.statistics.imls,
+            curves=self.statistics.poes,
+            poes=self.poes,
+            spectra=self.spectra,
+            disag_imts=np.array(self.disag_imts, dtype=str),
+            disag_poes=self.disag_poes,
+            **{f"mag_dist-{site}": values for site, values in self.mag_dist.items()},
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "ScenarioResult":
+        """Read a result written by :meth:`save`."""
+        with np.load(path) as arrays:
+            return cls(
+                key=str(arrays["key"]),
+                name=str(arrays["name"]),
+                statistics=HazardCurves(
+                    type_datas=arrays["type_datas"].tolist(),
+                    imts=arrays["imts"].tolist(),
+                    sites=arrays["sites"],
+                    imls=arrays["imls"],
+                    poes=arrays["curves"],
+                    metadata={},
+                ),
+                poes=arrays["poes"],
+                spectra=arrays["spectra"],
+                mag_dist={
+                    int(name[len("mag_dist-") :]): arrays[name]
+                    for name in arrays.files
+                    if name.startswith("mag_dist-")
+                },
+                disag_imts=arrays["disag_imts"].tolist(),
+                disag_poes=arrays["disag_poes"],
+            )
+
+
+@dataclass
+class SweepInputs:
+    """Outputs of a run loaded once for all the scenarios of a sweep.
+
+    Attributes:
+        curves: every hazard curve needed by the scenarios.
+        matrices: disaggregation of each site, when exported.
+        source_branches: branches of the source model logic tree.
+        gsim_branches: branches of the GMPE logic tree.
+        poes: default PoEs of the scenarios (``poes`` of ``job.ini``).
+    """
+
+    curves: HazardCurves
+    matrices: Dict[int, DisaggregationMatrix] = field(default_factory=dict)
+    source_branches: List[LogicTreeBranch] = field(default_factory=list)
+    gsim_branches: List[LogicTreeBranch] = field(default_factory=list)
+    poes: Tuple[float, ...] = ()
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """The large arrays of the inputs, by name."""
+        arrays = {"curves": self.curves.poes}
+        for site, matrix in self.matrices.items():
+            arrays[f"disag-{site}"] = matrix.values
+        return arrays
+
+    def with_arrays(self, arrays: Dict[str, np.ndarray]) -> "SweepInputs":
+        """Same inputs on other arrays (see :meth:`arrays`)."""
+        return replace(
+            self,
+            curves=replace(self.curves, poes=arrays["curves"]),
+            matrices={
+                site: replace(matrix, values=arrays[f"disag-{site}"])
+                for site, matrix in self.matrices.items()
+            },
+        )
+
+
+def _realization_weights(spec: ScenarioSpec, inputs: SweepInputs) -> np.ndarray:
+    if not inputs.source_branches or not inputs.gsim_branches:
+        raise ValueError(f"Scenario {spec.name!r} needs the logic trees of the job")
+    _, weights = realization_weights(
+        inputs.source_branches, inputs.gsim_branches, dict(spec.branch_weights)
+    )
+    return weights
+
+
+def _statistics(spec: ScenarioSpec, inputs: SweepInputs) -> HazardCurves:
+    """Mean and quantile curves of a scenario.
+
+    The exported ones are used if they are all there and the branches keep
+    their weights, otherwise they are recomputed from the realizations.
+    """
+    curves = inputs.curves.select(imts=spec.imts, sites=spec.sites)
+    exported = {}
+    for type_data in curves.type_datas:
+        if type_data == "mean":
+            exported["mean"] = type_data
+        elif not type_data.startswith("rlz-"):
+            for quantile in spec.quantiles:
+                if np.isclose(float(type_data), quantile):
+                    exported[f"{quantile:g}"] = type_data
+    if not spec.branch_weights and len(exported) == 1 + len(spec.quantiles):
+        names = ["mean"] + [f"{quantile:g}" for quantile in spec.quantiles]
+        statistics = curves.select([exported[name] for name in names])
+        statistics.type_datas = names
+        return statistics
+
+    rlzs = [t for t in curves.type_datas if t.startswith("rlz-")]
+    return logic_tree_statistics(
+        curves.select(rlzs), _realization_weights(spec, inputs), spec.quantiles
+    )
+
+
+def _mag_dist(
+    spec: ScenarioSpec, inputs: SweepInputs, poes: np.ndarray
+) -> Tuple[Dict[int, np.ndarray], List[str], np.ndarray]:
+    """Magnitude-Distance contributions of the sites, IMTs and PoEs of a scenario."""
+    sites = range(len(inputs.curves.sites)) if spec.sites is None else spec.sites
+    mag_dist, imts, disag_poes = {}, [], np.empty(0)
+    for site in sites:
+        matrix = inputs.matrices.get(site)
+        if matrix is None:
+            continue
+        imts = [imt for imt in matrix.imts if spec.imts is None or imt in spec.imts]
+        i_poes = [i for i, poe in enumerate(matrix.poes) if np.isclose(poes, poe).any()]
+        disag_poes = matrix.poes[i_poes]
+        weights = matrix.weights
+        if spec.branch_weights:
+            weights = _realization_weights(spec, inputs)[matrix.rlz_ids]
+        values = marginal_poes(matrix, ["Mag", "Dist"])
+        values = values[[matrix.imts.index(imt) for imt in imts]][:, i_poes]
+        mag_dist[site] = np.average(values, axis=-1, weights=weights)
+    return mag_dist, imts, disag_poes
+
+
+@timed
+def evaluate_scenario(
+    spec: ScenarioSpec, inputs: SweepInputs, key: str = ""
+) -> ScenarioResult:
+    """Statistics, UHS and disaggregation of one scenario.
+
+    Raises:
+        ValueError: if the statistics of the scenario were not exported and
+            cannot be recomputed from the realizations.
+    """
+    statistics = _statistics(spec, inputs)
+    poes = np.array(spec.poes or inputs.poes, dtype=float)
+    mag_dist, disag_imts, disag_poes = _mag_dist(spec, inputs, poes)
+    return ScenarioResult(
+        key=key,
+        name=spec.name,
+        statistics=statistics,
+        poes=poes,
+        spectra=uniform_hazard_spectra(statistics, poes),
+        mag_dist=mag_dist,
+        disag_imts=disag_imts,
+        disag_poes=disag_poes,
+    )
+
+
+class SharedArrays:
+    """Arrays copied once in shared memory, for the processes of a pool.
+
+    The processes get :attr:`specs` and :func:`attach_arrays` them instead of
+    receiving a copy of the arrays.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.blocks: List[SharedMemory] = []
+        self.specs: Dict[str, Tuple[str, tuple, str]] = {}
+        for name, array in arrays.items():
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        """Release the shared memory."""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach_arrays(
+    specs: Dict[str, Tuple[str, tuple, str]],
+) -> Tuple[List[SharedMemory], Dict[str, np.ndarray]]:
+    """Read-only views on arrays shared by :class:`SharedArrays`.
+
+    Returns:
+        The blocks of shared memory, to keep alive as long as the views are
+        used, and the views by name.
+    """
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.setflags(write=False)
+        blocks.append(block)
+        arrays[name] = array
+    return blocks, arrays
+
+
+# Inputs of the scenarios in the processes of the pool, set by _init_worker
+_WORKER = {}
+
+
+def _init_worker(inputs: SweepInputs, specs: Dict[str, Tuple[str, tuple, str]]):
+    blocks, arrays = attach_arrays(specs)
+    _WORKER["blocks"] = blocks
+    _WORKER["inputs"] = inputs.with_arrays(arrays)
+
+
+def _evaluate_in_worker(spec_key: Tuple[ScenarioSpec, str]) -> ScenarioResult:
+    spec, key = spec_key
+    return evaluate_scenario(spec, _WORKER["inputs"], key)
+
+
+@timed
+def evaluate_scenarios(
+    specs: Sequence[ScenarioSpec],
+    inputs: SweepInputs,
+    keys: Sequence[str],
+    workers: Optional[int] = 1,
+) -> List[ScenarioResult]:
+    """Evaluate scenarios, serially or in a pool of processes sharing the input arrays.
+
+    Args:
+        workers: number of processes, all the cores if None, no pool if 1.
+
+    Returns:
+        The results, in the order of the specs.
+    """
+    if workers == 1 or len(specs) <= 1:
+        return [evaluate_scenario(spec, inputs, key) for spec, key in zip(specs, keys)]
+    with SharedArrays(inputs.arrays()) as shared:
+        skeleton = inputs.with_arrays({name: None for name in shared.specs})
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(skeleton, shared.specs),
+        ) as executor:
+            return list(executor.map(_evaluate_in_worker, zip(specs, keys)))
+
+
+@timed
+def load_sweep_inputs(
+    export_dir: str,
+    specs: Sequence[ScenarioSpec],
+    config: Optional[JobConfig] = None,
+    filenames: Optional[FilenameIndex] = None,
+) -> SweepInputs:
+    """Load once the outputs needed by all the scenarios: the union of their IMTs and sites."""
+    if filenames is None:
+        filenames = FilenameIndex.from_directory(export_dir)
+    imts = None
+    if all(spec.imts is not None for spec in specs):
+        imts = sorted({imt for spec in specs for imt in spec.imts})
+    curves = load_hazard_curves(export_dir, filenames, type_acc=imts)
+
+    sites = set(range(len(curves.sites)))
+    if all(spec.sites is not None for spec in specs):
+        sites = {site for spec in specs for site in spec.sites}
+    matrices = {}
+    for site in sorted(sites):
+        path = find_mag_dist_file(export_dir, site, filenames)
+        if path is not None:
+            matrices[site] = read_disaggregation(path, use_cache=True)
+
+    inputs = SweepInputs(curves, matrices)
+    if config is not None:
+        inputs.poes = tuple(config.poes.tolist())
+        if config.source_model_logic_tree and config.gsim_logic_tree:
+            inputs.source_branches = read_logic_tree(config.source_model_logic_tree)
+            inputs.gsim_branches = read_logic_tree(config.gsim_logic_tree)
+    return inputs
+
+
+def sweep_inputs_key(
+    export_dir: str,
+    config: Optional[JobConfig] = None,
+    filenames: Optional[FilenameIndex] = None,
+) -> str:
+    """Key of the outputs and configuration a sweep reads, see :func:`~psha_disag_mod.utils.files_key`."""
+    if is_archive(export_dir):
+        paths = [export_dir]
+    else:
+        if filenames is None:
+            filenames = FilenameIndex.from_directory(export_dir)
+        paths = [
+            os.path.join(export_dir, filename)
+            for mode in ("psha", "disaggregation")
+            for filename in filter_filenames(filenames, mode)
+        ]
+    if config is not None:
+        paths.append(config.path)
+        paths.extend(
+            path
+            for path in (config.source_model_logic_tree, config.gsim_logic_tree)
+            if path
+        )
+    return files_key(paths)
+
+
+@timed
+def run_sweep(
+    export_dir: str,
+    specs: Sequence[ScenarioSpec],
+    job_ini: Optional[str] = None,
+    workers: Optional[int] = 1,
+    use_cache: bool = True,
+    profile: Optional[str] = None,
+) -> Dict[str, ScenarioResult]:
+    """Evaluate scenarios over the outputs of a run.
+
+    The result of each scenario is cached in the cache folder of the export
+    directory, or of the directory of an archive, under the hash of its spec
+    (see :meth:`ScenarioSpec.key`), so
+    that only the scenarios which were never evaluated on these outputs are
+    computed. Those are evaluated by :func:`evaluate_scenarios` on outputs
+    loaded once.
+
+    Args:
+        export_dir: ``export_dir`` of the job, where the CSV files are.
+        specs: scenarios, the ones with the same hash are evaluated once.
+        job_ini: configuration of the job, for the default PoEs and the logic
+            trees reweighted by the scenarios.
+        workers: number of processes, all the cores if None, no pool if 1.
+        use_cache: whether to read and write the cached results.
+        profile: JSON file of the time spent in each stage of the sweep (see
+            :func:`~psha_disag_mod.utils.profiling`).
+
+    Returns:
+        The result of each scenario, by hash, in the order of the specs.
+    """
+    with profiling(profile) if profile else nullcontext():
+        return _run_sweep(export_dir, specs, job_ini, workers, use_cache)
+
+
+def _results_dir(export_dir: str) -> str:
+    """Folder of the cached results of a run, next to the archive for an archive."""
+    if is_archive(export_dir):
+        directory, name = os.path.split(os.path.abspath(export_dir))
+        return os.path.join(cache_dir(directory), f"scenarios-{name}")
+    return os.path.join(cache_dir(export_dir), "scenarios")
+
+
+def _run_sweep(
+    export_dir: str,
+    specs: Sequence[ScenarioSpec],
+    job_ini: Optional[str],
+    workers: Optional[int],
+    use_cache: bool,
+) -> Dict[str, ScenarioResult]:
+    config = read_job_config(job_ini) if job_ini else None
+    filenames = FilenameIndex.from_directory(export_dir)
+    inputs_key = sweep_inputs_key(export_dir, config, filenames)
+    keys = [spec.key(inputs_key) for spec in specs]
+    results_dir = _results_dir(export_dir)
+    os.makedirs(results_dir, exist_ok=True)
+
+    results: Dict[str, ScenarioResult] = {}
+    pending: Dict[str, ScenarioSpec] = {}
+    for spec, key in zip(specs, keys):
+        path = os.path.join(results_dir, f"{key}.npz")
+        if key in results or key in pending:
+            continue
+        if use_cache and os.path.exists(path):
+            results[key] = ScenarioResult.load(path)
+        else:
+            pending[key] = spec
+
+    if pending:
+        inputs = load_sweep_inputs(
+            export_dir, list(pending.values()), config, filenames
+        )
+        for result in evaluate_scenarios(
+            list(pending.values()), inputs, list(pending), workers=workers
+        ):
+            results[result.key] = result
+            if use_cache:
+                result.save(os.path.join(results_dir, f"{result.key}.npz"))
+    return {key: results[key] for key in keys}
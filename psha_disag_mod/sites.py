@@ -0,0 +1,154 @@
+"""Spatial index over the sites of a run and the Lon/Lat bins of its disaggregation.
+
+The sites are placed on the unit sphere and indexed by a KD-tree, so that the
+nearest sites of a point, or the sites within a radius of it, are found in
+logarithmic time whatever the size of the site grid. The queries return
+indices of sites, to slice the stacked curves (see
+:meth:`~psha_disag_mod.drouet_curves.HazardCurves.select`) or to pick the
+disaggregation files of the sites.
+"""
+
+from functools import cached_property
+from typing import NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+# Mean radius of the Earth in km
+EARTH_RADIUS = 6371.0
+
+
+class Nearest(NamedTuple):
+    """Selection of the ``k`` sites nearest to (lon, lat)."""
+
+    lon: float
+    lat: float
+    k: int = 1
+
+
+class WithinRadius(NamedTuple):
+    """Selection of the sites within ``radius`` km of (lon, lat)."""
+
+    lon: float
+    lat: float
+    radius: float
+
+
+# A site index, a list of indices, or a spatial query
+SiteSelection = Union[int, Sequence[int], Nearest, WithinRadius]
+
+
+def unit_vectors(lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """Points of the unit sphere at longitudes and latitudes in degrees, shape (n, 3)."""
+    lons = np.radians(np.asarray(lons, dtype=float))
+    lats = np.radians(np.asarray(lats, dtype=float))
+    return np.stack(
+        [np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)],
+        axis=-1,
+    )
+
+
+def _chord(distance: float) -> float:
+    """Straight distance on the unit sphere of a great-circle distance in km."""
+    angle = min(distance / EARTH_RADIUS, np.pi)
+    return 2 * np.sin(angle / 2)
+
+
+def _great_circle(chord: np.ndarray) -> np.ndarray:
+    """Great-circle distance in km of a straight distance on the unit sphere."""
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def great_circle_distances(lonlats: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Great-circle distances in km between two sets of points, in bulk.
+
+    The chords between the points of the unit sphere come from one matrix
+    product, ``|u - v|² = 2 - 2 u·v``, which keeps a precision of meters.
+
+    Args:
+        lonlats: (lon, lat) in degrees, shape (n, 2).
+        others: (lon, lat) in degrees, shape (m, 2).
+
+    Returns:
+        The distances, shape (n, m).
+    """
+    lonlats, others = np.atleast_2d(lonlats), np.atleast_2d(others)
+    vectors = unit_vectors(lonlats[:, 0], lonlats[:, 1])
+    other_vectors = unit_vectors(others[:, 0], others[:, 1])
+    squared_chords = 2 - 2 * (vectors @ other_vectors.T)
+    return _great_circle(np.sqrt(np.maximum(squared_chords, 0)))
+
+
+class SiteTable:
+    """(lon, lat) of sites, indexed by a KD-tree over their points of the unit sphere.
+
+    Attributes:
+        lonlats: longitude and latitude of the sites in degrees, shape (site, 2).
+    """
+
+    def __init__(self, lonlats: np.ndarray):
+        self.lonlats = np.asarray(lonlats, dtype=float)[:, :2]
+
+    @cached_property
+    def tree(self):
+        """KD-tree of the sites, built on the first spatial query."""
+        # Imported here, as scipy takes longer to import than the whole package
+        from scipy.spatial import cKDTree
+
+        return cKDTree(unit_vectors(self.lonlats[:, 0], self.lonlats[:, 1]))
+
+    def __len__(self) -> int:
+        return len(self.lonlats)
+
+    def nearest(
+        self, lon: float, lat: float, k: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The ``k`` sites nearest to a point.
+
+        Returns:
+            Their indices and their great-circle distances in km, nearest first.
+        """
+        k = min(k, len(self))
+        chords, indices = self.tree.query(unit_vectors(lon, lat), k=k)
+        return np.atleast_1d(indices), _great_circle(np.atleast_1d(chords))
+
+    def within(self, lon: float, lat: float, radius: float) -> np.ndarray:
+        """Indices of the sites within ``radius`` km of a point, in increasing order."""
+        indices = self.tree.query_ball_point(unit_vectors(lon, lat), _chord(radius))
+        return np.array(sorted(indices), dtype=int)
+
+    def select(self, selection: SiteSelection) -> np.ndarray:
+        """Indices of the sites of a selection, see :data:`SiteSelection`.
+
+        Raises:
+            IndexError: if the selection has indices beyond the table.
+        """
+        if isinstance(selection, Nearest):
+            return self.nearest(*selection)[0]
+        if isinstance(selection, WithinRadius):
+            return self.within(*selection)
+        indices = np.atleast_1d(np.asarray(selection, dtype=int))
+        if ((indices < 0) | (indices >= len(self))).any():
+            raise IndexError(f"Sites {selection} out of the {len(self)} sites")
+        return indices
+
+
+def lonlat_bin_mask(
+    lon_bin_edges: np.ndarray,
+    lat_bin_edges: np.ndarray,
+    lon: float,
+    lat: float,
+    radius: float,
+) -> np.ndarray:
+    """Lon/Lat bins of a disaggregation whose centers are within ``radius`` km of a point.
+
+    Returns:
+        A boolean mask of shape (lon, lat), to select the bins of the ``Lon``
+        and ``Lat`` axes of a disaggregation matrix.
+    """
+    lon_centers = (lon_bin_edges[:-1] + lon_bin_edges[1:]) / 2
+    lat_centers = (lat_bin_edges[:-1] + lat_bin_edges[1:]) / 2
+    lons, lats = np.meshgrid(lon_centers, lat_centers, indexing="ij")
+    table = SiteTable(np.column_stack([lons.ravel(), lats.ravel()]))
+    mask = np.zeros(lons.size, dtype=bool)
+    mask[table.within(lon, lat, radius)] = True
+    return mask.reshape(lons.shape)
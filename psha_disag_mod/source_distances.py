@@ -0,0 +1,370 @@
+"""Distances from the sites to the sources of a model, and the rates they bring per distance bin.
+
+The area polygons are discretized on a grid of ``area_source_discretization``
+km, like OpenQuake places the point ruptures of an area source, and every
+point carries its share of the rates of the source. The distances from all
+the sites to all the points come from one matrix product per chunk of sites
+(see :func:`~psha_disag_mod.sites.great_circle_distances`), and the rates
+are summed in the ``dist_bin_edges`` bins with ``np.bincount``, so that no
+Python loop runs over the points. The tables of a model are cached next to
+its XML, keyed by the hash of the file and the sites, to check the ``Dist``
+and ``Mag_Dist`` disaggregations of a run against its sources again and
+again at no cost.
+
+The distances are epicentral: from the site to the point on the surface,
+whatever the depth and the extent of the ruptures.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from psha_disag_mod.euro_xml import (
+    SourceModel,
+    file_hash,
+    mfd_row_rates,
+    read_logic_tree,
+    read_source_model,
+)
+from psha_disag_mod.metadata_ini import JobConfig
+from psha_disag_mod.sites import EARTH_RADIUS, great_circle_distances
+from psha_disag_mod.utils import (
+    cache_dir,
+    content_hash,
+    load_array_cache,
+    save_array_cache,
+    timed,
+)
+
+# Distances between sites and points computed at once
+CHUNKSIZE = 1_000_000
+# area_source_discretization of OpenQuake, in km, when job.ini has none
+DEFAULT_SPACING = 10.0
+
+
+def inside_polygon(lonlats: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Whether points are inside a polygon, by the even-odd rule on every edge at once.
+
+    Args:
+        lonlats: (lon, lat) of the points, shape (point, 2).
+        polygon: (lon, lat) of the vertices, closed or not, shape (vertex, 2).
+    """
+    x, y = lonlats[:, :1], lonlats[:, 1:]
+    x0, y0 = polygon.T
+    x1, y1 = np.roll(polygon, -1, axis=0).T
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return (crosses & (x < x_cross)).sum(axis=1) % 2 == 1
+
+
+def discretize_polygon(polygon: np.ndarray, spacing: float) -> np.ndarray:
+    """Points of a grid of ``spacing`` km inside a polygon.
+
+    The grid is regular in longitude and latitude, its longitude step
+    stretched at the mean latitude of the polygon. A polygon smaller than
+    the grid is represented by the mean of its vertices.
+
+    Returns:
+        (lon, lat) of the points, shape (point, 2).
+    """
+    lat_step = np.degrees(spacing / EARTH_RADIUS)
+    lon_step = lat_step / np.cos(np.radians(polygon[:, 1].mean()))
+    (lon_min, lat_min), (lon_max, lat_max) = polygon.min(axis=0), polygon.max(axis=0)
+    lons = np.arange(lon_min + lon_step / 2, lon_max, lon_step)
+    lats = np.arange(lat_min + lat_step / 2, lat_max, lat_step)
+    grid = np.stack(np.meshgrid(lons, lats, indexing="ij"), axis=-1).reshape(-1, 2)
+    points = grid[inside_polygon(grid, polygon)]
+    if len(points) == 0:
+        return polygon.mean(axis=0, keepdims=True)
+    return points
+
+
+@dataclass
+class SourcePoints:
+    """Points of the sources of a model, with the rates of their magnitude bins.
+
+    Attributes:
+        lonlats: (lon, lat) of the points, shape (point, 2), those of source
+            ``i`` being ``offsets[i]:offsets[i + 1]``.
+        offsets: first point of every source, and the number of points.
+        mags: centers of the magnitude bins.
+        rates: annual rates of the magnitude bins of the points, shape
+            (point, magnitude bin).
+    """
+
+    lonlats: np.ndarray
+    offsets: np.ndarray
+    mags: np.ndarray
+    rates: np.ndarray
+
+    @property
+    def source_index(self) -> np.ndarray:
+        """Source of every point."""
+        return np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+
+@timed
+def source_points(
+    model: SourceModel,
+    spacing: float = DEFAULT_SPACING,
+    bin_width: float = 0.1,
+    min_mag: Optional[float] = None,
+) -> SourcePoints:
+    """Points of the sources of a model: the grid of the area sources, the locations of the others.
+
+    The rates of an area source are shared evenly by the points of its
+    grid, the points of a multi-point source keep the rates of their own
+    MFD.
+
+    Args:
+        spacing: ``area_source_discretization`` of ``job.ini``, in km.
+        bin_width: ``width_of_mfd_bin`` of ``job.ini``.
+        min_mag: ``minimum_magnitude`` of ``job.ini``, the bins whose center
+            is below are dropped.
+    """
+    mags, row_rates = mfd_row_rates(model, bin_width)
+    if min_mag is not None:
+        kept = mags >= min_mag
+        mags, row_rates = mags[kept], row_rates[:, kept]
+    geometry, mfd = model.offsets["geometry"], model.offsets["mfd"]
+    lonlats: List[np.ndarray] = []
+    rates: List[np.ndarray] = []
+    for i, kind in enumerate(model.kind):
+        points = model.geometry[geometry[i] : geometry[i + 1]]
+        point_rates = row_rates[mfd[i] : mfd[i + 1]]
+        if kind == "areaSource":
+            points = discretize_polygon(points, spacing)
+            point_rates = np.repeat(
+                point_rates.sum(axis=0, keepdims=True) / len(points), len(points), 0
+            )
+        lonlats.append(points)
+        rates.append(point_rates)
+    return SourcePoints(
+        lonlats=np.concatenate(lonlats) if lonlats else np.empty((0, 2)),
+        offsets=np.concatenate([[0], np.cumsum([len(p) for p in lonlats])]).astype(int),
+        mags=mags,
+        rates=np.concatenate(rates) if rates else np.empty((0, len(mags))),
+    )
+
+
+@dataclass
+class DistanceRates:
+    """Distances from sites to the sources of a model, and the rates of the sources per distance bin.
+
+    Attributes:
+        sites: (lon, lat) of the sites, shape (site, 2).
+        source_ids: ids of the sources of the model.
+        dist_bin_edges: edges of the distance bins, in km.
+        mags: centers of the magnitude bins.
+        min_distances: distance from every site to the nearest point of
+            every source, shape (site, source).
+        source_rates: annual rates of the points of every source in every
+            distance bin, shape (site, source, distance bin).
+        mag_dist_rates: annual rates of all the sources in every magnitude
+            and distance bin, shape (site, magnitude bin, distance bin).
+    """
+
+    sites: np.ndarray
+    source_ids: List[str]
+    dist_bin_edges: np.ndarray
+    mags: np.ndarray
+    min_distances: np.ndarray
+    source_rates: np.ndarray
+    mag_dist_rates: np.ndarray
+
+    def dist_rates(self) -> np.ndarray:
+        """Rates of all the sources in every distance bin, shape (site, distance bin)."""
+        return self.source_rates.sum(axis=1)
+
+    def save(self, path: str, key: str = ""):
+        """Write the tables in a cache folder, see :func:`~psha_disag_mod.utils.save_array_cache`."""
+        save_array_cache(
+            path,
+            key,
+            {
+                "sites": self.sites,
+                "dist_bin_edges": self.dist_bin_edges,
+                "mags": self.mags,
+                "min_distances": self.min_distances,
+                "source_rates": self.source_rates,
+                "mag_dist_rates": self.mag_dist_rates,
+            },
+            {"source_ids": self.source_ids},
+        )
+
+    @classmethod
+    def load(cls, path: str, key: Optional[str] = None) -> Optional["DistanceRates"]:
+        """Map the tables written by :meth:`save`, None if there are none for ``key``."""
+        cache = load_array_cache(path, key)
+        if cache is None:
+            return None
+        arrays, extra = cache
+        return cls(**extra, **arrays)
+
+
+@timed
+def distance_rates(
+    points: SourcePoints,
+    sites: np.ndarray,
+    dist_bin_edges: np.ndarray,
+    source_ids: Optional[List[str]] = None,
+) -> DistanceRates:
+    """Distances from sites to the points of sources, and their rates per distance bin.
+
+    The points beyond the last edge (``maximum_distance``) bring nothing.
+
+    Args:
+        points: points of the sources, see :func:`source_points`.
+        sites: (lon, lat) of the sites, shape (site, 2).
+        dist_bin_edges: edges of the distance bins, e.g. the
+            ``distance_bin_edges`` of a :class:`~psha_disag_mod.metadata_ini.JobConfig`.
+        source_ids: ids of the sources, to label the tables.
+    """
+    sites = np.atleast_2d(np.asarray(sites, dtype=float))[:, :2]
+    dist_bin_edges = np.asarray(dist_bin_edges, dtype=float)
+    n_sources, n_bins = len(points.offsets) - 1, len(dist_bin_edges) - 1
+    n_mags = len(points.mags)
+    min_distances = np.full((len(sites), n_sources), np.inf)
+    source_rates = np.zeros((len(sites), n_sources, n_bins))
+    mag_dist_rates = np.zeros((len(sites), n_mags, n_bins))
+    source_index = points.source_index
+    totals = points.rates.sum(axis=1)
+    step = max(1, CHUNKSIZE // max(len(totals), 1))
+    starts = range(0, len(sites), step) if len(totals) else range(0)
+    for start in starts:
+        chunk = slice(start, start + step)
+        distances = great_circle_distances(sites[chunk], points.lonlats)
+        n_chunk = len(distances)
+        # the points of a source follow each other
+        min_distances[chunk] = np.minimum.reduceat(
+            distances, points.offsets[:-1], axis=1
+        )
+        bins = np.searchsorted(dist_bin_edges, distances, side="right") - 1
+        bins = np.minimum(bins, n_bins - 1)
+        inside = (distances >= dist_bin_edges[0]) & (distances <= dist_bin_edges[-1])
+        site_index = np.arange(n_chunk)[:, np.newaxis]
+        point_index = np.broadcast_to(np.arange(len(totals)), distances.shape)[inside]
+
+        flat = ((site_index * n_sources + source_index) * n_bins + bins)[inside]
+        source_rates[chunk] = np.bincount(
+            flat, weights=totals[point_index], minlength=n_chunk * n_sources * n_bins
+        ).reshape(n_chunk, n_sources, n_bins)
+        flat = (site_index * n_bins + bins)[inside]
+        for m in range(n_mags):
+            mag_dist_rates[chunk, m] = np.bincount(
+                flat, weights=points.rates[point_index, m], minlength=n_chunk * n_bins
+            ).reshape(n_chunk, n_bins)
+    return DistanceRates(
+        sites=sites,
+        source_ids=list(source_ids) if source_ids is not None else [],
+        dist_bin_edges=dist_bin_edges,
+        mags=points.mags,
+        min_distances=min_distances,
+        source_rates=source_rates,
+        mag_dist_rates=mag_dist_rates,
+    )
+
+
+@timed
+def model_distance_rates(
+    path: str,
+    sites: np.ndarray,
+    dist_bin_edges: np.ndarray,
+    spacing: float = DEFAULT_SPACING,
+    bin_width: float = 0.1,
+    min_mag: Optional[float] = None,
+    use_cache: bool = True,
+) -> DistanceRates:
+    """Distance tables of the sources of a NRML source model, from their cache if possible.
+
+    The cache is in the cache folder of the directory of the XML, keyed by
+    the hash of the file, the sites and the parameters: a second call reads
+    neither the XML nor its parsed model, and memory-maps the tables.
+
+    Args:
+        path: path of the source model.
+        sites: (lon, lat) of the sites, shape (site, 2).
+        dist_bin_edges: edges of the distance bins, in km.
+        spacing: ``area_source_discretization`` of ``job.ini``, in km.
+        bin_width: ``width_of_mfd_bin`` of ``job.ini``.
+        min_mag: ``minimum_magnitude`` of ``job.ini``.
+        use_cache: whether to read and write the cache.
+    """
+    sites = np.atleast_2d(np.asarray(sites, dtype=float))[:, :2]
+    dist_bin_edges = np.asarray(dist_bin_edges, dtype=float)
+
+    def compute() -> DistanceRates:
+        model = read_source_model(path, use_cache)
+        points = source_points(model, spacing, bin_width, min_mag)
+        return distance_rates(points, sites, dist_bin_edges, model.id.tolist())
+
+    if not use_cache:
+        return compute()
+    key = content_hash(
+        {
+            # bumped when the discretization of the MFDs changes
+            "version": 2,
+            "model": file_hash(path),
+            "sites": sites,
+            "dist_bin_edges": dist_bin_edges,
+            "spacing": float(spacing),
+            "bin_width": float(bin_width),
+            "min_mag": min_mag,
+        }
+    )
+    cache_path = os.path.join(
+        cache_dir(os.path.dirname(os.path.abspath(path))), f"distance_rates-{key}"
+    )
+    rates = DistanceRates.load(cache_path, key)
+    if rates is None:
+        rates = compute()
+        rates.save(cache_path, key)
+        rates = DistanceRates.load(cache_path, key) or rates
+    return rates
+
+
+@timed
+def job_distance_rates(
+    config: JobConfig, sites: Optional[np.ndarray] = None, use_cache: bool = True
+) -> Dict[str, DistanceRates]:
+    """Distance tables of every source model of the source model logic tree of a job.
+
+    The parameters come from ``job.ini``: ``area_source_discretization``,
+    ``width_of_mfd_bin``, ``minimum_magnitude``, and the distance bins of
+    the disaggregation up to ``maximum_distance``.
+
+    Args:
+        sites: (lon, lat) of the sites, the ``sites`` of the job if None.
+
+    Returns:
+        The tables of every file named by the branches, by filename.
+
+    Raises:
+        ValueError: if the job has no source model logic tree or no distance bins.
+    """
+    if not config.source_model_logic_tree:
+        raise ValueError(f"No source model logic tree in {config.path}")
+    if len(config.distance_bin_edges) < 2:
+        raise ValueError(f"No distance bins in {config.path}")
+    directory = os.path.dirname(config.source_model_logic_tree)
+    filenames = dict.fromkeys(
+        filename
+        for branch in read_logic_tree(config.source_model_logic_tree)
+        if branch.uncertainty_type == "sourceModel"
+        for filename in branch.uncertainty_model.split()
+    )
+    return {
+        filename: model_distance_rates(
+            os.path.join(directory, filename),
+            config.sites if sites is None else sites,
+            config.distance_bin_edges,
+            config.area_source_discretization or DEFAULT_SPACING,
+            config.width_of_mfd_bin or 0.1,
+            config.minimum_magnitude,
+            use_cache,
+        )
+        for filename in filenames
+    }
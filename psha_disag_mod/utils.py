@@ -0,0 +1,397 @@
+"""Helpers shared by the readers of the OpenQuake outputs."""
+
+import ast
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Folder created in an export directory to keep the binary caches of its outputs
+CACHE_DIRNAME = ".psha_disag_cache"
+# File of an array cache giving its key and the values other than arrays
+ARRAY_CACHE_INDEX = "index.json"
+
+_METADATA_KEY = re.compile(r"(?:^|,\s*)(\w+)=")
+
+
+def parse_oq_metadata(line: str) -> Dict[str, Any]:
+    """Parse the ``#`` line written by OpenQuake at the top of its CSV outputs.
+
+    Args:
+        line: e.g. ``#,,,"generated_by='OpenQuake engine 3.15.0', kind='mean',
+            investigation_time=1.0, imt='PGA'"``.
+
+    Returns:
+        The values of the line, as Python objects (str, float, list...).
+    """
+    content = line.strip().lstrip("#").strip(",").strip().strip('"')
+    keys = list(_METADATA_KEY.finditer(content))
+    metadata = {}
+    for key, next_key in zip(keys, keys[1:] + [None]):
+        value = content[key.end() : next_key.start() if next_key else None]
+        try:
+            metadata[key.group(1)] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            metadata[key.group(1)] = value.strip()
+    return metadata
+
+
+def read_oq_metadata(path: str) -> Dict[str, Any]:
+    """Read the metadata of an OpenQuake CSV output (see :func:`parse_oq_metadata`)."""
+    with open(path) as csv_file:
+        return parse_oq_metadata(csv_file.readline())
+
+
+def imt_period(imt: str) -> float:
+    """Period in seconds of an intensity measure type, 0 for ``PGA``.
+
+    Raises:
+        ValueError: for the types which are not accelerations (e.g. PGV).
+    """
+    if imt == "PGA":
+        return 0.0
+    match = re.fullmatch(r"SA\((.+)\)", imt)
+    if match is None:
+        raise ValueError(f"{imt!r} is not an acceleration type")
+    return float(match.group(1))
+
+
+def files_key(paths: Iterable[str]) -> str:
+    """Digest of the names, sizes and modification times of files.
+
+    It changes as soon as one of the files is rewritten, so it tells whether
+    a cache built on these files is still valid.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return digest.hexdigest()
+
+
+def names_key(names: Iterable[str]) -> str:
+    """Short digest of a list of names, to name a cache file after its content."""
+    return hashlib.sha1("\n".join(names).encode()).hexdigest()[:16]
+
+
+def cache_dir(directory: str) -> str:
+    """Cache folder of an export directory, created if needed."""
+    path = os.path.join(directory, CACHE_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_array_cache(
+    path: str, key: str, arrays: Dict[str, np.ndarray], extra: Any = None
+):
+    """Write arrays in a cache folder, one ``.npy`` file each, to be memory-mapped.
+
+    The folder is written aside and renamed at once, so that concurrent
+    readers only ever see complete caches. If another process renames its
+    own cache first, that one is kept.
+
+    Args:
+        path: folder of the cache, replaced if it exists.
+        key: key of the inputs of the arrays, see :func:`load_array_cache`.
+        arrays: arrays by name.
+        extra: other values to keep with the arrays, serializable in JSON.
+    """
+    temporary = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, f"{name}.npy"), array, allow_pickle=False)
+    with open(os.path.join(temporary, ARRAY_CACHE_INDEX), "w") as index_file:
+        json.dump({"key": key, "arrays": list(arrays), "extra": extra}, index_file)
+    # Mapped files of the stale cache remain readable by the processes using them
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(temporary, path)
+    except OSError:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def load_array_cache(
+    path: str, key: Optional[str] = None
+) -> Optional[Tuple[Dict[str, np.ndarray], Any]]:
+    """Map the arrays of a cache written by :func:`save_array_cache`.
+
+    The arrays are read-only ``np.memmap`` views of the files: the processes
+    mapping the same cache share one copy in the page cache, and only read
+    the pages they slice.
+
+    Returns:
+        The arrays by name and the ``extra`` values, None if there is no
+        cache or if ``key`` is given and differs from the saved one.
+    """
+    try:
+        with open(os.path.join(path, ARRAY_CACHE_INDEX)) as index_file:
+            index = json.load(index_file)
+        if key is not None and index["key"] != key:
+            return None
+        arrays = {
+            name: np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="r", allow_pickle=False
+            )
+            for name in index["arrays"]
+        }
+    except (OSError, ValueError):
+        return None
+    return arrays, index["extra"]
+
+
+def imt_frequency(imt: str) -> float:
+    """Frequency in Hz of an intensity measure type, 100 Hz for ``PGA``."""
+    period = imt_period(imt)
+    return 100.0 if period == 0 else 1 / period
+
+
+def return_period(poe: float, investigation_time: float = 1.0) -> float:
+    """Return period in years of a probability of exceedance over the investigation time.
+
+    Computed as ``investigation_time / poe``, e.g. 475 years for 0.002105 in one year.
+    """
+    return investigation_time / poe
+
+
+def content_hash(value: Any) -> str:
+    """Digest of nested dicts, lists, numbers, strings and NumPy arrays.
+
+    Equal contents give equal digests, whatever the identity of the objects,
+    so it tells whether the inputs of a computation changed.
+    """
+    digest = hashlib.sha1()
+    _update_digest(digest, value)
+    return digest.hexdigest()
+
+
+def _update_digest(digest, value: Any):
+    if isinstance(value, dict):
+        digest.update(b"{")
+        for key in sorted(value, key=str):
+            _update_digest(digest, key)
+            _update_digest(digest, value[key])
+        digest.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"[")
+        for item in value:
+            _update_digest(digest, item)
+        digest.update(b"]")
+    elif hasattr(value, "tobytes") and hasattr(value, "dtype"):
+        digest.update(f"array{value.dtype.str}{value.shape}".encode())
+        digest.update(value.tobytes())
+    else:
+        digest.update(f"{type(value).__name__}:{value!r};".encode())
+
+
+# Instrumentation of the post-processing: timers of the stages, counters of the
+# files read and samples of the peak RSS. It records nothing, at the cost of
+# one global lookup per call, unless a Profile is enabled.
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process and of its finished children, in bytes.
+
+    0 where the ``resource`` module is not available.
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class Profile:
+    """Timings, counters and peak RSS of a run, see :func:`profiling`.
+
+    Attributes:
+        events: one dict per timed call, with its ``name``, ``start`` (seconds
+            since the start of the profile), ``duration``, ``thread`` and the
+            peak RSS at its end.
+        counters: totals of the counters, e.g. ``files_read`` and ``bytes_parsed``.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.counters: Dict[str, float] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_event(self, name: str, start: float, end: float):
+        event = {
+            "name": name,
+            "start": start - self.start,
+            "duration": end - start,
+            "thread": threading.get_ident(),
+            "peak_rss": peak_rss(),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def report(self) -> Dict[str, Any]:
+        """Summary of the run: calls, total and maximal time of each stage, counters."""
+        stages: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            stage = stages.setdefault(
+                event["name"], {"calls": 0, "total": 0.0, "max": 0.0}
+            )
+            stage["calls"] += 1
+            stage["total"] += event["duration"]
+            stage["max"] = max(stage["max"], event["duration"])
+        return {
+            "wall_time": time.perf_counter() - self.start,
+            "peak_rss": peak_rss(),
+            "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total"])),
+            "counters": dict(self.counters),
+        }
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Events in the Trace Event Format, to open in ``chrome://tracing`` or Perfetto."""
+        pid = os.getpid()
+        events = [
+            {
+                "name": event["name"],
+                "cat": event["name"].split(".", 1)[0],
+                "ph": "X",
+                "ts": 1e6 * event["start"],
+                "dur": 1e6 * event["duration"],
+                "pid": pid,
+                "tid": event["thread"],
+                "args": {"peak_rss": event["peak_rss"]},
+            }
+            for event in self.events
+        ]
+        report = self.report()
+        events.append(
+            {
+                "name": "counters",
+                "ph": "C",
+                "ts": 1e6 * report["wall_time"],
+                "pid": pid,
+                "args": report["counters"],
+            }
+        )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str, chrome: Optional[bool] = None):
+        """Write the report in JSON, or the Chrome trace.
+
+        Args:
+            chrome: whether to write the Chrome trace, by default when the
+                name of the file ends with ``.trace.json``.
+        """
+        if chrome is None:
+            chrome = path.endswith(".trace.json")
+        with open(path, "w") as json_file:
+            json.dump(self.chrome_trace() if chrome else self.report(), json_file)
+
+
+_PROFILE: Optional[Profile] = None
+
+
+def active_profile() -> Optional[Profile]:
+    """Profile being recorded, None when the instrumentation is disabled."""
+    return _PROFILE
+
+
+@contextmanager
+def profiling(path: Optional[str] = None) -> Iterator[Profile]:
+    """Enable the instrumentation within a ``with`` block.
+
+    A profile already being recorded is reused, so that nested entry points
+    (e.g. :func:`~psha_disag_mod.plots_psha_disag.plot_run` called by a
+    script which profiles itself) add to the same report.
+
+    Args:
+        path: file where the report is written at the end of the block (see
+            :meth:`Profile.write`), if any.
+    """
+    global _PROFILE
+    if _PROFILE is not None:
+        profile = _PROFILE
+        yield profile
+    else:
+        profile = _PROFILE = Profile()
+        try:
+            yield profile
+        finally:
+            _PROFILE = None
+    if path is not None:
+        profile.write(path)
+
+
+class _Timer:
+    __slots__ = ("profile", "name", "start")
+
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_event(self.name, self.start, time.perf_counter())
+
+
+_NO_TIMER = nullcontext()
+
+
+def timer(name: str):
+    """Context manager timing a block as the stage ``name`` of the profile."""
+    profile = _PROFILE
+    return _NO_TIMER if profile is None else _Timer(profile, name)
+
+
+def timed(function: Callable) -> Callable:
+    """Decorator timing each call of a function, as ``<module>.<qualified name>``."""
+    name = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = _PROFILE
+        if profile is None:
+            return function(*args, **kwargs)
+        with _Timer(profile, name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def count(name: str, value: float = 1):
+    """Add to a counter of the profile."""
+    profile = _PROFILE
+    if profile is not None:
+        profile.count(name, value)
+
+
+def count_file(path: str):
+    """Count a file read, and its size in ``bytes_parsed``."""
+    profile = _PROFILE
+    if profile is not None:
+        profile.count("files_read")
+        profile.count("bytes_parsed", os.path.getsize(path))
@@ -0,0 +1,433 @@
+"""Post-process an export directory while OpenQuake is still writing it.
+
+A large job exports its CSV files over many minutes. :func:`watch_run` reads
+each file as soon as it is complete, adds it to the curves and
+disaggregations of the run already read, and renders again only the figures
+it changes: the hazard curves of its IMT, the mean curves and the UHS for a
+hazard curve, the figures of its site for a disaggregation. The figures
+whose inputs did not change are left alone by the
+:class:`~psha_disag_mod.plots_psha_disag.PlotManifest`, and the curves read
+so far are saved in the cache of the directory, where
+:func:`~psha_disag_mod.drouet_curves.load_hazard_curves` finds them.
+
+The new files are found by polling the directory: a file is complete once
+its size and modification time hold for ``settle`` seconds. On Linux,
+inotify reports the files closed after writing (or moved into the
+directory) at once; the directory is still polled at every wait, for the
+files written before the watch started, those of the events lost by an
+overflow of the queue, or those of a network file system inotify does not
+see.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import stat
+import struct
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from psha_disag_mod.compartiment import (
+    is_disag_filename,
+    is_psha_filename,
+    read_disag_params,
+    read_psha_params,
+)
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.drouet_curves import (
+    HazardCurves,
+    assemble_hazard_curves,
+    hazard_curves_cache_path,
+    read_hazard_curve,
+)
+from psha_disag_mod.metadata_ini import JobConfig
+from psha_disag_mod.plots_psha_disag import (
+    FIGURE_KINDS,
+    FigureJob,
+    disag_jobs,
+    imt_curve_job,
+    mean_curves_job,
+    render_stale_jobs,
+    site_plot_dir,
+    uhs_jobs,
+)
+from psha_disag_mod.sites import SiteSelection
+from psha_disag_mod.utils import count, files_key, timed
+
+# Seconds between two polls of the directory
+POLL_INTERVAL = 1.0
+# Seconds a file keeps its size and modification time before it is read
+SETTLE = 2.0
+
+# inotify(7) events of a file fully written into the directory
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+# Mag_Dist disaggregations drawn, the first one found for a site
+_MAG_DIST_AXES = (("Mag", "Dist"), ("Mag", "Dist", "Eps"))
+
+
+class PollingWatcher:
+    """New and rewritten files of a directory, found by listing it again and again.
+
+    A file is reported once it kept the same size and modification time
+    over ``settle`` seconds, then again each time it changes.
+    """
+
+    def __init__(self, directory: str, settle: float = SETTLE):
+        self.directory = directory
+        self.settle = settle
+        # (size, mtime) of the files reported
+        self.reported: Dict[str, Tuple[int, int]] = {}
+        # (size, mtime) of the files changing, and when they were first seen so
+        self.pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+
+    def _signature(self, stat: os.stat_result) -> Tuple[int, int]:
+        return stat.st_size, stat.st_mtime_ns
+
+    def poll(self) -> List[str]:
+        """Names of the files settled since the last call."""
+        now = time.monotonic()
+        ready = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                signature = self._signature(entry.stat())
+                if self.reported.get(entry.name) == signature:
+                    continue
+                first_seen = self.pending.get(entry.name)
+                if first_seen is None or first_seen[0] != signature:
+                    self.pending[entry.name] = (signature, now)
+                elif now - first_seen[1] >= self.settle:
+                    del self.pending[entry.name]
+                    self.reported[entry.name] = signature
+                    ready.append(entry.name)
+        return ready
+
+    def wait(self, timeout: float) -> List[str]:
+        """Names of the files settled within ``timeout`` seconds."""
+        time.sleep(timeout)
+        return self.poll()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InotifyWatcher(PollingWatcher):
+    """Files closed after writing or moved into a directory, reported by inotify at once.
+
+    Raises:
+        OSError: if inotify is not available.
+    """
+
+    def __init__(self, directory: str, settle: float = SETTLE):
+        super().__init__(directory, settle)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {directory}")
+
+    def _read_events(self) -> List[str]:
+        """Names of the files of the pending events."""
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if name:
+                    names.append(os.fsdecode(name))
+
+    def wait(self, timeout: float) -> List[str]:
+        """Names of the files written within ``timeout`` seconds, and of those settled."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        names = self._read_events() if readable else []
+        ready = []
+        for name in dict.fromkeys(names):
+            try:
+                file_stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            signature = self._signature(file_stat)
+            self.pending.pop(name, None)
+            if self.reported.get(name) != signature:
+                self.reported[name] = signature
+                ready.append(name)
+        count("watch.inotify_events", len(names))
+        # polled even when events keep coming, or the files already there
+        # would wait for the directory to go quiet
+        ready.extend(name for name in self.poll() if name not in ready)
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(
+    directory: str, settle: float = SETTLE, inotify: bool = True
+) -> PollingWatcher:
+    """Watcher of a directory, with inotify on Linux if possible, else by polling."""
+    if inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory, settle)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory, settle)
+
+
+@dataclass
+class WatchUpdate:
+    """Changes brought by a batch of files of a run.
+
+    Attributes:
+        filenames: files of the batch.
+        imts: IMTs of the hazard curves of the batch.
+        sites: sites of the disaggregations of the batch.
+        rendered: paths of the figures rendered again.
+    """
+
+    filenames: List[str]
+    imts: Set[str] = field(default_factory=set)
+    sites: Set[int] = field(default_factory=set)
+    rendered: List[str] = field(default_factory=list)
+
+
+class IncrementalRun:
+    """Curves and disaggregations of a run read so far, and the figures drawn from them.
+
+    The hazard curve files are kept as read, with all their sites, and
+    assembled again when a batch brings new ones. The disaggregations are
+    read through their cache (see
+    :func:`~psha_disag_mod.disaggregation.read_disaggregation`).
+
+    Args:
+        site: index, indices or a spatial query of the sites, see
+            :func:`~psha_disag_mod.plots_psha_disag.run_jobs`. The sites of a
+            spatial query are found once the first curves are read.
+        poes: PoEs of the UHS, by default the ``poes`` of the ``config``.
+        config: ``job.ini`` of the run, giving the IMTs and PoEs of the
+            disaggregations.
+        kinds: kinds of figures to draw, among ``FIGURE_KINDS``.
+        workers: number of processes rendering the figures, see
+            :func:`~psha_disag_mod.plots_psha_disag.render_jobs`.
+    """
+
+    def __init__(
+        self,
+        export_dir: str,
+        plot_dir: str,
+        site: SiteSelection = 0,
+        poes: Optional[Sequence[float]] = None,
+        config: Optional[JobConfig] = None,
+        kinds: Sequence[str] = FIGURE_KINDS,
+        workers: Optional[int] = 1,
+    ):
+        self.export_dir = export_dir
+        self.plot_dir = plot_dir
+        self.site = site
+        if config is not None and poes is None:
+            poes = config.poes.tolist()
+        self.poes = poes
+        self.config = config
+        self.kinds = kinds
+        self.workers = workers
+        self.curve_files: Dict[str, tuple] = {}
+        self.curves: Optional[HazardCurves] = None
+        # Mag_Dist and Mag_Dist_Eps files of every site
+        self.disag_files: Dict[int, Dict[Tuple[str, ...], str]] = {}
+        self._cache_path: Optional[str] = None
+
+    def sites(self) -> List[int]:
+        """Sites drawn, empty while a spatial query has no curves to select from."""
+        if self.curves is not None:
+            return self.curves.site_table.select(self.site).tolist()
+        if isinstance(self.site, (int, np.integer, list, tuple, np.ndarray)):
+            return np.atleast_1d(np.asarray(self.site, dtype=int)).tolist()
+        return []
+
+    def _classify(self, update: WatchUpdate, filename: str):
+        if is_psha_filename(filename):
+            params = read_psha_params(filename)
+            if params["type_filename"] != "curve":
+                # the UHS and maps are drawn from the curves
+                count("watch.ignored")
+                return
+            path = os.path.join(self.export_dir, filename)
+            self.curve_files[filename] = read_hazard_curve(path)
+            update.imts.add(params["type_acc"])
+        elif is_disag_filename(filename):
+            params = read_disag_params(filename)
+            axes = tuple(params["disaggregation_axes"])
+            if axes not in _MAG_DIST_AXES:
+                count("watch.ignored")
+                return
+            self.disag_files.setdefault(params["site"], {})[axes] = filename
+            update.sites.add(params["site"])
+
+    def _store_curves(self):
+        """Assemble the curves read so far, and save them where load_hazard_curves looks."""
+        filenames = sorted(self.curve_files)
+        self.curves = assemble_hazard_curves(
+            filenames, [self.curve_files[name] for name in filenames]
+        )
+        paths = [os.path.join(self.export_dir, name) for name in filenames]
+        cache_path = hazard_curves_cache_path(self.export_dir, filenames)
+        self.curves.save(cache_path, files_key(paths))
+        # the curves of the previous batch are a subset, not worth keeping
+        if self._cache_path not in (None, cache_path):
+            shutil.rmtree(self._cache_path, ignore_errors=True)
+        self._cache_path = cache_path
+
+    def _curve_jobs(self, imts: Set[str], sites: List[int]) -> List[FigureJob]:
+        curves = self.curves
+        investigation_time = next(iter(curves.metadata.values()), {}).get(
+            "investigation_time", 1.0
+        )
+        jobs: List[Optional[FigureJob]] = []
+        for i_site in sites:
+            site_dir = site_plot_dir(self.plot_dir, sites, i_site)
+            if "curve" in self.kinds:
+                jobs.extend(
+                    imt_curve_job(curves, imt, site_dir, i_site) for imt in sorted(imts)
+                )
+                jobs.append(mean_curves_job(curves, site_dir, i_site))
+            if self.poes and "uhs" in self.kinds:
+                jobs.extend(
+                    uhs_jobs(curves, self.poes, site_dir, i_site, investigation_time)
+                )
+        return [job for job in jobs if job is not None]
+
+    def _disag_jobs(self, sites_changed: Set[int], sites: List[int]) -> List[FigureJob]:
+        jobs = []
+        for i_site in sorted(sites_changed & set(sites)):
+            files = self.disag_files[i_site]
+            filename = next(files[axes] for axes in _MAG_DIST_AXES if axes in files)
+            path = os.path.join(self.export_dir, filename)
+            if self.config is not None:
+                matrix = read_disaggregation(
+                    path, self.config.imts, self.config.poes_disagg, use_cache=True
+                )
+            else:
+                matrix = read_disaggregation(path, use_cache=True)
+            jobs.extend(disag_jobs(matrix, site_plot_dir(self.plot_dir, sites, i_site)))
+        return jobs
+
+    @timed
+    def add(self, filenames: Sequence[str]) -> WatchUpdate:
+        """Read a batch of new or rewritten files, and render the figures they change.
+
+        The files which are neither hazard curves nor Magnitude-Distance
+        disaggregations are skipped.
+        """
+        update = WatchUpdate(list(filenames))
+        for filename in filenames:
+            self._classify(update, filename)
+        known_sites = set(self.sites())
+        if update.imts:
+            self._store_curves()
+        sites = self.sites()
+        jobs = []
+        if update.imts and ("curve" in self.kinds or "uhs" in self.kinds):
+            jobs.extend(self._curve_jobs(update.imts, sites))
+        if "disag" in self.kinds:
+            # the disaggregations read before the sites of a query were known
+            update.sites |= set(sites) - known_sites
+            update.sites &= set(self.disag_files)
+            jobs.extend(self._disag_jobs(update.sites, sites))
+        if jobs:
+            update.rendered = render_stale_jobs(
+                jobs, self.plot_dir, workers=self.workers
+            )
+        return update
+
+
+@timed
+def watch_run(
+    export_dir: str,
+    plot_dir: str,
+    site: SiteSelection = 0,
+    workers: Optional[int] = 1,
+    poes: Optional[Sequence[float]] = None,
+    config: Optional[JobConfig] = None,
+    kinds: Sequence[str] = FIGURE_KINDS,
+    poll_interval: float = POLL_INTERVAL,
+    settle: float = SETTLE,
+    idle_timeout: Optional[float] = None,
+    stop: Optional[threading.Event] = None,
+    inotify: bool = True,
+    on_update: Optional[Callable[[WatchUpdate], None]] = None,
+) -> List[str]:
+    """Render the figures of a run as its files are written, until it is stopped.
+
+    The files already there are taken as they settle, then the new ones as
+    they come (see :class:`IncrementalRun`). The files arriving within
+    ``poll_interval`` of each other are read as one batch, and each figure
+    is rendered once per batch.
+
+    Args:
+        site, poes, config, kinds, workers: see :class:`IncrementalRun`.
+        poll_interval: seconds between two polls of the directory, and
+            longest wait for the rest of a batch.
+        settle: seconds a polled file keeps its size and modification time
+            before it is read.
+        idle_timeout: stop after this many seconds without new files, never
+            if None.
+        stop: event stopping the watch, e.g. set by another thread.
+        inotify: use inotify on Linux, rather than polling only.
+        on_update: called after each batch, e.g. to print the figures.
+
+    Returns:
+        The paths of the rendered figures, each once per batch changing it.
+    """
+    run = IncrementalRun(export_dir, plot_dir, site, poes, config, kinds, workers)
+    rendered: List[str] = []
+    with open_watcher(export_dir, settle, inotify) as watcher:
+        last_change = time.monotonic()
+        while stop is None or not stop.is_set():
+            filenames = watcher.wait(poll_interval)
+            if not filenames:
+                idle = time.monotonic() - last_change
+                if idle_timeout is not None and idle >= idle_timeout:
+                    break
+                continue
+            batch_start = time.monotonic()
+            while time.monotonic() - batch_start < poll_interval:
+                more = watcher.wait(min(poll_interval / 10, 0.1))
+                if not more:
+                    break
+                filenames.extend(more)
+            update = run.add(list(dict.fromkeys(filenames)))
+            count("watch.batches")
+            rendered.extend(update.rendered)
+            last_change = time.monotonic()
+            if on_update is not None:
+                on_update(update)
+    return rendered
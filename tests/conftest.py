@@ -0,0 +1,25 @@
+import os
+import shutil
+
+import pytest
+
+DROUET_DIR = os.path.join(os.path.dirname(__file__), "..", "Drouet-Simplified")
+
+
+@pytest.fixture
+def export_dir(tmp_path):
+    """Copy of the outputs of the Drouet-Simplified run, free to be modified"""
+    path = tmp_path / "output"
+    shutil.copytree(os.path.join(DROUET_DIR, "output"), path)
+    return str(path)
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    """Copy of the source models and logic trees of the Drouet-Simplified job"""
+    path = tmp_path / "model"
+    path.mkdir()
+    for filename in os.listdir(DROUET_DIR):
+        if filename.endswith((".xml", ".ini")):
+            shutil.copy(os.path.join(DROUET_DIR, filename), path)
+    return str(path)
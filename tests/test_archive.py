@@ -0,0 +1,120 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.archive import (
+    ARCHIVE_SUFFIX,
+    ingest_export,
+    is_archive,
+    open_archive,
+)
+from psha_disag_mod.compartiment import FilenameIndex, filter_filenames
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.drouet_curves import load_hazard_curves
+from psha_disag_mod.plots_psha_disag import run_jobs
+from psha_disag_mod.scenarios import ScenarioSpec, run_sweep
+from psha_disag_mod.sites import WithinRadius
+from psha_disag_mod.utils import CACHE_DIRNAME
+from tests.test_sites import multi_site_dir  # noqa: F401 (fixture)
+
+UHS_CSV = (
+    "#,,,\"generated_by='OpenQuake engine 3.15.0', kind='mean', "
+    'investigation_time=1.0"\n'
+    "lon,lat,0.002105~PGA,0.002105~SA(0.1)\n"
+    "5.73000,45.19000,1.176964E-01,2.793376E-01\n"
+)
+
+
+@pytest.fixture
+def archive(export_dir, model_dir):
+    with open(os.path.join(export_dir, "hazard_uhs-mean_18.csv"), "w") as csv_file:
+        csv_file.write(UHS_CSV)
+    return ingest_export(export_dir, job_ini=os.path.join(model_dir, "job.ini"))
+
+
+def test_ingest_export(export_dir, archive):
+    check.equal(archive, export_dir + ARCHIVE_SUFFIX)
+    check.is_true(is_archive(archive))
+    check.is_false(is_archive(export_dir))
+    content = open_archive(archive)
+    check.equal(content.filenames, sorted(os.listdir(export_dir)))
+    check.equal(content.metadata("hazard_curve-mean-PGA_18.csv")["kind"], "mean")
+    columns, values = content.table("hazard_uhs-mean_18.csv")
+    check.equal(columns, ["lon", "lat", "0.002105~PGA", "0.002105~SA(0.1)"])
+    check.is_true(np.allclose(values, [[5.73, 45.19, 0.1176964, 0.2793376]]))
+    with open(os.path.join(export_dir, "logicTree_GMPE.xml"), "rb") as xml_file:
+        check.equal(content.read_file("logicTree_GMPE.xml"), xml_file.read())
+    check.is_true(
+        np.allclose(content.job_config().poes_disagg[:2], [0.002105, 0.000404])
+    )
+
+
+def test_archive_stands_for_export_dir(export_dir, archive):
+    check.equal(
+        filter_filenames(FilenameIndex.from_directory(archive), "disaggregation"),
+        ["Dist-0_18.csv"],
+    )
+    for patterns in ({}, {"type_data": ["mean"]}, {"type_acc": ["SA(0.1)"]}):
+        expected = load_hazard_curves(export_dir, use_cache=False, **patterns)
+        curves = load_hazard_curves(archive, **patterns)
+        check.equal(curves.type_datas, expected.type_datas)
+        check.equal(curves.imts, expected.imts)
+        check.is_true(np.array_equal(curves.imls, expected.imls, equal_nan=True))
+        check.is_true(np.array_equal(curves.poes, expected.poes, equal_nan=True))
+        check.equal(curves.metadata, expected.metadata)
+
+    matrix = read_disaggregation(os.path.join(archive, "Dist-0_18.csv"))
+    expected = read_disaggregation(os.path.join(export_dir, "Dist-0_18.csv"))
+    check.is_true(np.array_equal(matrix.values, expected.values))
+    check.is_true(np.array_equal(matrix.bin_edges["Dist"], expected.bin_edges["Dist"]))
+    check.equal(matrix.rlz_ids, expected.rlz_ids)
+
+
+def test_run_jobs_archive(export_dir, archive, tmp_path):
+    shutil.rmtree(export_dir)
+
+    jobs = run_jobs(archive, str(tmp_path), poes=[0.002105])
+
+    check.equal(len(jobs), 17)
+
+
+def test_run_sweep_archive(export_dir, model_dir, archive):
+    job_ini = os.path.join(model_dir, "job.ini")
+    specs = [ScenarioSpec.create("pga", imts=["PGA"], quantiles=[])]
+    expected = run_sweep(export_dir, specs, job_ini, use_cache=False)
+    shutil.rmtree(export_dir)
+
+    results = run_sweep(archive, specs, job_ini)
+    cached = run_sweep(archive, specs, job_ini)
+
+    (result,), (expected,) = results.values(), expected.values()
+    check.is_true(np.array_equal(result.spectra, expected.spectra, equal_nan=True))
+    check.is_true(np.array_equal(next(iter(cached.values())).spectra, result.spectra))
+    # cached next to the archive, under its name
+    results_dir = os.path.join(
+        os.path.dirname(archive),
+        CACHE_DIRNAME,
+        f"scenarios-{os.path.basename(archive)}",
+    )
+    check.equal(os.listdir(results_dir), [f"{next(iter(results))}.npz"])
+
+
+def test_chunked_curves(multi_site_dir, tmp_path):  # noqa: F811
+    archive = ingest_export(
+        multi_site_dir, str(tmp_path / f"run{ARCHIVE_SUFFIX}"), chunk_bytes=1
+    )
+    content = open_archive(archive)
+    poes = content.array(content.index["curves"]["18"]["poes"])
+    expected = load_hazard_curves(multi_site_dir, use_cache=False)
+
+    check.equal(len(poes.members), 3)
+    check.is_true(
+        np.array_equal(poes[:, :, 1:], expected.poes[:, :, 1:], equal_nan=True)
+    )
+    check.is_true(np.array_equal(poes[2, 0, 2], expected.poes[2, 0, 2]))
+    check.is_true(np.array_equal(poes[..., 3], expected.poes[..., 3], equal_nan=True))
+    curves = content.hazard_curves(sites=WithinRadius(7.0, 46.0, 1.0))
+    check.is_true(np.array_equal(curves.poes, expected.poes[:, :, 2:], equal_nan=True))
@@ -0,0 +1,111 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest_check as check
+
+from psha_disag_mod.__main__ import main
+from tests.test_disaggregation import write_mag_dist_eps
+
+
+def test_list(export_dir, capsys):
+    main(["list", export_dir, "--type-data", "mean"])
+    check.equal(
+        capsys.readouterr().out.split(),
+        ["hazard_curve-mean-PGA_18.csv", "hazard_curve-mean-SA(0.1)_18.csv"],
+    )
+
+    main(["filter", export_dir, "--mode", "disaggregation", "--axes", "Dist"])
+    check.equal(capsys.readouterr().out.split(), ["Dist-0_18.csv"])
+
+
+def test_lazy_imports(export_dir):
+    """list and stats do not import matplotlib nor scipy."""
+    for command in (
+        ["list", export_dir],
+        ["stats", export_dir, "--poes", "0.002105", "--output", os.devnull],
+    ):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys\n"
+                "from psha_disag_mod.__main__ import main\n"
+                f"main({command!r})\n"
+                "print([m for m in ('matplotlib', 'scipy') if m in sys.modules])",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        check.equal(result.stdout.splitlines()[-1], "[]")
+
+
+def test_stats(export_dir, tmp_path):
+    path = str(tmp_path / "stats.csv")
+
+    main(["stats", export_dir, "--poes", "0.002105", "0.0001", "--output", path])
+
+    with open(path) as csv_file:
+        lines = csv_file.read().splitlines()
+    check.equal(lines[0], "type_data,poe,return_period,imt,acceleration")
+    check.equal(
+        [line.split(",")[3] for line in lines[1:]], ["PGA", "SA(0.1)", "PGA", "SA(0.1)"]
+    )
+    check.is_true(lines[1].startswith("mean,2.105000E-03,4.750594E+02,PGA,"))
+
+
+def test_stats_disag(export_dir, capsys):
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_18.csv"))
+
+    main(["stats", export_dir, "--disag"])
+
+    lines = capsys.readouterr().out.splitlines()
+    check.is_true(lines[0].startswith("imt,poe,return_period,rlz,rate,mode_mag"))
+    check.equal(len(lines), 1 + 2 * 2 * 2)
+
+
+def test_plot(export_dir, tmp_path, capsys):
+    plot_dir = str(tmp_path / "plots")
+
+    main(["plot", "uhs", export_dir, plot_dir, "--poes", "0.002105"])
+
+    expected = os.path.join(plot_dir, "uhs", "hazard_uhs_475_plot.png")
+    check.equal(capsys.readouterr().out.split(), [expected])
+    check.is_false(os.path.exists(os.path.join(plot_dir, "curve")))
+
+
+def test_ingest_profile(export_dir, tmp_path, capsys):
+    archive = str(tmp_path / "run.psha.zip")
+    profile = str(tmp_path / "profile.json")
+
+    main(["--profile", profile, "ingest", export_dir, "--archive", archive])
+    main(["list", archive, "--type-data", "mean", "--type-acc", "PGA"])
+
+    check.equal(
+        capsys.readouterr().out.split(), [archive, "hazard_curve-mean-PGA_18.csv"]
+    )
+    check.is_true(os.path.exists(profile))
+
+
+def test_watch(export_dir, tmp_path, capsys):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+    for filename in os.listdir(export_dir):
+        if "PGA" in filename:
+            shutil.copy(os.path.join(export_dir, filename), watched)
+    plot_dir = str(tmp_path / "plots")
+
+    main(
+        ["watch", str(watched), plot_dir, "--poll", "0.1", "--settle", "0"]
+        + ["--idle-timeout", "0.5", "--no-inotify"]
+    )
+
+    check.equal(
+        sorted(capsys.readouterr().out.split()),
+        [
+            os.path.join(plot_dir, "curve", "hazard_curve_all_type_acc_plot.png"),
+            os.path.join(plot_dir, "curve", "hazard_curve_all_type_data_PGA_plot.png"),
+        ],
+    )
@@ -0,0 +1,201 @@
+import os
+import warnings
+from dataclasses import replace
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.__main__ import main
+from psha_disag_mod.comparison import (
+    Run,
+    comparison_report,
+    curve_deviations,
+    disaggregation_distances,
+    interpolate_levels,
+    load_disaggregations,
+    parse_run,
+    spectra_deviations,
+    stack_runs,
+)
+from psha_disag_mod.compartiment import filter_filenames
+from psha_disag_mod.disaggregation import read_disaggregation
+from tests.test_disaggregation import write_mag_dist_eps
+
+
+def write_run(export_dir, output_dir, seed, factor, extra_site=False):
+    """Copy of the curves of seed 18 as another seed, the PoEs multiplied by factor"""
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in filter_filenames(os.listdir(export_dir), "psha", seed=[18]):
+        with open(os.path.join(export_dir, filename)) as csv_file:
+            header = csv_file.readline() + csv_file.readline()
+            values = np.loadtxt(csv_file, delimiter=",", ndmin=2)
+        values[:, 3:] *= factor
+        if extra_site:
+            moved = values.copy()
+            moved[:, :2] += 1.0
+            values = np.vstack([moved, values])
+        with open(
+            os.path.join(output_dir, filename[: -len("18.csv")] + f"{seed}.csv"), "w"
+        ) as csv_file:
+            csv_file.write(header)
+            np.savetxt(csv_file, values, fmt="%.6E", delimiter=",")
+
+
+def test_parse_run():
+    check.equal(parse_run("output:14"), Run("output", 14))
+    check.equal(parse_run("/data/output"), Run("/data/output"))
+    check.equal(parse_run("output:14").name, "output_14")
+    check.equal(Run("output", label="v2").name, "v2")
+
+
+def test_interpolate_levels():
+    levels = np.array([0.01, 0.1, 1.0, np.nan])
+    poes = np.array([[1e-1, 1e-3, 1e-5, np.nan], [1e-2, 0.0, 0.0, np.nan]])
+
+    targets = np.array([0.01, 0.1**1.5, 1.0, 2.0])
+
+    interpolated = interpolate_levels(levels, poes, targets)
+
+    check.is_true(np.allclose(interpolated[0, :3], [1e-1, 1e-2, 1e-5]))
+    check.equal(interpolated[1, 2], 0.0)
+    check.is_true(np.isnan(interpolated[:, 3]).all())
+
+
+def test_interpolate_levels_from_zero():
+    levels = np.array([0.0, 0.1, 0.2, 0.4])
+    poes = np.array([0.5, 0.2, 0.05, 0.01])
+    targets = np.array([0.0, 0.05, 0.3, 0.4, np.nan])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        interpolated = interpolate_levels(levels, poes, targets)
+        same = interpolate_levels(levels, poes, levels)
+
+    check.is_true(np.allclose(same, poes))
+    # linear in the level below the first positive one, as the UHS
+    check.is_true(np.allclose(interpolated[:2], [0.5, np.sqrt(0.5 * 0.2)]))
+    check.almost_equal(interpolated[2], 0.05 * 0.2 ** np.log2(1.5))
+    check.almost_equal(interpolated[3], 0.01)
+    check.is_true(np.isnan(interpolated[4]))
+    check.is_true(np.isnan(interpolate_levels(levels[1:], poes[1:], [0.0, 0.05])).all())
+
+
+def test_stack_runs_from_zero(export_dir, tmp_path):
+    other_dir = str(tmp_path / "other")
+    write_run(export_dir, other_dir, 20, 1.0)
+    # the other SA(0.1) grid starts at 0 too, then differs
+    for filename in os.listdir(other_dir):
+        if "SA(0.1)" not in filename:
+            continue
+        path = os.path.join(other_dir, filename)
+        with open(path) as csv_file:
+            text = csv_file.read()
+        with open(path, "w") as csv_file:
+            csv_file.write(text.replace("poe-0.0010000", "poe-0.0015000", 1))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        stack = stack_runs([Run(export_dir), Run(other_dir)], use_cache=False)
+
+    i_imt = stack.imts.index("SA(0.1)")
+    i_data = stack.type_datas.index("mean")
+    check.equal(stack.imls[i_imt, 0], 0.0)
+    reference, other = stack.poes[:, i_data, i_imt, 0]
+    check.equal(other[0], reference[0])
+    check.is_false(np.isnan(other[:2]).any())
+    check.is_true(np.allclose(other[2:], reference[2:], equal_nan=True))
+
+
+def test_stack_runs(export_dir, tmp_path):
+    write_run(export_dir, export_dir, 19, 1.1)
+    other_dir = str(tmp_path / "other")
+    write_run(export_dir, other_dir, 20, 0.5, extra_site=True)
+    runs = [Run(export_dir, 18), Run(export_dir, 19), Run(other_dir)]
+
+    stack = stack_runs(runs)
+
+    check.equal(stack.runs, ["output_18", "output_19", "other"])
+    check.equal(stack.poes.shape, (3, 5, 15, 1, 22))
+    check.equal(stack.sites.shape, (1, 3))
+    check.is_true(np.allclose(stack.poes[1], 1.1 * stack.poes[0], equal_nan=True))
+    check.is_true(np.allclose(stack.poes[2], 0.5 * stack.poes[0], equal_nan=True))
+
+    deviations = curve_deviations(stack)
+    exported = ~np.isnan(stack.poes[0]).all(axis=-1)
+    check.is_true(np.allclose(deviations["min_ratio"][1][exported], 1.1))
+    check.is_true(np.allclose(deviations["max_ratio"][2][exported], 0.5))
+    check.is_true(
+        np.allclose(deviations["max_abs_log_diff"][1][exported], np.log10(1.1))
+    )
+    check.is_true(np.isnan(deviations["mean_log_diff"][:, ~exported]).all())
+
+    spectra = spectra_deviations(stack, [0.002105, 0.0001])
+    check.equal(spectra.shape, (3, 5, 1, 2, 15))
+    check.is_true(np.allclose(spectra[0][~np.isnan(spectra[0])], 0))
+    check.is_true((spectra[1][~np.isnan(spectra[1])] > 0).all())
+    check.is_true((spectra[2][~np.isnan(spectra[2])] < 0).all())
+
+
+def test_disaggregation_distances(tmp_path):
+    expected = write_mag_dist_eps(str(tmp_path / "Mag_Dist_Eps-0_14.csv"))
+    matrix = read_disaggregation(str(tmp_path / "Mag_Dist_Eps-0_14.csv"))
+    values = matrix.values.copy()
+    values[..., 0, 0, 0, :] = 0
+    shifted = replace(matrix, values=values, imts=["SA(0.1)", "PGA"])
+
+    distances = disaggregation_distances([matrix, matrix, shifted])
+
+    check.equal(distances["total_variation"].shape, (3, 2, 2))
+    check.is_true(np.allclose(distances["total_variation"][:2], 0))
+    check.is_true(np.allclose(distances["rate_ratio"][1], 1))
+    rates = np.average(-np.log(1 - expected), axis=-1, weights=matrix.weights)
+    rates = rates.reshape(2, 2, -1)
+    reference = rates / rates.sum(-1, keepdims=True)
+    # The IMTs of the shifted matrix are swapped
+    moved = rates[::-1].copy()
+    moved[..., 0] = 0
+    moved /= moved.sum(-1, keepdims=True)
+    check.is_true(
+        np.allclose(
+            distances["total_variation"][2],
+            0.5 * np.abs(moved - reference).sum(-1),
+        )
+    )
+    check.is_true((distances["hellinger"][2] > 0).all())
+
+    coarse = replace(
+        matrix, bin_edges={**matrix.bin_edges, "Mag": np.array([4.5, 5.5])}
+    )
+    with pytest.raises(ValueError):
+        disaggregation_distances([matrix, coarse])
+
+
+def test_comparison_report(export_dir, tmp_path):
+    write_run(export_dir, export_dir, 19, 1.1)
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_18.csv"))
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_19.csv"))
+    runs = [Run(export_dir, 18), Run(export_dir, 19)]
+
+    report = comparison_report(
+        stack_runs(runs),
+        poes=[0.002105],
+        matrices=load_disaggregations(runs),
+    )
+
+    check.equal(list(report["run"]), ["output_18", "output_19"])
+    check.equal(list(report["curves"]), [47, 47])
+    # The PoEs of the copy are rounded to 7 digits
+    log_diff = pytest.approx(np.log10(1.1), rel=1e-4)
+    check.equal(list(report["max_abs_log_diff"]), [0, log_diff])
+    check.equal(report["mean_abs_log_diff"][1], log_diff)
+    check.equal(report["worst_site"][1], 0)
+    check.greater(report["max_uhs_deviation"][1], 0)
+    check.equal(list(report["max_total_variation"]), [0, 0])
+
+    path = str(tmp_path / "report.csv")
+    main(["compare", f"{export_dir}:18", f"{export_dir}:19", "--output", path])
+    with open(path) as csv_file:
+        lines = csv_file.read().splitlines()
+    check.equal(len(lines), 3)
+    check.is_true(lines[2].startswith("output_19,47,4.139"))
@@ -3,7 +3,14 @@ from typing import List, Dict
 import pytest
 import pytest_check as check
 
-from psha_disag_mod.compartiment import read_psha_params, filter_filenames
+from psha_disag_mod.compartiment import (
+    FilenameIndex,
+    filter_filenames,
+    PshaFileParams,
+    read_disag_params,
+    read_psha_params,
+    read_psha_params_many,
+)
 
 
 def generate_filename(startname, type_filename, type_data, type_acc, seed):
@@ -630,3 +637,78 @@ class TestCompartimentation:
 
         print(filtered)
         check.equal(filtered, expected_filtered)
+
+
+def test_read_psha_params_many():
+    filenames, expected_params = generate_filenames(
+        startnames=("hazard", "quantile"),
+        type_filenames=("uhs", "curve"),
+        type_datas={
+            "hazard": ["mean", "rlz-001"],
+            "quantile": ["0.5", "0.95"],
+        },
+        type_accs=["PGA", "SA(0.1)"],
+        seeds=[0, 14],
+    )
+    records = read_psha_params_many(filenames + ["Mag_Dist-0_14.csv", "job.ini"])
+
+    check.equal(records[-2:], [None, None])
+    for record, expected in zip(records, expected_params):
+        check.equal(record, PshaFileParams(**expected))
+
+
+def test_read_psha_params_cached_copy():
+    params = read_psha_params("hazard_curve-mean-PGA_14.csv")
+    params["seed"] = 0
+
+    check.equal(read_psha_params("hazard_curve-mean-PGA_14.csv")["seed"], 14)
+
+
+def test_read_disag_params():
+    params = read_disag_params("Mag_Dist_Eps-0_14.csv")
+    check.equal(
+        params, {"disaggregation_axes": ["Mag", "Dist", "Eps"], "site": 0, "seed": 14}
+    )
+
+
+@pytest.mark.parametrize("index", [list, FilenameIndex])
+def test_filter_sites(index):
+    filenames = index(
+        [
+            "Mag_Dist-0_14.csv",
+            "Mag_Dist-1_14.csv",
+            "Mag_Dist-12_14.csv",
+            "Dist-12_14.csv",
+            "hazard_curve-mean-PGA_14.csv",
+        ]
+    )
+
+    check.equal(
+        filter_filenames(filenames, "disaggregation", sites=[1, 12]),
+        ["Mag_Dist-1_14.csv", "Mag_Dist-12_14.csv", "Dist-12_14.csv"],
+    )
+    check.equal(
+        filter_filenames(
+            filenames, "disaggregation", disaggregation_patterns=["Mag"], sites=[12]
+        ),
+        ["Mag_Dist-12_14.csv"],
+    )
+    with pytest.raises(ValueError):
+        filter_filenames(filenames, "psha", sites=[0])
+
+
+class TestFilenameIndex(TestCompartimentation):
+    """Same expectations as the linear filter, on an index of the filenames"""
+
+    @pytest.fixture(autouse=True)
+    def setup_index(self, setup):
+        self.filenames = FilenameIndex(self.filenames)
+
+    def test_from_directory(self, tmp_path):
+        for filename in ("hazard_curve-mean-PGA_18.csv", "Dist-0_18.csv", "job.ini"):
+            (tmp_path / filename).touch()
+
+        index = FilenameIndex.from_directory(str(tmp_path))
+
+        check.equal(filter_filenames(index, "psha"), ["hazard_curve-mean-PGA_18.csv"])
+        check.equal(filter_filenames(index, "disaggregation"), ["Dist-0_18.csv"])
@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.disag_analytics import (
+    marginal_poes,
+    marginal_rates,
+    mean_values,
+    modal_bins,
+    poe_to_rate,
+    rate_to_poe,
+    scenario_table,
+    write_table,
+)
+from psha_disag_mod.disaggregation import read_disaggregation
+from tests.test_disaggregation import write_mag_dist_eps
+
+MAGS = np.array([4.75, 5.25])
+DISTS = np.array([5.0, 15.0, 25.0])
+EPS = np.array([-2.0, 0.0, 2.0])
+
+
+@pytest.fixture
+def mag_dist_eps(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+    return read_disaggregation(path), expected
+
+
+def test_poe_to_rate():
+    poes = np.array([0.0, 0.002105, 0.5, 1.0])
+
+    rates = poe_to_rate(poes, 50.0)
+
+    check.is_true(np.allclose(rates[:3], -np.log(1 - poes[:3]) / 50.0))
+    check.equal(rates[3], np.inf)
+    check.is_true(np.allclose(rate_to_poe(rates, 50.0), poes))
+
+
+def test_marginals(mag_dist_eps):
+    matrix, expected = mag_dist_eps
+    rates = -np.log(1 - expected)
+
+    dist_mag = marginal_rates(matrix, ["Dist", "Mag"])
+
+    check.equal(dist_mag.shape, (2, 2, 3, 2, 2))
+    check.is_true(np.allclose(dist_mag, np.swapaxes(rates.sum(axis=4), 2, 3)))
+    check.is_true(np.allclose(marginal_rates(matrix, ["Eps"]), rates.sum(axis=(2, 3))))
+    # independent bins: adding their rates is combining 1 - prod(1 - poe)
+    mag_dist = marginal_poes(matrix, ["Mag", "Dist"])
+    check.is_true(np.allclose(mag_dist, 1 - np.prod(1 - expected, axis=4)))
+    check.is_true(np.array_equal(matrix.marginal(["Mag", "Dist"]), mag_dist))
+    with pytest.raises(ValueError):
+        marginal_rates(matrix, ["Lon"])
+
+
+def test_modes_and_means(mag_dist_eps):
+    matrix, expected = mag_dist_eps
+    rates = -np.log(1 - expected)
+
+    modes = modal_bins(matrix)
+    means = mean_values(matrix)
+
+    for i, j, r in np.ndindex(2, 2, 2):
+        bins = rates[i, j, ..., r]
+        mode = np.unravel_index(np.argmax(bins), bins.shape)
+        check.equal(tuple(modes[axis][i, j, r] for axis in matrix.axes), mode)
+        mags, dists, eps = np.meshgrid(MAGS, DISTS, EPS, indexing="ij")
+        for axis, centers in zip(matrix.axes, (mags, dists, eps)):
+            check.almost_equal(
+                means[axis][i, j, r], (bins * centers).sum() / bins.sum()
+            )
+
+
+def test_scenario_table(mag_dist_eps, tmp_path):
+    matrix, expected = mag_dist_eps
+    matrix.values[1, 0] = 0
+
+    table = scenario_table(matrix)
+
+    check.equal(
+        list(table),
+        ["imt", "poe", "return_period", "rlz", "rate"]
+        + ["mode_mag", "mean_mag", "mode_dist", "mean_dist", "mode_eps", "mean_eps"],
+    )
+    check.equal(list(table["imt"]), ["PGA"] * 4 + ["SA(0.1)"] * 4)
+    check.equal(list(table["rlz"]), [2, 7] * 4)
+    check.is_true(
+        np.allclose(
+            table["poe"], [0.002105] * 2 + [0.0001] * 2 + [0.002105] * 2 + [0.0001] * 2
+        )
+    )
+    check.is_true(np.allclose(table["return_period"][:2], 1 / 0.002105))
+    check.almost_equal(table["rate"][0], -np.log(1 - expected[0, 0, ..., 0]).sum())
+    # The bins encode their position, the last one contributes the most
+    check.equal(table["mode_mag"][0], 5.25)
+    check.equal(table["mode_dist"][0], 25.0)
+    check.equal(table["mode_eps"][0], 2.0)
+    check.is_true(np.isnan(table["mode_mag"][4:6]).all())
+    check.is_true(np.isnan(table["mean_dist"][4:6]).all())
+    check.equal(table["rate"][4], 0)
+
+    path = str(tmp_path / "scenarios.csv")
+    write_table(path, table)
+    with open(path) as csv_file:
+        lines = csv_file.read().splitlines()
+    check.equal(len(lines), 9)
+    check.is_true(lines[1].startswith("PGA,2.105000E-03,4.750594E+02,2,"))
+
+
+def test_scenario_table_trt(tmp_path):
+    path = tmp_path / "Mag_TRT-0_14.csv"
+    path.write_text(
+        '#,,,,,"investigation_time=50.0, mag_bin_edges=[4.5, 5.0, 5.5], '
+        "tectonic_region_types=['Stable Shallow Crust', 'Active Shallow Crust'], "
+        'rlz_ids=[0], weights=[1.0]"\n'
+        "imt,poe,mag,trt,rlz0\n"
+        "PGA,0.1,4.75,Stable Shallow Crust,1.0E-02\n"
+        "PGA,0.1,4.75,Active Shallow Crust,2.0E-02\n"
+        "PGA,0.1,5.25,Stable Shallow Crust,3.0E-02\n"
+    )
+
+    table = scenario_table(read_disaggregation(str(path)))
+
+    check.equal(list(table["mode_trt"]), ["Stable Shallow Crust"])
+    check.equal(list(table["mode_mag"]), [5.25])
+    check.is_not_in("mean_trt", table)
+    check.almost_equal(table["return_period"][0], 500.0)
+    rates = -np.log(1 - np.array([1e-2, 2e-2, 3e-2])) / 50.0
+    check.almost_equal(table["rate"][0], rates.sum())
+    check.almost_equal(
+        table["mean_mag"][0], (4.75 * rates[:2].sum() + 5.25 * rates[2]) / rates.sum()
+    )
+
+
+def test_scenario_table_dist(export_dir):
+    matrix = read_disaggregation(os.path.join(export_dir, "Dist-0_18.csv"))
+
+    table = scenario_table(matrix)
+
+    check.equal(len(table["imt"]), 15 * 4)
+    check.is_true((table["mode_dist"] >= 5.0).all())
+    check.is_true((table["mean_dist"] <= 250.0).all())
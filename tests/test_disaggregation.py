@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.disaggregation import (
+    find_disaggregation_file,
+    read_disaggregation,
+)
+
+MAG_DIST_EPS_HEADER = (
+    "#,,,,,,,\"generated_by='OpenQuake engine 3.15.0', investigation_time=1.0, "
+    "mag_bin_edges=[4.5, 5.0, 5.5], dist_bin_edges=[0.0, 10.0, 20.0, 30.0], "
+    "eps_bin_edges=[-3.0, -1.0, 1.0, 3.0], "
+    "tectonic_region_types=['Stable Shallow Crust', 'Active Shallow Crust'], "
+    'rlz_ids=[2, 7], weights=[0.25, 0.75], lon=5.73, lat=45.19"\n'
+)
+
+
+def write_mag_dist_eps(path, imts=("PGA", "SA(0.1)"), poes=(0.002105, 0.0001)):
+    """Synthetic Mag_Dist_Eps file, the value of a bin encodes its position"""
+    expected = np.zeros((len(imts), len(poes), 2, 3, 3, 2))
+    with open(path, "w") as csv_file:
+        csv_file.write(MAG_DIST_EPS_HEADER)
+        csv_file.write("imt,poe,mag,dist,eps,rlz2,rlz7\n")
+        for i, imt in enumerate(imts):
+            for j, poe in enumerate(poes):
+                for m, mag in enumerate((4.75, 5.25)):
+                    for d, dist in enumerate((5.0, 15.0, 25.0)):
+                        for e, eps in enumerate((-2.0, 0.0, 2.0)):
+                            value = (i + 1) * 1e-3 + j * 1e-4 + m * 1e-5 + d * 1e-6
+                            value += e * 1e-7
+                            expected[i, j, m, d, e] = value, 2 * value
+                            csv_file.write(
+                                f"{imt},{poe},{mag:.5E},{dist:.5E},{eps:.5E},"
+                                f"{value:.8E},{2 * value:.8E}\n"
+                            )
+    return expected
+
+
+def test_read_dist(export_dir):
+    matrix = read_disaggregation(os.path.join(export_dir, "Dist-0_18.csv"))
+
+    check.equal(matrix.axes, ["Dist"])
+    check.equal(matrix.imts[:2], ["PGA", "SA(0.03)"])
+    check.is_true(np.allclose(matrix.poes, [0.002105, 0.000404, 0.0002, 0.0001]))
+    check.equal(matrix.values.shape, (15, 4, 25, 1))
+    check.equal(matrix.rlz_ids, [5])
+    check.equal(matrix.site, (5.72999999999999, 45.19))
+    check.equal(matrix.matrix("PGA", 0.002105, rlz=5)[1], 1.00927e-03)
+    check.is_true(np.allclose(matrix.bin_centers("Dist")[:2], [5.0, 15.0]))
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 100])
+def test_read_chunks(tmp_path, chunksize):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+
+    matrix = read_disaggregation(path, chunksize=chunksize)
+
+    check.equal(matrix.axes, ["Mag", "Dist", "Eps"])
+    check.equal(matrix.imts, ["PGA", "SA(0.1)"])
+    check.equal(matrix.rlz_ids, [2, 7])
+    check.is_true(np.allclose(matrix.weights, [0.25, 0.75]))
+    check.is_true(np.allclose(matrix.values, expected))
+
+
+def test_read_preallocated(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+
+    matrix = read_disaggregation(path, imts=["SA(0.1)"], poes=[0.0001, 0.002105])
+
+    check.equal(matrix.imts, ["SA(0.1)", "PGA"])
+    check.is_true(np.allclose(matrix.poes, [0.0001, 0.002105]))
+    check.is_true(np.allclose(matrix.values, expected[::-1, ::-1]))
+
+
+def test_read_cached(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+
+    first = read_disaggregation(path, use_cache=True)
+    cached = read_disaggregation(path, use_cache=True)
+
+    check.is_true(np.allclose(cached.values, expected))
+    check.is_instance(cached.values, np.memmap)
+    check.is_false(cached.values.flags.writeable)
+    check.is_true(np.array_equal(cached.bin_edges["Mag"], [4.5, 5.0, 5.5]))
+    check.equal(
+        (cached.axes, cached.imts, cached.rlz_ids),
+        (first.axes, first.imts, first.rlz_ids),
+    )
+    check.equal(cached.metadata, first.metadata)
+
+    reordered = read_disaggregation(path, imts=["SA(0.1)"], use_cache=True)
+    check.equal(reordered.imts, ["SA(0.1)", "PGA"])
+    os.remove(path)
+    write_mag_dist_eps(path, imts=("PGA",))
+    os.utime(path, ns=(0, 0))
+    check.equal(read_disaggregation(path, use_cache=True).imts, ["PGA"])
+
+
+def test_marginal(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+    matrix = read_disaggregation(path)
+
+    mag_dist = matrix.marginal(["Mag", "Dist"])
+
+    check.equal(mag_dist.shape, (2, 2, 2, 3, 2))
+    check.is_true(np.allclose(mag_dist, 1 - np.prod(1 - expected, axis=4)))
+
+
+def test_find_disaggregation_file(export_dir):
+    path = find_disaggregation_file(export_dir, ["Dist"])
+
+    check.equal(os.path.basename(path), "Dist-0_18.csv")
+    with pytest.raises(FileNotFoundError):
+        find_disaggregation_file(export_dir, ["Mag", "Dist"])
+
+
+def test_read_trt(tmp_path):
+    path = tmp_path / "TRT-0_14.csv"
+    path.write_text(
+        MAG_DIST_EPS_HEADER
+        + "imt,poe,trt,rlz2,rlz7\n"
+        + "PGA,0.0001,Active Shallow Crust,1.0E-03,2.0E-03\n"
+        + "PGA,0.0001,Stable Shallow Crust,3.0E-03,4.0E-03\n"
+    )
+
+    matrix = read_disaggregation(str(path))
+    read_disaggregation(str(path), use_cache=True)
+    cached = read_disaggregation(str(path), use_cache=True)
+
+    check.equal(
+        matrix.bin_centers("TRT"), ["Stable Shallow Crust", "Active Shallow Crust"]
+    )
+    check.equal(cached.bin_edges, matrix.bin_edges)
+    check.is_true(np.array_equal(cached.values, matrix.values))
+    check.is_true(np.allclose(matrix.values[0, 0], [[3e-3, 4e-3], [1e-3, 2e-3]]))
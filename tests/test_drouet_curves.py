@@ -0,0 +1,308 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.drouet_curves import (
+    load_hazard_curves,
+    logic_tree_statistics,
+    read_hazard_curve,
+    uhs_table,
+    uniform_hazard_spectra,
+    weighted_quantiles,
+)
+from psha_disag_mod.euro_xml import realization_weights
+from psha_disag_mod.utils import CACHE_DIRNAME
+
+
+def test_read_hazard_curve(export_dir):
+    metadata, sites, imls, poes = read_hazard_curve(
+        os.path.join(export_dir, "hazard_curve-mean-PGA_18.csv")
+    )
+
+    check.equal(metadata["kind"], "mean")
+    check.equal(metadata["imt"], "PGA")
+    check.is_true(np.allclose(sites, [[5.73, 45.19, 0.0]]))
+    check.equal(imls.shape, (22,))
+    check.equal(imls[0], 0.0005)
+    check.equal(poes.shape, (1, 22))
+    check.equal(poes[0, 0], 3.021727e-01)
+
+
+def test_load_hazard_curves(export_dir):
+    curves = load_hazard_curves(export_dir)
+
+    check.equal(curves.type_datas, ["mean", "rlz-000", "rlz-001", "rlz-002", "rlz-003"])
+    check.equal(curves.imts[:3], ["PGA", "SA(0.03)", "SA(0.05)"])
+    check.equal(curves.poes.shape, (5, 15, 1, 22))
+    # rlz-000 was only exported for a few IMTs
+    check.is_true(np.isnan(curves.poes[1, 0]).all())
+    imls, poes = curves.curve("rlz-001", "SA(0.1)")
+    _, _, expected_imls, expected_poes = read_hazard_curve(
+        os.path.join(export_dir, "hazard_curve-rlz-001-SA(0.1)_18.csv")
+    )
+    check.is_true(np.array_equal(imls, expected_imls))
+    check.is_true(np.array_equal(poes, expected_poes[0]))
+
+
+def test_load_hazard_curves_patterns(export_dir):
+    curves = load_hazard_curves(export_dir, type_data=["mean"], type_acc=["PGA"])
+
+    check.equal(curves.type_datas, ["mean"])
+    check.equal(curves.imts, ["PGA"])
+
+
+def test_load_hazard_curves_cache(export_dir):
+    curves = load_hazard_curves(export_dir)
+    check.equal(len(os.listdir(os.path.join(export_dir, CACHE_DIRNAME))), 1)
+
+    cached = load_hazard_curves(export_dir)
+    check.is_true(np.array_equal(cached.poes, curves.poes, equal_nan=True))
+    check.equal(cached.metadata, curves.metadata)
+    check.equal(cached.type_datas, curves.type_datas)
+    for array in (curves.poes, cached.poes, cached.imls, cached.sites):
+        check.is_instance(array, np.memmap)
+        check.is_false(array.flags.writeable)
+
+    path = os.path.join(export_dir, "hazard_curve-mean-PGA_18.csv")
+    with open(path) as csv_file:
+        lines = csv_file.readlines()
+    lines[2] = lines[2].replace("3.021727E-01", "3.000000E-01")
+    with open(path, "w") as csv_file:
+        csv_file.writelines(lines)
+    os.utime(path, ns=(0, 0))
+
+    reloaded = load_hazard_curves(export_dir)
+    check.equal(reloaded.curve("mean", "PGA")[1][0], 0.3)
+
+
+def test_load_hazard_curves_concurrent(export_dir):
+    expected = load_hazard_curves(export_dir, use_cache=False)
+
+    with ProcessPoolExecutor(4) as executor:
+        loaded = list(executor.map(load_hazard_curves, [export_dir] * 8))
+
+    for curves in loaded:
+        check.is_true(np.array_equal(curves.poes, expected.poes, equal_nan=True))
+    cache_names = os.listdir(os.path.join(export_dir, CACHE_DIRNAME))
+    check.is_false(any(".tmp-" in name for name in cache_names))
+
+
+def test_load_hazard_curves_several_runs(export_dir):
+    open(os.path.join(export_dir, "hazard_curve-mean-PGA_19.csv"), "w").close()
+
+    with pytest.raises(ValueError):
+        load_hazard_curves(export_dir, use_cache=False)
+
+
+def write_hazard_curve(path, kind, imt, imls, poes):
+    """Write a hazard curve of one site in the format of OpenQuake."""
+    with open(path, "w") as csv_file:
+        csv_file.write(
+            f"#,,,\"generated_by='OpenQuake engine 3.15.0', kind='{kind}', "
+            f"investigation_time=1.0, imt='{imt}'\"\n"
+        )
+        csv_file.write(
+            ",".join(["lon", "lat", "depth"] + [f"poe-{iml:.7f}" for iml in imls])
+            + "\n"
+        )
+        csv_file.write(
+            ",".join(["5.73000", "45.19000", "0.00000"] + [f"{p:E}" for p in poes])
+            + "\n"
+        )
+
+
+def reference_quantile(quantile, curves, weights):
+    """``quantile_curve`` of OpenQuake, one element at a time."""
+    result = np.zeros(curves.shape[1:])
+    for idx, _ in np.ndenumerate(result):
+        data = curves[(slice(None),) + idx]
+        order = np.argsort(data)
+        result[idx] = np.interp(quantile, np.cumsum(weights[order]), data[order])
+    return result
+
+
+@pytest.fixture
+def realizations_dir(tmp_path, model_dir):
+    """Run of 16 realizations of the Drouet logic trees, with its mean and quantiles."""
+    _, weights = realization_weights(
+        os.path.join(model_dir, "logicTree_SRCS.xml"),
+        os.path.join(model_dir, "logicTree_GMPE.xml"),
+    )
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    rng = np.random.default_rng(0)
+    imls = np.geomspace(0.0005, 2.0, 22)
+    poes = {
+        imt: np.exp(-np.outer(rng.uniform(5, 15, len(weights)), imls**0.5))
+        for imt in ["PGA", "SA(0.1)"]
+    }
+    for imt, rlz_poes in poes.items():
+        for rlz, rlz_poe in enumerate(rlz_poes):
+            write_hazard_curve(
+                output_dir / f"hazard_curve-rlz-{rlz:03d}-{imt}_7.csv",
+                f"rlz-{rlz:03d}",
+                imt,
+                imls,
+                rlz_poe,
+            )
+        write_hazard_curve(
+            output_dir / f"hazard_curve-mean-{imt}_7.csv",
+            "mean",
+            imt,
+            imls,
+            weights @ rlz_poes,
+        )
+        for quantile in [0.05, 0.5, 0.95]:
+            write_hazard_curve(
+                output_dir / f"quantile_curve-{quantile}-{imt}_7.csv",
+                f"quantile-{quantile}",
+                imt,
+                imls,
+                reference_quantile(quantile, rlz_poes, weights),
+            )
+    return str(output_dir), weights
+
+
+def test_realization_weights(model_dir):
+    paths, weights = realization_weights(
+        os.path.join(model_dir, "logicTree_SRCS.xml"),
+        os.path.join(model_dir, "logicTree_GMPE.xml"),
+    )
+
+    check.equal(len(paths), 16)
+    check.equal(paths[1], ("model#0", "gmpe_Stable_2"))
+    check.equal(paths[4][0], "model#1")
+    check.is_true(np.isclose(weights[0], 0.22 * 0.25))
+    check.is_true(np.isclose(weights[-1], 0.34 * 0.25))
+    check.is_true(np.isclose(weights.sum(), 1))
+
+
+def test_realization_weights_reweighted(model_dir):
+    _, weights = realization_weights(
+        os.path.join(model_dir, "logicTree_SRCS.xml"),
+        os.path.join(model_dir, "logicTree_GMPE.xml"),
+        branch_weights={"gmpe_Stable_1": 1.0, "gmpe_Stable_2": 0.0},
+    )
+
+    check.is_true(np.isclose(weights[0], 0.22))
+    check.equal(weights[1], 0.0)
+
+
+def test_weighted_quantiles():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(size=(16, 3, 1, 5))
+    values[:, 0, 0, 0] = 0.1
+    weights = rng.uniform(size=16)
+    weights /= weights.sum()
+
+    quantiles = weighted_quantiles(values, weights, [0.01, 0.05, 0.5, 0.95, 1.0])
+
+    for i, quantile in enumerate([0.01, 0.05, 0.5, 0.95, 1.0]):
+        check.is_true(
+            np.allclose(quantiles[i], reference_quantile(quantile, values, weights))
+        )
+
+
+def test_logic_tree_statistics(realizations_dir):
+    export_dir, weights = realizations_dir
+    rlz_curves = load_hazard_curves(export_dir, type_data=["rlz-"])
+
+    statistics = logic_tree_statistics(rlz_curves, weights)
+
+    check.equal(statistics.type_datas, ["mean", "0.05", "0.5", "0.95"])
+    check.equal(statistics.imts, ["PGA", "SA(0.1)"])
+    check.equal(statistics.poes.shape, (4, 2, 1, 22))
+    exported = load_hazard_curves(export_dir, type_data=["mean"])
+    check.is_true(np.allclose(statistics.poes[0], exported.poes[0], rtol=1e-5))
+    for i, quantile in enumerate(["0.05", "0.5", "0.95"]):
+        exported = load_hazard_curves(
+            export_dir, startname=["quantile"], type_data=[quantile]
+        )
+        check.is_true(np.allclose(statistics.poes[1 + i], exported.poes[0], rtol=1e-5))
+
+
+def test_logic_tree_statistics_missing_realizations(export_dir, model_dir):
+    _, weights = realization_weights(
+        os.path.join(model_dir, "logicTree_SRCS.xml"),
+        os.path.join(model_dir, "logicTree_GMPE.xml"),
+    )
+    rlz_curves = load_hazard_curves(export_dir, type_data=["rlz-"])
+
+    with pytest.raises(ValueError):
+        logic_tree_statistics(rlz_curves, weights)
+    # rlz-000 was not exported for PGA
+    with pytest.raises(ValueError):
+        logic_tree_statistics(rlz_curves, weights[:4])
+
+
+def reference_uhs(poe, imls, curve):
+    """``compute_hazard_maps`` of OpenQuake, for one curve and one PoE."""
+    log_curve = np.log(np.maximum(curve[::-1], 1e-30))
+    if np.log(poe) > log_curve[-1]:
+        return 0.0
+    with np.errstate(divide="ignore"):
+        log_imls = np.log(imls[::-1])
+    return np.exp(np.interp(np.log(poe), log_curve, log_imls))
+
+
+def test_uniform_hazard_spectra(export_dir):
+    curves = load_hazard_curves(export_dir)
+    poes = [0.5, 0.002105, 0.000404, 0.0002, 0.0001, 1e-12]
+
+    spectra = uniform_hazard_spectra(curves, poes)
+
+    check.equal(spectra.shape, (5, 1, 6, 15))
+    check.is_true(np.isnan(spectra[0, 0, :, curves.imts.index("SA(0.05)")]).all())
+    for i_data, i_imt in [(0, 0), (0, 3), (2, 0), (2, 14), (4, 7)]:
+        expected = [
+            reference_uhs(poe, curves.imls[i_imt], curves.poes[i_data, i_imt, 0])
+            for poe in poes
+        ]
+        check.is_true(np.allclose(spectra[i_data, 0, :, i_imt], expected))
+    check.equal(spectra[0, 0, 0, 0], 0.0)
+    check.equal(spectra[0, 0, -1, 0], curves.imls[0, -1])
+
+
+def test_uhs_table(export_dir):
+    curves = load_hazard_curves(export_dir)
+    poes = [0.002105, 0.0001]
+
+    table = uhs_table(curves, poes, investigation_time=50.0)
+
+    check.equal(len(table["imt"]), 5 * 2 * 15)
+    check.equal(list(table["type_data"][:31:15]), ["mean", "mean", "rlz-000"])
+    check.equal(list(table["imt"][:2]), ["PGA", "SA(0.03)"])
+    check.is_true(
+        np.allclose(
+            table["return_period"][:31:15], [50 / 0.002105, 50 / 0.0001, 50 / 0.002105]
+        )
+    )
+    check.is_true(
+        np.array_equal(
+            table["acceleration"],
+            uniform_hazard_spectra(curves, poes).ravel(),
+            equal_nan=True,
+        )
+    )
+
+
+def test_uniform_hazard_spectra_zero_level(tmp_path):
+    imls = np.array([0.0, 0.1, 0.2, 0.4])
+    # the bump of the last level is ignored, the curve being made monotone
+    poes = np.array([0.1, 0.01, 0.001, 0.002])
+    write_hazard_curve(
+        tmp_path / "hazard_curve-mean-SA(1.0)_3.csv", "mean", "SA(1.0)", imls, poes
+    )
+    curves = load_hazard_curves(str(tmp_path), use_cache=False)
+
+    spectra = uniform_hazard_spectra(curves, [np.sqrt(0.1 * 0.01), 0.005, 0.001])
+
+    # linear in the level against the log of the PoE in the first bin
+    check.is_true(np.isclose(spectra[0, 0, 0, 0], 0.05))
+    check.is_true(
+        np.isclose(spectra[0, 0, 1, 0], 0.1 * 2 ** (np.log(0.5) / np.log(0.1)))
+    )
+    check.is_true(np.isclose(spectra[0, 0, 2, 0], 0.2))
@@ -0,0 +1,216 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.euro_xml import (
+    gr_rates,
+    logic_tree_gr_rates,
+    parse_source_model,
+    read_logic_tree,
+    read_source_model,
+)
+from psha_disag_mod.utils import CACHE_DIRNAME
+
+POINT_SOURCE_MODEL = """<?xml version='1.0' encoding='UTF8'?>
+<nrml xmlns:gml="http://www.opengis.net/gml" xmlns="http://openquake.org/xmlns/nrml/0.5">
+  <sourceModel name="POINTS">
+    <sourceGroup name="Group1" tectonicRegion="Active Shallow Crust">
+      <pointSource id="P1" name="point">
+        <pointGeometry>
+          <gml:Point><gml:pos>5.7 45.2</gml:pos></gml:Point>
+          <upperSeismoDepth>0.0</upperSeismoDepth>
+          <lowerSeismoDepth>10.0</lowerSeismoDepth>
+        </pointGeometry>
+        <magScaleRel>WC1994</magScaleRel>
+        <ruptAspectRatio>1.5</ruptAspectRatio>
+        <truncGutenbergRichterMFD aValue="2.0" bValue="1.0" minMag="4.5" maxMag="6.5"/>
+        <nodalPlaneDist>
+          <nodalPlane probability="1.0" strike="0.0" dip="90" rake="0"/>
+        </nodalPlaneDist>
+        <hypoDepthDist>
+          <hypoDepth probability="1.0" depth="5.0"/>
+        </hypoDepthDist>
+      </pointSource>
+      {extra}
+    </sourceGroup>
+  </sourceModel>
+</nrml>
+"""
+
+
+def test_area_sources(model_dir):
+    model = parse_source_model(os.path.join(model_dir, "area_sources_GTR_1.xml"))
+
+    check.equal(model.name, "GTR")
+    check.equal(len(model), 90)
+    source = model.source(0)
+    check.equal((source.id, source.name), ("ACC", "ALPILLE_CRAU_CAMARGUE"))
+    check.equal(source.kind, "areaSource")
+    check.equal(source.tectonic_region, "Stable Shallow Crust")
+    check.equal(source.geometry.shape, (12, 2))
+    check.is_true(np.allclose(source.geometry[0], [5.034808, 43.527264]))
+    check.equal((source.upper_depth, source.lower_depth), (0.1, 20.0))
+    check.is_true(np.allclose(source.mfd, [[1.7195482312927952, 0.9405, 4.0, 6.3]]))
+    check.is_none(source.bin_width)
+    check.equal(source.nodal_planes.shape, (18, 4))
+    check.is_true(np.allclose(source.nodal_planes[-1], [1 / 24, 270.0, 75, -90]))
+    check.is_true(np.allclose(source.hypo_depths[:, 1], [5.8, 11.5, 17.2]))
+    check.equal(model.source(1).geometry.shape, (28, 2))
+
+
+def test_multi_point_sources(model_dir):
+    model = parse_source_model(os.path.join(model_dir, "smoothed_source_model_1.xml"))
+
+    check.equal(len(model), 90)
+    source = model.source(0)
+    check.equal((source.id, source.kind), ("MPS_ACC", "multiPointSource"))
+    check.equal(source.geometry.shape, (49, 2))
+    check.equal(source.mfd.shape, (49, 4))
+    check.is_true(np.allclose(source.mfd[0], [-0.542, 0.87, 4.0, 6.3]))
+    check.is_true(np.allclose(source.mfd[7, 0], -0.472439))
+    check.equal(source.bin_width, 0.1)
+
+
+def test_point_source(tmp_path):
+    path = tmp_path / "points.xml"
+    path.write_text(POINT_SOURCE_MODEL.format(extra=""))
+
+    source = parse_source_model(str(path)).source(0)
+
+    check.equal(source.kind, "pointSource")
+    check.equal(source.tectonic_region, "Active Shallow Crust")
+    check.is_true(np.allclose(source.geometry, [[5.7, 45.2]]))
+    check.equal(source.rupt_aspect_ratio, 1.5)
+
+
+def test_unsupported_source(tmp_path):
+    path = tmp_path / "faults.xml"
+    path.write_text(
+        POINT_SOURCE_MODEL.format(extra='<simpleFaultSource id="F1" name="fault"/>')
+    )
+
+    with pytest.raises(ValueError, match="simpleFaultSource F1"):
+        parse_source_model(str(path))
+
+    path.write_text(
+        POINT_SOURCE_MODEL.format(extra="").replace(
+            '<truncGutenbergRichterMFD aValue="2.0" bValue="1.0" minMag="4.5" '
+            'maxMag="6.5"/>',
+            '<incrementalMFD minMag="4.5" binWidth="0.1"/>',
+        )
+    )
+    with pytest.raises(ValueError, match="incrementalMFD MFD of source P1"):
+        parse_source_model(str(path))
+
+
+def test_read_source_model_cache(model_dir):
+    path = os.path.join(model_dir, "area_sources_EDF_1.xml")
+
+    model = read_source_model(path)
+    cached = read_source_model(path)
+
+    check.equal(len(os.listdir(os.path.join(model_dir, CACHE_DIRNAME))), 1)
+    check.is_true(np.array_equal(cached.id, model.id))
+    check.is_true(np.array_equal(cached.geometry, model.geometry))
+    check.is_true(np.array_equal(cached.offsets["mfd"], model.offsets["mfd"]))
+    check.equal(cached.source(3).name, model.source(3).name)
+    check.is_true(np.array_equal(cached.source(3).mfd, model.source(3).mfd))
+
+    with open(path) as xml_file:
+        content = xml_file.read()
+    with open(path, "w") as xml_file:
+        xml_file.write(content.replace('maxMag="', 'maxMag="1', 1))
+    check.not_equal(read_source_model(path).mfd[0, 3], model.mfd[0, 3])
+
+
+def reference_gr_rates(a, b, min_mag, max_mag, bin_width):
+    """Bins of a truncated Gutenberg-Richter MFD, one at a time as OpenQuake does"""
+    first = round(min_mag / bin_width) * bin_width + bin_width / 2
+    last = round(max_mag / bin_width) * bin_width - bin_width / 2
+    n_bins = int(round((last - first) / bin_width)) + 1
+    rates = {}
+    for i in range(n_bins):
+        mag = first + i * bin_width
+        mag_hi = mag + bin_width / 2
+        # the top bin ends at the unrounded maxMag
+        if mag >= max_mag - bin_width / 2:
+            mag_hi = max_mag
+        rates[round(mag, 2)] = 10 ** (a - b * (mag - bin_width / 2)) - 10 ** (
+            a - b * mag_hi
+        )
+    return rates
+
+
+@pytest.mark.parametrize(
+    "filename", ["area_sources_IRSN_1.xml", "smoothed_source_model_1.xml"]
+)
+def test_gr_rates(model_dir, filename):
+    model = parse_source_model(os.path.join(model_dir, filename))
+
+    rates = gr_rates(model, bin_width=0.1)
+
+    check.equal(rates.rates.shape, (len(model), len(rates.mags)))
+    for i in (0, len(model) // 2, len(model) - 1):
+        expected = np.zeros(len(rates.mags))
+        for row in model.source(i).mfd:
+            for mag, rate in reference_gr_rates(*row, 0.1).items():
+                expected[np.argmin(np.abs(rates.mags - mag))] += rate
+        check.is_true(np.allclose(rates.rates[i], expected))
+
+
+def test_gr_rates_off_grid_max_mag(tmp_path):
+    path = tmp_path / "point.xml"
+    path.write_text(
+        POINT_SOURCE_MODEL.format(extra="").replace(
+            'aValue="2.0" bValue="1.0" minMag="4.5" maxMag="6.5"',
+            'aValue="3.0" bValue="1.0" minMag="4.5" maxMag="6.75"',
+        )
+    )
+
+    rates = gr_rates(parse_source_model(str(path)), bin_width=0.1)
+
+    check.is_true(np.allclose(rates.mags[[0, -1]], [4.55, 6.75]))
+    # the top bin is cut at 6.75: 10^(3 - 6.7) - 10^(3 - 6.75)
+    check.almost_equal(rates.rates[0, -1], 2.1698e-05, rel=1e-4)
+    check.almost_equal(rates.rates[0, -2], 10**-3.6 - 10**-3.7)
+    check.almost_equal(rates.rates[0].sum(), 10**-1.5 - 10**-3.75)
+
+
+def test_gr_rates_min_mag(model_dir):
+    model = parse_source_model(os.path.join(model_dir, "area_sources_EDF_1.xml"))
+
+    rates = gr_rates(model, bin_width=0.1)
+    above = gr_rates(model, bin_width=0.1, min_mag=4.5)
+
+    check.is_true(np.allclose(above.mags[0], 4.55))
+    check.is_true(np.allclose(above.rates, rates.rates[:, rates.mags >= 4.5]))
+
+
+def test_read_logic_tree(model_dir):
+    branches = read_logic_tree(os.path.join(model_dir, "logicTree_GMPE.xml"))
+
+    check.equal(len(branches), 4)
+    check.equal(branches[1].branch_id, "gmpe_Stable_2")
+    check.equal(branches[1].uncertainty_model, "DrouetAlpes2015Rrup")
+    check.equal(branches[1].weight, 0.25)
+    check.equal(branches[1].uncertainty_type, "gmpeModel")
+    check.equal(branches[1].apply_to_tectonic_region, "Stable Shallow Crust")
+
+
+def test_logic_tree_gr_rates(model_dir):
+    rates = logic_tree_gr_rates(
+        os.path.join(model_dir, "logicTree_SRCS.xml"), bin_width=0.1, min_mag=4.5
+    )
+
+    check.is_true(np.allclose(rates.weights, [0.22, 0.22, 0.22, 0.34]))
+    check.equal([len(ids) for ids in rates.source_ids], [22, 90, 46, 90])
+    check.equal(rates.rates.shape, (4, 90, len(rates.mags)))
+    edf = gr_rates(
+        read_source_model(os.path.join(model_dir, "area_sources_EDF_1.xml")),
+        bin_width=0.1,
+        min_mag=4.5,
+    )
+    check.is_true(np.allclose(rates.rates[0, :22, : len(edf.mags)], edf.rates))
+    check.is_true(np.all(rates.rates[0, 22:] == 0))
@@ -0,0 +1,195 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.drouet_curves import load_hazard_curves, logic_tree_statistics
+from psha_disag_mod.euro_xml import (
+    LogicTreeBranch,
+    read_logic_tree,
+    realization_weights,
+)
+from psha_disag_mod.logic_tree_sampling import (
+    CompactLogicTree,
+    convergence_table,
+    sample_paths,
+    sample_realizations,
+    sampled_disaggregation,
+    sampled_statistics,
+    sampled_type_datas,
+)
+from psha_disag_mod.metadata_ini import read_job_config
+from tests.test_disaggregation import write_mag_dist_eps
+from tests.test_drouet_curves import realizations_dir  # noqa: F401 (fixture)
+
+
+def gsim_branches():
+    """Two GMPE branch sets of different sizes, one per tectonic region"""
+    return [
+        LogicTreeBranch("g1", "gmpeModel", "a1", "A1", 0.6, "Stable"),
+        LogicTreeBranch("g1", "gmpeModel", "a2", "A2", 0.4, "Stable"),
+        LogicTreeBranch("g2", "gmpeModel", "b1", "B1", 0.1, "Active"),
+        LogicTreeBranch("g2", "gmpeModel", "b2", "B2", 0.2, "Active"),
+        LogicTreeBranch("g2", "gmpeModel", "b3", "B3", 0.7, "Active"),
+    ]
+
+
+def test_compact_logic_tree(model_dir):
+    sources = read_logic_tree(os.path.join(model_dir, "logicTree_SRCS.xml"))
+
+    tree = CompactLogicTree.from_logic_trees(sources, gsim_branches())
+
+    check.equal(tree.branch_sets, ["source_models", "g1", "g2"])
+    check.equal(list(tree.sizes), [4, 2, 3])
+    check.equal(tree.n_paths, 24)
+    check.is_true(np.allclose(tree.weights[0], [0.22, 0.22, 0.22, 0.34]))
+    check.is_true(np.allclose(tree.weights[1], [0.6, 0.4, 0, 0]))
+    # every path falls on the realization OpenQuake gives it
+    paths = np.indices(tree.sizes).reshape(3, -1).T
+    expected_paths, expected_weights = realization_weights(sources, gsim_branches())
+    check.equal(list(tree.realizations(paths)), list(range(24)))
+    check.equal([tree.path(path) for path in paths], expected_paths)
+    check.is_true(
+        np.allclose(tree.weights[np.arange(3), paths].prod(axis=1), expected_weights)
+    )
+
+    reweighted = CompactLogicTree.from_logic_trees(
+        sources, gsim_branches(), {"b3": 0.0}
+    )
+    check.is_true(np.allclose(reweighted.weights[2], [1 / 3, 2 / 3, 0, 0]))
+    with pytest.raises(ValueError):
+        CompactLogicTree.from_logic_trees(sources, gsim_branches(), {"a1": 0, "a2": 0})
+
+
+def test_compact_logic_tree_shared_branch_set():
+    """Both trees in a branch set bs1, as in many OpenQuake jobs"""
+    sources = [
+        LogicTreeBranch("bs1", "sourceModel", "s1", "a.xml", 0.3, None),
+        LogicTreeBranch("bs1", "sourceModel", "s2", "b.xml", 0.7, None),
+    ]
+    gsims = [
+        LogicTreeBranch("bs1", "gmpeModel", "g1", "A", 0.2, "Stable"),
+        LogicTreeBranch("bs1", "gmpeModel", "g2", "B", 0.3, "Stable"),
+        LogicTreeBranch("bs1", "gmpeModel", "g3", "C", 0.5, "Stable"),
+    ]
+
+    tree = CompactLogicTree.from_logic_trees(sources, gsims)
+
+    expected_paths, expected_weights = realization_weights(sources, gsims)
+    check.equal(tree.branch_sets, ["bs1", "bs1"])
+    check.equal(tree.n_paths, len(expected_paths))
+    paths = np.indices(tree.sizes).reshape(2, -1).T
+    check.equal(list(tree.realizations(paths)), list(range(6)))
+    check.equal([tree.path(path) for path in paths], expected_paths)
+    check.is_true(
+        np.allclose(tree.weights[np.arange(2), paths].prod(axis=1), expected_weights)
+    )
+
+
+def test_sample_paths(model_dir):
+    sources = read_logic_tree(os.path.join(model_dir, "logicTree_SRCS.xml"))
+    tree = CompactLogicTree.from_logic_trees(sources, gsim_branches(), {"b1": 0})
+
+    paths = sample_paths(tree, 100_000, seed=23)
+
+    check.equal(paths.shape, (100_000, 3))
+    check.is_true(np.array_equal(paths, sample_paths(tree, 100_000, seed=23)))
+    for i, size in enumerate(tree.sizes):
+        frequencies = np.bincount(paths[:, i], minlength=size) / len(paths)
+        check.is_true(np.allclose(frequencies, tree.weights[i, :size], atol=0.01))
+    check.is_false((paths[:, 2] == 0).any())
+    with pytest.raises(ValueError):
+        sample_paths(tree, 0)
+
+
+def test_sample_realizations(model_dir):
+    path = os.path.join(model_dir, "job.ini")
+
+    with pytest.raises(ValueError):
+        sample_realizations(read_job_config(path))
+    samples = sample_realizations(read_job_config(path), 1000)
+    with open(path) as ini_file:
+        text = ini_file.read()
+    with open(path, "w") as ini_file:
+        ini_file.write(
+            text.replace(
+                "number_of_logic_tree_samples = 0", "number_of_logic_tree_samples = 50"
+            )
+        )
+    config = read_job_config(path)
+
+    check.equal(samples.shape, (1000,))
+    check.equal(set(samples.tolist()), set(range(16)))
+    check.equal(config.number_of_logic_tree_samples, 50)
+    check.is_true(np.array_equal(sample_realizations(config), samples[:50]))
+
+
+def test_sampled_statistics(realizations_dir):  # noqa: F811
+    export_dir, weights = realizations_dir
+    # every realization drawn in proportion to its weight: 0.055 or 0.085
+    samples = np.repeat(np.arange(16), np.round(weights * 200).astype(int))
+    np.random.default_rng(0).shuffle(samples)
+    curves = load_hazard_curves(export_dir, type_data=["rlz-"])
+
+    statistics = sampled_statistics(curves, samples)
+    expected = logic_tree_statistics(curves, weights)
+
+    check.equal(statistics.type_datas, ["mean", "0.05", "0.5", "0.95"])
+    check.is_true(np.allclose(statistics.poes, expected.poes))
+    drawn = samples[samples < 3]
+    subset = load_hazard_curves(export_dir, type_data=sampled_type_datas(drawn))
+    check.equal(subset.type_datas, ["rlz-000", "rlz-001", "rlz-002"])
+    check.is_true(
+        np.allclose(
+            sampled_statistics(subset, drawn).poes,
+            sampled_statistics(curves, drawn).poes,
+        )
+    )
+    with pytest.raises(ValueError):
+        sampled_statistics(subset, samples)
+
+
+def test_sampled_disaggregation(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+    matrix = read_disaggregation(path)
+
+    statistics = sampled_disaggregation(matrix, np.array([7, 2, 7]), [0.5])
+
+    check.equal(statistics.shape, (2, 2, 2, 2, 3, 3))
+    mean = (expected[..., 0] + 2 * expected[..., 1]) / 3
+    check.is_true(np.allclose(statistics[0], mean))
+    # interpolated between the cumulated weights 1/3 and 1 of the sorted values
+    check.is_true(np.allclose(statistics[1], 1.25 * expected[..., 0]))
+    with pytest.raises(ValueError):
+        sampled_disaggregation(matrix, np.array([2, 3]))
+
+
+def test_convergence_table(realizations_dir, model_dir):  # noqa: F811
+    export_dir, _ = realizations_dir
+    config = read_job_config(os.path.join(model_dir, "job.ini"))
+    samples = sample_realizations(config, 300)
+    curves = load_hazard_curves(export_dir, type_data=["rlz-"])
+
+    table = convergence_table(curves, samples, quantiles=[0.5])
+
+    check.equal(
+        list(table),
+        [
+            "n_samples",
+            "n_realizations",
+            "max_std_error",
+            "max_change_mean",
+            "max_change_0.5",
+        ],
+    )
+    check.equal(list(table["n_samples"]), [1, 2, 4, 8, 16, 32, 64, 128, 256, 300])
+    check.equal(table["n_realizations"][0], 1)
+    check.equal(table["n_realizations"][-1], 16)
+    check.equal(table["max_std_error"][0], 0)
+    check.is_true(table["max_std_error"][-1] < table["max_std_error"][3])
+    check.equal(table["max_change_mean"][-1], 0)
+    check.equal(table["max_change_0.5"][-1], 0)
+    check.is_true(table["max_change_mean"][-2] < table["max_change_mean"][0])
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.drouet_curves import load_hazard_curves
+from psha_disag_mod.metadata_ini import (
+    read_job_config,
+    validate_export,
+    validate_hazard_curves,
+)
+
+
+def test_read_job_config(model_dir):
+    config = read_job_config(os.path.join(model_dir, "job.ini"))
+
+    check.equal(config.calculation_mode, "disaggregation")
+    check.equal(config.random_seed, 23)
+    check.equal(config.number_of_logic_tree_samples, 0)
+    check.is_true(np.allclose(config.sites, [[5.73, 45.19]]))
+    check.is_true(np.allclose(config.poes, [0.002105, 0.000404, 0.0002, 0.0001]))
+    check.is_true(np.allclose(config.poes_disagg, config.poes))
+    check.is_true(np.allclose(config.quantiles, [0.05, 0.5, 0.95]))
+    check.equal(config.area_source_discretization, 15.0)
+    check.equal(config.width_of_mfd_bin, 0.1)
+    check.equal(config.num_epsilon_bins, 3)
+    check.is_true(config.individual_curves)
+    check.equal(len(config.imts), 15)
+    check.equal(config.imts[:2], ["PGA", "SA(0.03)"])
+    check.equal(config.imtls["SA(0.1)"].shape, (22,))
+    check.equal(config.imtls["SA(0.1)"][0], 0.0)
+    check.equal(config.distance_bin_edges[-1], 250.0)
+    check.is_true(np.allclose(config.eps_bin_edges, [-3, -1, 1, 3]))
+    check.is_true(np.allclose(config.mag_bin_edges(4.5, 6.8), [4.5, 5, 5.5, 6, 6.5, 7]))
+    check.equal(config.gsim_logic_tree, os.path.join(model_dir, "logicTree_GMPE.xml"))
+
+
+def test_read_job_config_shared(model_dir):
+    path = os.path.join(model_dir, "job.ini")
+    config = read_job_config(path)
+
+    check.is_true(read_job_config(path) is config)
+    with pytest.raises(ValueError):
+        config.poes[0] = 0.5
+
+    with open(path, "a") as ini_file:
+        ini_file.write("\n[extra]\nrandom_seed = 24\n")
+    os.utime(path, ns=(0, 0))
+    check.equal(read_job_config(path).random_seed, 24)
+
+
+def test_validate_export(model_dir, export_dir):
+    config = read_job_config(os.path.join(model_dir, "job.ini"))
+
+    validate_export(config, export_dir)
+    validate_hazard_curves(config, load_hazard_curves(export_dir))
+
+    path = os.path.join(export_dir, "hazard_curve-mean-PGA_18.csv")
+    with open(path) as csv_file:
+        lines = csv_file.readlines()
+    lines[1] = lines[1].replace("poe-0.0005000,", "poe-0.0004000,")
+    with open(path, "w") as csv_file:
+        csv_file.writelines(lines)
+    with pytest.raises(ValueError, match="hazard_curve-mean-PGA_18.csv"):
+        validate_export(config, export_dir)
@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.compartiment import filter_filenames
+from psha_disag_mod.pipeline import scan_directory, stream_map
+
+
+def test_scan_directory(export_dir, monkeypatch):
+    monkeypatch.setattr("psha_disag_mod.pipeline.SCAN_CHUNKSIZE", 7)
+    listing = os.listdir(export_dir)
+    # Not a file, not listed
+    os.mkdir(os.path.join(export_dir, "hazard_curve-mean-PGA_19.csv"))
+
+    check.equal(sorted(scan_directory(export_dir)), sorted(listing))
+    check.equal(
+        sorted(scan_directory(export_dir, "psha", type_data=["mean"])),
+        sorted(filter_filenames(listing, "psha", type_data=["mean"])),
+    )
+    check.equal(list(scan_directory(export_dir, "disaggregation")), ["Dist-0_18.csv"])
+
+
+def test_stream_map():
+    results = stream_map(lambda item: 2 * item, range(100), workers=3, maxsize=2)
+
+    check.equal(sorted(results), [(item, 2 * item) for item in range(100)])
+
+
+def test_stream_map_bounded():
+    threads = threading.active_count()
+    produced = []
+
+    def items():
+        for item in range(1000):
+            produced.append(item)
+            yield item
+
+    results = stream_map(lambda item: item, items(), workers=2, maxsize=3)
+    next(results)
+    time.sleep(0.3)
+
+    # The producer stalls once the queues and the workers are full
+    check.less_equal(len(produced), 2 * 3 + 2 + 2)
+    results.close()
+    check.equal(threading.active_count(), threads)
+
+
+def test_stream_map_errors():
+    threads = threading.active_count()
+
+    def read(item):
+        if item == 5:
+            raise ValueError(item)
+        return item
+
+    def items():
+        yield 1
+        raise OSError("unreadable directory")
+
+    with pytest.raises(ValueError):
+        list(stream_map(read, range(10), workers=2))
+    with pytest.raises(OSError):
+        list(stream_map(read, items()))
+    with pytest.raises(ValueError):
+        list(stream_map(read, range(10), workers=0))
+    check.equal(threading.active_count(), threads)
@@ -0,0 +1,207 @@
+import os
+
+import numpy as np
+import pytest_check as check
+from matplotlib.image import imread
+
+from psha_disag_mod.compartiment import filter_filenames
+from psha_disag_mod.disaggregation import read_disaggregation
+from psha_disag_mod.drouet_curves import load_hazard_curves
+from psha_disag_mod.metadata_ini import read_job_config
+from psha_disag_mod.plots_psha_disag import (
+    disag_jobs,
+    hazard_curve_jobs,
+    PlotManifest,
+    mag_dist_contributions,
+    plot_run,
+    render_jobs,
+    render_stale_jobs,
+    run_jobs,
+    stream_plot_run,
+    uhs_jobs,
+)
+from psha_disag_mod.sites import Nearest
+from psha_disag_mod.utils import profiling
+from tests.test_disaggregation import write_mag_dist_eps
+
+
+def test_hazard_curve_jobs(export_dir, tmp_path):
+    curves = load_hazard_curves(export_dir)
+
+    jobs = hazard_curve_jobs(curves, str(tmp_path))
+
+    check.equal(len(jobs), 16)
+    check.equal(
+        jobs[0].path,
+        str(tmp_path / "curve" / "hazard_curve_all_type_data_PGA_plot.png"),
+    )
+    check.equal(list(jobs[0].data["poes"]), ["mean", "rlz-001", "rlz-002", "rlz-003"])
+    check.equal(
+        jobs[-1].path, str(tmp_path / "curve" / "hazard_curve_all_type_acc_plot.png")
+    )
+    check.equal(list(jobs[-1].data["poes"]), ["PGA", "SA(0.1)"])
+
+
+def test_uhs_jobs(export_dir, tmp_path):
+    curves = load_hazard_curves(export_dir, type_data=["mean", "rlz-001"])
+
+    jobs = uhs_jobs(curves, [0.002105, 0.0001], str(tmp_path))
+
+    check.equal(
+        [job.path for job in jobs],
+        [
+            str(tmp_path / "uhs" / "hazard_uhs_475_plot.png"),
+            str(tmp_path / "uhs" / "hazard_uhs_10000_plot.png"),
+        ],
+    )
+    # the mean was only exported for PGA and SA(0.1)
+    check.equal(list(jobs[0].data["accelerations"]), ["rlz-001"])
+    check.equal(jobs[1].data["title"], "10000 years")
+    check.equal(jobs[0].data["frequencies"][0], 100.0)
+    check.is_true(os.path.exists(render_jobs(jobs[1:])[0]))
+
+
+def test_run_jobs_config(export_dir, model_dir, tmp_path):
+    config = read_job_config(os.path.join(model_dir, "job.ini"))
+
+    jobs = run_jobs(export_dir, str(tmp_path), config=config)
+
+    uhs = [os.path.basename(job.path) for job in jobs if "uhs" in job.path]
+    check.equal(
+        uhs,
+        [
+            "hazard_uhs_475_plot.png",
+            "hazard_uhs_2475_plot.png",
+            "hazard_uhs_5000_plot.png",
+            "hazard_uhs_10000_plot.png",
+        ],
+    )
+
+
+def test_run_jobs_profile(export_dir, tmp_path):
+    n_curves = len(filter_filenames(os.listdir(export_dir), "psha"))
+
+    with profiling() as profile:
+        run_jobs(export_dir, str(tmp_path))
+
+    report = profile.report()
+    check.equal(report["stages"]["drouet_curves.read_hazard_curve"]["calls"], n_curves)
+    check.equal(report["counters"]["files_read"], n_curves)
+    for stage in (
+        "compartiment.list_directory",
+        "plots_psha_disag.run_jobs",
+        "drouet_curves.load_hazard_curves",
+        "disaggregation.find_mag_dist_file",
+    ):
+        check.is_in(stage, report["stages"])
+
+
+def test_disag_jobs(tmp_path):
+    path = str(tmp_path / "Mag_Dist_Eps-0_14.csv")
+    expected = write_mag_dist_eps(path)
+    matrix = read_disaggregation(path)
+
+    jobs = disag_jobs(matrix, str(tmp_path))
+
+    check.equal(
+        [os.path.basename(job.path) for job in jobs],
+        [
+            "disagg_Mag_Dist_hist3Dplot_0.002105_PGA.png",
+            "disagg_Mag_Dist_hist3Dplot_0.002105_SA(0.1).png",
+            "disagg_Mag_Dist_hist3Dplot_0.0001_PGA.png",
+            "disagg_Mag_Dist_hist3Dplot_0.0001_SA(0.1).png",
+        ],
+    )
+    mag_dist = 1 - np.prod(1 - expected, axis=4)
+    check.is_true(
+        np.allclose(
+            mag_dist_contributions(matrix),
+            0.25 * mag_dist[..., 0] + 0.75 * mag_dist[..., 1],
+        )
+    )
+    check.equal(jobs[2].data["contributions"].shape, (2, 3))
+    check.is_true(os.path.exists(render_jobs(jobs[:1])[0]))
+
+
+def test_render_jobs(export_dir, tmp_path):
+    jobs = run_jobs(export_dir, str(tmp_path))[:2]
+
+    paths = render_jobs(jobs, workers=2)
+
+    check.equal(paths, [job.path for job in jobs])
+    for path in paths:
+        check.is_true(os.path.getsize(path) > 0)
+
+
+def test_render_templates(export_dir, tmp_path):
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_18.csv"))
+    jobs = run_jobs(export_dir, str(tmp_path / "new"), poes=[0.002105])
+    # Curves of several kinds, then a spectrum and the 3D histograms
+    kinds = [os.path.basename(os.path.dirname(job.path)) for job in jobs]
+    jobs = jobs[:2] + [jobs[kinds.index("uhs")]] + jobs[-2:]
+    check.equal(len({job.render for job in jobs}), 3)
+
+    paths = render_jobs(jobs, templates=False)
+    templated = render_jobs(
+        [job._replace(path=job.path.replace("new", "templated")) for job in jobs]
+    )
+
+    for path, templated_path in zip(paths, templated):
+        check.is_true(np.array_equal(imread(path), imread(templated_path)))
+
+
+def test_render_stale_jobs(export_dir, tmp_path):
+    plot_dir = str(tmp_path / "plots")
+    jobs = hazard_curve_jobs(load_hazard_curves(export_dir), plot_dir)[:2]
+
+    check.equal(render_stale_jobs(jobs, plot_dir), [job.path for job in jobs])
+    check.equal(render_stale_jobs(jobs, plot_dir), [])
+
+    path = os.path.join(export_dir, "hazard_curve-mean-PGA_18.csv")
+    with open(path) as csv_file:
+        lines = csv_file.readlines()
+    lines[2] = lines[2].replace("3.021727E-01", "3.000000E-01")
+    with open(path, "w") as csv_file:
+        csv_file.writelines(lines)
+    os.utime(path, ns=(0, 0))
+    jobs = hazard_curve_jobs(load_hazard_curves(export_dir), plot_dir)[:2]
+
+    check.equal(render_stale_jobs(jobs, plot_dir), [jobs[0].path])
+    os.remove(jobs[1].path)
+    check.equal(render_stale_jobs(jobs, plot_dir), [jobs[1].path])
+    check.equal(
+        render_stale_jobs(jobs, plot_dir, force=True), [job.path for job in jobs]
+    )
+
+
+def test_stream_plot_run(export_dir, tmp_path):
+    plot_dir = str(tmp_path / "plots")
+    poes = [0.002105, 0.0001]
+
+    paths = stream_plot_run(
+        export_dir, plot_dir, poes=poes, kinds=["curve", "uhs"], readers=3, maxsize=2
+    )
+
+    jobs = run_jobs(export_dir, plot_dir, poes=poes, kinds=["curve", "uhs"])
+    check.equal(sorted(paths), sorted(job.path for job in jobs))
+    # Same inputs as the figures of run_jobs, which are then up to date
+    check.equal(PlotManifest(plot_dir).stale_jobs(jobs), [])
+    check.equal(plot_run(export_dir, plot_dir, poes=poes, stream=True), [])
+    lon, lat = load_hazard_curves(export_dir).sites[0, :2]
+    nearest = stream_plot_run(
+        export_dir, plot_dir, Nearest(lon, lat), poes=poes, kinds=["curve", "uhs"]
+    )
+    check.equal(nearest, [])
+
+
+def test_stream_plot_run_disag(export_dir, tmp_path):
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_18.csv"))
+    write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-1_18.csv"))
+    plot_dir = str(tmp_path / "plots")
+
+    paths = stream_plot_run(export_dir, plot_dir, kinds=["disag"], workers=2)
+
+    jobs = run_jobs(export_dir, plot_dir, kinds=["disag"])
+    check.equal(len(jobs), 4)
+    check.equal(sorted(paths), sorted(job.path for job in jobs))
+    check.equal(PlotManifest(plot_dir).stale_jobs(jobs), [])
@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod import scenarios
+from psha_disag_mod.drouet_curves import load_hazard_curves
+from psha_disag_mod.scenarios import (
+    ScenarioSpec,
+    SharedArrays,
+    attach_arrays,
+    run_sweep,
+)
+from psha_disag_mod.utils import CACHE_DIRNAME
+from tests.test_disaggregation import write_mag_dist_eps
+from tests.test_drouet_curves import realizations_dir  # noqa: F401 (fixture)
+
+
+def test_scenario_spec_key():
+    spec = ScenarioSpec.create("a", poes=[0.002105], branch_weights={"b": 1, "a": 0})
+
+    check.equal(spec.branch_weights, (("a", 0), ("b", 1)))
+    check.equal(
+        spec.key(),
+        ScenarioSpec.create("b", (0.002105,), branch_weights={"a": 0, "b": 1}).key(),
+    )
+    check.not_equal(spec.key(), spec.key("other inputs"))
+    check.not_equal(spec.key(), ScenarioSpec.create("a", poes=[0.0001]).key())
+
+
+def test_shared_arrays():
+    array = np.arange(12.0).reshape(3, 4)
+
+    with SharedArrays({"array": array}) as shared:
+        blocks, arrays = attach_arrays(shared.specs)
+        check.is_true(np.array_equal(arrays["array"], array))
+        with pytest.raises(ValueError):
+            arrays["array"][0, 0] = 1.0
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+def test_run_sweep_exported(export_dir, model_dir):
+    specs = [
+        ScenarioSpec.create("all", quantiles=[]),
+        ScenarioSpec.create("pga", poes=[0.002105], imts=["PGA"], quantiles=[]),
+    ]
+
+    results = run_sweep(export_dir, specs, os.path.join(model_dir, "job.ini"))
+
+    everything, pga = results.values()
+    check.equal(everything.name, "all")
+    check.equal(everything.statistics.type_datas, ["mean"])
+    check.equal(everything.spectra.shape, (1, 1, 4, 15))
+    check.is_true(np.allclose(everything.poes, [0.002105, 0.000404, 0.0002, 0.0001]))
+    check.equal(pga.statistics.imts, ["PGA"])
+    check.equal(pga.spectra[0, 0, 0, 0], everything.spectra[0, 0, 0, 0])
+
+
+def test_run_sweep_missing_statistics(export_dir, model_dir):
+    # the quantiles were not exported, nor every realization
+    with pytest.raises(ValueError):
+        run_sweep(export_dir, [ScenarioSpec()], os.path.join(model_dir, "job.ini"))
+
+
+def test_run_sweep_cache(export_dir, model_dir, monkeypatch):
+    job_ini = os.path.join(model_dir, "job.ini")
+    specs = [ScenarioSpec.create(imts=["PGA"], quantiles=[])]
+    evaluated = []
+    evaluate_scenario = scenarios.evaluate_scenario
+
+    def counting_evaluate_scenario(spec, inputs, key=""):
+        evaluated.append(spec)
+        return evaluate_scenario(spec, inputs, key)
+
+    monkeypatch.setattr(scenarios, "evaluate_scenario", counting_evaluate_scenario)
+    first = run_sweep(export_dir, specs, job_ini)
+    specs.append(ScenarioSpec.create(imts=["SA(0.1)"], quantiles=[]))
+    second = run_sweep(export_dir, specs + specs, job_ini)
+
+    check.equal(evaluated, specs)
+    check.equal(len(second), 2)
+    key = next(iter(first))
+    check.is_true(np.array_equal(second[key].spectra, first[key].spectra))
+    check.equal(
+        len(os.listdir(os.path.join(export_dir, CACHE_DIRNAME, "scenarios"))), 2
+    )
+
+
+def test_run_sweep_reweighted(realizations_dir, model_dir):  # noqa: F811
+    export_dir, weights = realizations_dir
+    expected = write_mag_dist_eps(os.path.join(export_dir, "Mag_Dist_Eps-0_7.csv"))
+    specs = [
+        ScenarioSpec.create("exported"),
+        ScenarioSpec.create("no model#0", branch_weights={"model#0": 0.0}),
+    ]
+
+    exported, reweighted = run_sweep(
+        export_dir, specs, os.path.join(model_dir, "job.ini"), workers=2
+    ).values()
+
+    check.equal(exported.statistics.type_datas, ["mean", "0.05", "0.5", "0.95"])
+    check.equal(reweighted.statistics.type_datas, ["mean", "0.05", "0.5", "0.95"])
+    curves = load_hazard_curves(export_dir, type_data=["rlz-"])
+    rlz_weights = np.where(np.arange(16) < 4, 0.0, weights)
+    mean = np.tensordot(rlz_weights / rlz_weights.sum(), curves.poes, axes=1)
+    check.is_true(np.allclose(reweighted.statistics.poes[0], mean))
+    check.is_false(np.allclose(exported.statistics.poes[0], mean))
+    # the disaggregation has the realizations 2 (model#0) and 7 (model#1)
+    mag_dist = 1 - np.prod(1 - expected, axis=4)
+    check.is_true(
+        np.allclose(
+            exported.mag_dist[0], 0.25 * mag_dist[..., 0] + 0.75 * mag_dist[..., 1]
+        )
+    )
+    check.is_true(np.allclose(reweighted.mag_dist[0], mag_dist[..., 1]))
+    check.equal(reweighted.disag_imts, ["PGA", "SA(0.1)"])
@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.drouet_curves import load_hazard_curves
+from psha_disag_mod.plots_psha_disag import run_jobs
+from psha_disag_mod.sites import (
+    EARTH_RADIUS,
+    Nearest,
+    SiteTable,
+    WithinRadius,
+    great_circle_distances,
+    lonlat_bin_mask,
+)
+
+
+def haversine(lon, lat, lons, lats):
+    lon, lat, lons, lats = map(np.radians, (lon, lat, lons, lats))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@pytest.fixture
+def grid():
+    lons, lats = np.meshgrid(np.arange(4.0, 8.0, 0.1), np.arange(43.0, 47.0, 0.1))
+    return np.column_stack([lons.ravel(), lats.ravel()])
+
+
+def test_nearest(grid):
+    table = SiteTable(grid)
+
+    indices, distances = table.nearest(5.73, 45.19, k=3)
+
+    expected = haversine(5.73, 45.19, grid[:, 0], grid[:, 1])
+    check.equal(indices.tolist(), np.argsort(expected)[:3].tolist())
+    check.is_true(np.allclose(distances, np.sort(expected)[:3]))
+
+
+def test_within(grid):
+    table = SiteTable(grid)
+
+    indices = table.within(5.73, 45.19, 20.0)
+
+    expected = haversine(5.73, 45.19, grid[:, 0], grid[:, 1])
+    check.equal(indices.tolist(), np.flatnonzero(expected <= 20.0).tolist())
+    check.equal(len(table.within(0.0, 0.0, 20.0)), 0)
+
+
+def test_great_circle_distances(grid):
+    sites = np.array([[5.73, 45.19], [5.7301, 45.19], [-3.0, 48.0]])
+
+    distances = great_circle_distances(sites, grid)
+
+    check.equal(distances.shape, (3, len(grid)))
+    for site, row in zip(sites, distances):
+        check.is_true(np.allclose(row, haversine(*site, grid[:, 0], grid[:, 1])))
+    # meters apart, the chords still give the distance
+    check.almost_equal(
+        great_circle_distances(sites[0], sites[1])[0, 0],
+        haversine(*sites[0], *sites[1]),
+        abs=1e-6,
+    )
+
+
+def test_select(grid):
+    table = SiteTable(grid)
+
+    check.equal(table.select(3).tolist(), [3])
+    check.equal(table.select([4, 2]).tolist(), [4, 2])
+    check.equal(len(table.select(Nearest(5.73, 45.19, 4))), 4)
+    check.equal(
+        table.select(WithinRadius(5.73, 45.19, 20.0)).tolist(),
+        table.within(5.73, 45.19, 20.0).tolist(),
+    )
+    with pytest.raises(IndexError):
+        table.select(len(grid))
+
+
+def test_lonlat_bin_mask():
+    lon_edges = np.arange(5.0, 6.6, 0.2)
+    lat_edges = np.arange(44.5, 46.1, 0.2)
+
+    mask = lonlat_bin_mask(lon_edges, lat_edges, 5.73, 45.19, 15.0)
+
+    check.equal(mask.shape, (len(lon_edges) - 1, len(lat_edges) - 1))
+    lons, lats = np.meshgrid(
+        (lon_edges[:-1] + lon_edges[1:]) / 2,
+        (lat_edges[:-1] + lat_edges[1:]) / 2,
+        indexing="ij",
+    )
+    check.is_true(np.array_equal(mask, haversine(5.73, 45.19, lons, lats) <= 15.0))
+
+
+@pytest.fixture
+def multi_site_dir(export_dir):
+    """Export of the Drouet run with its single site copied to 2 other sites"""
+    for filename in os.listdir(export_dir):
+        if filename.startswith("hazard_curve"):
+            path = os.path.join(export_dir, filename)
+            with open(path) as csv_file:
+                lines = csv_file.readlines()
+            for lon, lat in ((5.9, 45.3), (7.0, 46.0)):
+                lines.append(
+                    lines[2].replace("5.73000,45.19000", f"{lon:.5f},{lat:.5f}")
+                )
+            with open(path, "w") as csv_file:
+                csv_file.writelines(lines)
+    return export_dir
+
+
+def test_select_curves(multi_site_dir):
+    curves = load_hazard_curves(multi_site_dir, use_cache=False)
+
+    near = curves.select(sites=WithinRadius(5.73, 45.19, 30.0))
+
+    check.is_true(np.allclose(near.sites[:, :2], [[5.73, 45.19], [5.9, 45.3]]))
+    check.equal(near.poes.shape[2], 2)
+    check.is_true(np.array_equal(near.poes, curves.poes[:, :, :2], equal_nan=True))
+    check.equal(curves.select(sites=Nearest(7.1, 46.0)).sites[0, 0], 7.0)
+
+
+def test_run_jobs_sites(multi_site_dir, tmp_path):
+    jobs = run_jobs(multi_site_dir, str(tmp_path), site=WithinRadius(5.9, 45.3, 30))
+
+    directories = sorted(
+        {os.path.relpath(job.path, tmp_path).split(os.sep)[0] for job in jobs}
+    )
+    check.equal(directories, ["site-0", "site-1"])
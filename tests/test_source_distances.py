@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.euro_xml import gr_rates, read_source_model
+from psha_disag_mod.metadata_ini import read_job_config
+from psha_disag_mod.source_distances import (
+    discretize_polygon,
+    distance_rates,
+    inside_polygon,
+    job_distance_rates,
+    model_distance_rates,
+    source_points,
+)
+from tests.test_sites import haversine
+
+SITES = np.array([[5.73, 45.19], [4.8, 44.0]])
+EDGES = np.arange(0.0, 260.0, 10.0)
+
+
+def test_discretize_polygon():
+    square = np.array([[5.0, 45.0], [6.0, 45.0], [6.0, 46.0], [5.0, 46.0]])
+    # a concave polygon, the square without its upper right quarter
+    notched = np.array(
+        [[5.0, 45.0], [6.0, 45.0], [6.0, 45.5], [5.5, 45.5], [5.5, 46.0], [5.0, 46.0]]
+    )
+
+    points = discretize_polygon(square, 10.0)
+    notched_points = discretize_polygon(notched, 10.0)
+
+    # about 111 km by 79 km, one point per 100 km²
+    check.almost_equal(len(points), 111 * 79 / 100, rel=0.1)
+    check.is_true(inside_polygon(points, square).all())
+    check.almost_equal(len(notched_points), 0.75 * len(points), rel=0.1)
+    check.is_false(((notched_points[:, 0] > 5.5) & (notched_points[:, 1] > 45.5)).any())
+    tiny = square * 0.001 + [5, 40]
+    check.is_true(np.allclose(discretize_polygon(tiny, 10.0), tiny.mean(axis=0)))
+
+
+@pytest.mark.parametrize(
+    "filename", ["area_sources_EDF_1.xml", "smoothed_source_model_1.xml"]
+)
+def test_distance_rates(model_dir, filename):
+    model = read_source_model(os.path.join(model_dir, filename), use_cache=False)
+    points = source_points(model, 15.0, 0.1, 4.5)
+
+    rates = distance_rates(points, SITES, EDGES, model.id.tolist())
+
+    check.equal(rates.source_rates.shape, (2, len(model), 25))
+    check.equal(rates.mag_dist_rates.shape, (2, len(points.mags), 25))
+    check.equal(rates.source_ids, model.id.tolist())
+    expected = gr_rates(model, 0.1, 4.5)
+    check.is_true(np.allclose(points.mags, expected.mags))
+    check.is_true(
+        np.allclose(np.add.reduceat(points.rates, points.offsets[:-1]), expected.rates)
+    )
+    check.is_true(np.allclose(rates.dist_rates(), rates.mag_dist_rates.sum(axis=1)))
+    # every point of every source, one at a time
+    source_index = points.source_index
+    for i, (lon, lat) in enumerate(SITES):
+        distances = haversine(lon, lat, points.lonlats[:, 0], points.lonlats[:, 1])
+        for source in (0, len(model) - 1):
+            mine = source_index == source
+            check.almost_equal(rates.min_distances[i, source], distances[mine].min())
+            in_bins = np.histogram(
+                distances[mine], EDGES, weights=points.rates[mine].sum(axis=1)
+            )[0]
+            check.is_true(np.allclose(rates.source_rates[i, source], in_bins))
+    # the whole model within a distance covering France
+    everything = distance_rates(points, SITES, [0.0, 5000.0])
+    check.is_true(
+        np.allclose(everything.source_rates[..., 0], expected.rates.sum(axis=1))
+    )
+
+
+def test_model_distance_rates_cache(model_dir, monkeypatch):
+    path = os.path.join(model_dir, "area_sources_GTR_1.xml")
+
+    rates = model_distance_rates(path, SITES, EDGES, 15.0, 0.1, 4.5)
+    # the cached tables need neither the XML nor the parsed model
+    monkeypatch.setattr(
+        "psha_disag_mod.source_distances.read_source_model", pytest.fail
+    )
+    cached = model_distance_rates(path, SITES, EDGES, 15.0, 0.1, 4.5)
+
+    check.is_instance(cached.source_rates, np.memmap)
+    check.equal(cached.source_ids, rates.source_ids)
+    check.is_true(np.array_equal(cached.source_rates, rates.source_rates))
+    check.is_true(np.array_equal(cached.mag_dist_rates, rates.mag_dist_rates))
+    with pytest.raises(pytest.fail.Exception):
+        model_distance_rates(path, SITES[:1], EDGES, 15.0, 0.1, 4.5)
+    with pytest.raises(pytest.fail.Exception):
+        model_distance_rates(path, SITES, EDGES, 10.0, 0.1, 4.5)
+
+
+def test_job_distance_rates(model_dir):
+    config = read_job_config(os.path.join(model_dir, "job.ini"))
+
+    tables = job_distance_rates(config)
+
+    check.equal(
+        list(tables),
+        [
+            "area_sources_EDF_1.xml",
+            "area_sources_GTR_1.xml",
+            "area_sources_IRSN_1.xml",
+            "smoothed_source_model_1.xml",
+        ],
+    )
+    for rates in tables.values():
+        check.is_true(np.allclose(rates.sites, [[5.73, 45.19]]))
+        check.equal(rates.dist_bin_edges[-1], 250.0)
+        check.is_true(rates.mags[0] >= 4.5)
+        check.is_true((rates.dist_rates() > 0).all())
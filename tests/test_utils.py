@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.utils import (
+    active_profile,
+    load_array_cache,
+    save_array_cache,
+    content_hash,
+    count,
+    imt_period,
+    parse_oq_metadata,
+    profiling,
+    timed,
+    timer,
+)
+
+
+@timed
+def double(value):
+    return 2 * value
+
+
+def test_parse_oq_metadata():
+    line = (
+        "#,,,,\"generated_by='OpenQuake engine 3.15.0-gite516637382', "
+        "start_date='2022-08-04T17:05:27', checksum=2488195332, "
+        "mag_bin_edges=[4.5, 5.0, 5.5], tectonic_region_types=['Stable Shallow Crust'], "
+        "investigation_time=1.0, imt='SA(0.1)'\"\n"
+    )
+
+    metadata = parse_oq_metadata(line)
+
+    check.equal(
+        metadata,
+        {
+            "generated_by": "OpenQuake engine 3.15.0-gite516637382",
+            "start_date": "2022-08-04T17:05:27",
+            "checksum": 2488195332,
+            "mag_bin_edges": [4.5, 5.0, 5.5],
+            "tectonic_region_types": ["Stable Shallow Crust"],
+            "investigation_time": 1.0,
+            "imt": "SA(0.1)",
+        },
+    )
+
+
+def test_imt_period():
+    check.equal(imt_period("PGA"), 0.0)
+    check.equal(imt_period("SA(0.15)"), 0.15)
+    with pytest.raises(ValueError):
+        imt_period("PGV")
+
+
+def test_content_hash():
+    value = {"poes": np.array([0.1, 0.01]), "imt": "PGA", "levels": [1, 2.0]}
+
+    check.equal(
+        content_hash(value),
+        content_hash({"levels": [1, 2.0], "imt": "PGA", "poes": np.array([0.1, 0.01])}),
+    )
+    check.not_equal(
+        content_hash(value), content_hash({**value, "poes": np.array([0.1, 0.02])})
+    )
+    check.not_equal(content_hash(value), content_hash({**value, "levels": [1, 2]}))
+
+
+def test_instrumentation_disabled():
+    check.is_none(active_profile())
+    with timer("stage"):
+        count("files_read")
+    check.equal(double(2), 4)
+    check.is_none(active_profile())
+
+
+def test_profiling(tmp_path):
+    path = str(tmp_path / "profile.json")
+    with profiling(path) as profile:
+        with timer("stage"):
+            double(1)
+            double(2)
+            count("files_read")
+            count("bytes_parsed", 100)
+        with profiling() as nested:
+            check.is_true(nested is profile)
+            count("files_read")
+    check.is_none(active_profile())
+
+    report = profile.report()
+    check.equal(list(report["stages"]), ["stage", "test_utils.double"])
+    check.equal(report["stages"]["test_utils.double"]["calls"], 2)
+    check.greater_equal(
+        report["stages"]["stage"]["total"],
+        report["stages"]["test_utils.double"]["total"],
+    )
+    check.equal(report["counters"], {"files_read": 2, "bytes_parsed": 100})
+    check.greater(report["peak_rss"], 0)
+    with open(path) as json_file:
+        check.equal(json.load(json_file)["counters"], report["counters"])
+
+    profile.write(str(tmp_path / "profile.trace.json"))
+    with open(tmp_path / "profile.trace.json") as json_file:
+        events = json.load(json_file)["traceEvents"]
+    check.equal([event["ph"] for event in events], ["X", "X", "X", "C"])
+    check.equal(events[-1]["args"], report["counters"])
+
+
+def test_array_cache(tmp_path):
+    path = str(tmp_path / "cache")
+    poes = np.linspace(0, 1, 12).reshape(3, 4)
+
+    check.is_none(load_array_cache(path))
+    save_array_cache(path, "key", {"poes": poes, "empty": np.empty((0, 3))}, [1, "a"])
+    arrays, extra = load_array_cache(path, "key")
+
+    check.equal(extra, [1, "a"])
+    check.is_instance(arrays["poes"], np.memmap)
+    check.is_false(arrays["poes"].flags.writeable)
+    check.is_true(np.array_equal(arrays["poes"][1:, ::2], poes[1:, ::2]))
+    check.equal(arrays["empty"].shape, (0, 3))
+    check.is_none(load_array_cache(path, "other key"))
+
+    save_array_cache(path, "other key", {"poes": 2 * poes})
+    check.is_true(np.array_equal(load_array_cache(path)[0]["poes"], 2 * poes))
+    check.equal(os.listdir(tmp_path), ["cache"])
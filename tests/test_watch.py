@@ -0,0 +1,183 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+import pytest_check as check
+
+from psha_disag_mod.drouet_curves import HazardCurves, hazard_curves_cache_path
+from psha_disag_mod.plots_psha_disag import PlotManifest, run_jobs
+from psha_disag_mod.utils import files_key
+from psha_disag_mod.watch import (
+    InotifyWatcher,
+    IncrementalRun,
+    PollingWatcher,
+    watch_run,
+)
+from tests.test_disaggregation import write_mag_dist_eps
+
+PGA_FILES = [
+    "hazard_curve-mean-PGA_18.csv",
+    "hazard_curve-rlz-001-PGA_18.csv",
+    "hazard_curve-rlz-002-PGA_18.csv",
+    "hazard_curve-rlz-003-PGA_18.csv",
+]
+SA_FILES = [
+    "hazard_curve-mean-SA(0.1)_18.csv",
+    "hazard_curve-rlz-001-SA(0.1)_18.csv",
+    "hazard_curve-rlz-002-SA(0.1)_18.csv",
+    "hazard_curve-rlz-003-SA(0.1)_18.csv",
+]
+
+
+def copy_files(source_dir, directory, filenames):
+    for filename in filenames:
+        shutil.copy(os.path.join(source_dir, filename), directory)
+
+
+def test_polling_watcher(tmp_path):
+    path = tmp_path / "hazard_curve-mean-PGA_18.csv"
+    path.write_text("partial")
+    (tmp_path / "subdirectory").mkdir()
+
+    with PollingWatcher(str(tmp_path), settle=0.2) as watcher:
+        check.equal(watcher.poll(), [])
+        path.write_text("partial, then more")
+        time.sleep(0.3)
+        # rewritten since seen, so not settled yet
+        check.equal(watcher.poll(), [])
+        time.sleep(0.3)
+        check.equal(watcher.poll(), ["hazard_curve-mean-PGA_18.csv"])
+        check.equal(watcher.wait(0.3), [])
+        path.write_text("rewritten")
+        check.equal(watcher.wait(0.1), [])
+        check.equal(watcher.wait(0.3), ["hazard_curve-mean-PGA_18.csv"])
+
+
+def test_inotify_watcher(tmp_path):
+    try:
+        watcher = InotifyWatcher(str(tmp_path), settle=60.0)
+    except (OSError, AttributeError):
+        pytest.skip("inotify is not available")
+
+    with watcher:
+        (tmp_path / "subdirectory").mkdir()
+        (tmp_path / "Dist-0_18.csv").write_text("written at once")
+        (tmp_path / "partial.csv.tmp").write_text("moved when complete")
+        os.rename(tmp_path / "partial.csv.tmp", tmp_path / "Mag_Dist-0_18.csv")
+
+        ready = watcher.wait(1.0)
+
+    # without waiting for the 60 s of settling
+    check.equal(ready, ["Dist-0_18.csv", "Mag_Dist-0_18.csv"])
+
+
+def test_inotify_watcher_busy(tmp_path):
+    (tmp_path / "Dist-0_18.csv").write_text("written before the watch")
+    try:
+        watcher = InotifyWatcher(str(tmp_path), settle=0.2)
+    except (OSError, AttributeError):
+        pytest.skip("inotify is not available")
+
+    ready = []
+    with watcher:
+        # a new file at every wait for 0.5 s, so that inotify is never quiet
+        for i in range(10):
+            time.sleep(0.05)
+            (tmp_path / f"Dist-{i + 1}_18.csv").write_text("written during the watch")
+            ready.extend(watcher.wait(0.1))
+
+    check.equal(sorted(ready), sorted(f"Dist-{i}_18.csv" for i in range(11)))
+
+
+def test_incremental_run(export_dir, tmp_path):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+    plot_dir = str(tmp_path / "plots")
+    run = IncrementalRun(str(watched), plot_dir, poes=[0.002105])
+
+    copy_files(export_dir, watched, PGA_FILES + ["Dist-0_18.csv"])
+    first = run.add(PGA_FILES + ["Dist-0_18.csv"])
+    again = run.add(PGA_FILES)
+    copy_files(export_dir, watched, SA_FILES)
+    second = run.add(SA_FILES)
+    write_mag_dist_eps(str(watched / "Mag_Dist_Eps-0_18.csv"))
+    disaggregation = run.add(["Mag_Dist_Eps-0_18.csv"])
+
+    check.equal(first.imts, {"PGA"})
+    check.equal(first.sites, set())
+    check.equal(
+        sorted(os.path.basename(path) for path in first.rendered),
+        [
+            "hazard_curve_all_type_acc_plot.png",
+            "hazard_curve_all_type_data_PGA_plot.png",
+            "hazard_uhs_475_plot.png",
+        ],
+    )
+    # the same curves, so the same figures
+    check.equal(again.rendered, [])
+    check.equal(second.imts, {"SA(0.1)"})
+    check.equal(
+        sorted(os.path.basename(path) for path in second.rendered),
+        [
+            "hazard_curve_all_type_acc_plot.png",
+            "hazard_curve_all_type_data_SA(0.1)_plot.png",
+            "hazard_uhs_475_plot.png",
+        ],
+    )
+    check.equal(disaggregation.sites, {0})
+    check.equal(len(disaggregation.rendered), 4)
+    check.equal(run.curves.imts, ["PGA", "SA(0.1)"])
+    # the curves of the first batch are replaced in the cache
+    cache_dirs = os.listdir(os.path.dirname(run._cache_path))
+    check.equal(
+        [name for name in cache_dirs if name.startswith("hazard_curves-")],
+        [os.path.basename(run._cache_path)],
+    )
+
+
+def test_watch_run(export_dir, tmp_path):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+    plot_dir = str(tmp_path / "plots")
+    filenames = PGA_FILES + SA_FILES
+    stop = threading.Event()
+    updates = []
+
+    def export():
+        for batch in (PGA_FILES, SA_FILES):
+            copy_files(export_dir, watched, batch)
+            time.sleep(0.5)
+
+    def on_update(update):
+        updates.append(update)
+        if len(set().union(*(u.filenames for u in updates))) == len(filenames):
+            stop.set()
+
+    exporter = threading.Thread(target=export)
+    exporter.start()
+    rendered = watch_run(
+        str(watched),
+        plot_dir,
+        poes=[0.002105],
+        kinds=["curve", "uhs"],
+        poll_interval=0.1,
+        settle=0.1,
+        idle_timeout=10.0,
+        stop=stop,
+        on_update=on_update,
+    )
+    exporter.join()
+
+    check.is_true(stop.is_set())
+    check.is_true(len(updates) >= 2)
+    jobs = run_jobs(str(watched), plot_dir, poes=[0.002105], kinds=["curve", "uhs"])
+    check.equal(
+        sorted(set(rendered)), sorted(job.path for job in jobs if job is not None)
+    )
+    # the figures are those plot would render, and the curves in the cache
+    check.equal(PlotManifest(plot_dir).stale_jobs(jobs), [])
+    paths = [str(watched / filename) for filename in sorted(filenames)]
+    cache_path = hazard_curves_cache_path(str(watched), sorted(filenames))
+    check.is_not_none(HazardCurves.load(cache_path, files_key(paths)))